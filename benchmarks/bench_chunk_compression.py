@@ -0,0 +1,119 @@
+"""
+Benchmark nén nội dung chunks (CHUNK_COMPRESSION): tỉ lệ nén, thời gian ghi và chi phí đọc
+(get_chunks qua ORM, get_chunk_range, tìm kiếm full-text) của từng codec, có / không có dictionary chung.
+
+Chạy:
+    python benchmarks/bench_chunk_compression.py
+    python benchmarks/bench_chunk_compression.py --docs 50 --chunks 2000 --chunk-size 200
+
+Dùng một file SQLite tạm (nén trong ứng dụng chỉ áp dụng với SQLite, xem database._chunk_encoder).
+zstd chỉ được đo nếu đã cài package zstandard.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+_tmp_dir = tempfile.mkdtemp()
+_db_path = os.path.join(_tmp_dir, 'bench.db')
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_path}"
+
+import chunk_codec
+from sqlalchemy import text
+from database import (
+    Base, ChunkDictionary, engine, SessionLocal, save_document_with_chunks, get_chunks, get_chunk_range,
+    search_chunks, chunk_storage_stats
+)
+
+WORDS = ("hợp đồng thuê nhà bên cho thuê bên thuê thanh toán hóa đơn điện nước tiền cọc thời hạn "
+         "điều khoản trách nhiệm bồi thường vi phạm chấm dứt gia hạn báo cáo tài chính quý doanh thu "
+         "chi phí lợi nhuận kế hoạch nhân sự phòng ban biên bản cuộc họp ngày tháng năm").split()
+PHRASES = ["Căn cứ Bộ luật Dân sự số 91/2015/QH13", "Hai bên thống nhất ký kết hợp đồng với các điều khoản sau",
+           "Điều khoản này có hiệu lực kể từ ngày ký", "Mọi tranh chấp được giải quyết bằng thương lượng"]
+QUERIES = ["hóa đơn", "bồi thường vi phạm", "Bộ luật Dân sự", "không_có_từ_này"]
+
+def make_chunk(rng, size):
+    parts = []
+    while sum(len(p) + 1 for p in parts) < size:
+        if rng.random() < 0.2:
+            parts.append(rng.choice(PHRASES) + ".")
+        else:
+            parts.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 12))) + ".")
+    return " ".join(parts)[:size]
+
+def make_docs(docs, chunks, size):
+    rng = random.Random(42)
+    return [[{'chunk_index': i, 'content': make_chunk(rng, size)} for i in range(chunks)] for _ in range(docs)]
+
+def run(name, codec, use_dict, corpus, samples):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    chunk_codec.CHUNK_COMPRESSION = codec
+    if use_dict:
+        session = SessionLocal()
+        try:
+            session.add(ChunkDictionary(codec=codec, data=chunk_codec.train_dictionary(samples, codec),
+                                        sample_count=len(samples)))
+            session.commit()
+        finally:
+            session.close()
+
+    start = time.perf_counter()
+    doc_ids = [save_document_with_chunks({'file_name': f"{name}_{i}.txt", 'file_path': "bench", 'file_type': ".txt"},
+                                         chunks) for i, chunks in enumerate(corpus)]
+    write = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for doc_id in doc_ids:
+        get_chunks(doc_id)
+    read_orm = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for doc_id in doc_ids:
+        get_chunk_range(doc_id, limit=len(corpus[0]))
+    read_range = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for query in QUERIES:
+        search_chunks(query, limit=20)
+    search = time.perf_counter() - start
+
+    stats = chunk_storage_stats()
+    with engine.connect() as conn:
+        conn.execute(text("VACUUM"))
+    db_size = os.path.getsize(_db_path)
+    print(f"{name:<14} x{stats['ratio']:<6.2f} {stats['stored_bytes'] / 1024 / 1024:9.1f}MB {db_size / 1024 / 1024:9.1f}MB "
+          f"{write:8.2f}s {read_orm:8.2f}s {read_range:8.2f}s {search * 1000:8.1f}ms")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=20)
+    parser.add_argument("--chunks", type=int, default=2000, help="Số chunks mỗi document")
+    parser.add_argument("--chunk-size", type=int, default=300, help="Số ký tự mỗi chunk")
+    args = parser.parse_args()
+
+    corpus = make_docs(args.docs, args.chunks, args.chunk_size)
+    samples = [chunk['content'] for chunk in corpus[0][:2000]]
+    configs = [("none", 'none', False), ("zlib", 'zlib', False), ("zlib+dict", 'zlib', True)]
+    try:
+        chunk_codec.check_codec('zstd')
+        configs += [("zstd", 'zstd', False), ("zstd+dict", 'zstd', True)]
+    except RuntimeError:
+        print("(bỏ qua zstd: chưa cài zstandard)")
+
+    print(f"{args.docs} documents x {args.chunks} chunks x {args.chunk_size} ký tự, SQLite {_db_path}")
+    print(f"{'codec':<14} {'tỉ lệ':<7} {'chunks':>11} {'file db':>11} {'ghi':>9} {'get_chunks':>9} "
+          f"{'range':>9} {'search':>10}")
+    try:
+        for name, codec, use_dict in configs:
+            run(name, codec, use_dict, corpus, samples)
+    finally:
+        Base.metadata.drop_all(bind=engine)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark tốc độ chunking (MB/s) cho từng chế độ: sentence, paragraph, token, sliding.
+
+Chạy:
+    python benchmarks/bench_chunker.py
+    python benchmarks/bench_chunker.py --size-mb 50 --page-kb 64
+
+Văn bản mẫu tiếng Việt (có viết tắt, số thập phân, dấu ba chấm) được đưa vào chunk_text_iter
+theo từng trang page-kb KB, giống cách processor đọc file theo trang.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from chunker import CHUNK_MODES, chunk_text_iter, chunk_text
+
+SAMPLE = (
+    "Theo báo cáo của UBND TP. Hồ Chí Minh, doanh thu quý 3 đạt 1.250,5 tỷ đồng, tăng 3.5% so với cùng kỳ. "
+    "ThS. Nguyễn V. An cho biết: \"Kết quả này vượt kỳ vọng...\" Tuy nhiên vẫn còn nhiều thách thức! "
+    "Các chi phí vận hành, nhân sự, v.v. đều tăng. Liệu năm sau có khả quan hơn?\n"
+    "Đoạn tiếp theo trình bày chi tiết từng hạng mục đầu tư và kế hoạch triển khai trong năm tới.\n\n"
+)
+
+def make_pages(size_mb, page_kb):
+    text = SAMPLE * (int(size_mb * 1024 * 1024) // len(SAMPLE.encode("utf-8")) + 1)
+    page_chars = page_kb * 1024
+    return [text[i:i + page_chars] for i in range(0, len(text), page_chars)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=20)
+    parser.add_argument("--page-kb", type=int, default=64)
+    parser.add_argument("--max-tokens", type=int, default=None)
+    parser.add_argument("--overlap-tokens", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần chạy mỗi chế độ (lấy lần nhanh nhất)")
+    args = parser.parse_args()
+
+    pages = make_pages(args.size_mb, args.page_kb)
+    size_mb = sum(len(p.encode("utf-8")) for p in pages) / (1024 * 1024)
+    print(f"Văn bản: {size_mb:.1f} MB, {len(pages)} trang")
+    print(f"{'mode':<12} {'chunks':>9} {'giây':>8} {'MB/s':>8}")
+
+    def best_of(func):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            count = func()
+            timings.append(time.perf_counter() - start)
+        return count, min(timings)
+
+    for mode in CHUNK_MODES:
+        count, elapsed = best_of(lambda: sum(1 for _ in chunk_text_iter(
+            pages, mode=mode, max_tokens=args.max_tokens, overlap_tokens=args.overlap_tokens)))
+        print(f"{mode:<12} {count:>9} {elapsed:>8.2f} {size_mb / elapsed:>8.1f}")
+
+    # Cách gọi cũ: toàn bộ văn bản trong một chuỗi
+    text = "".join(pages)
+    count, elapsed = best_of(lambda: len(chunk_text(text)))
+    print(f"{'sentence*':<12} {count:>9} {elapsed:>8.2f} {size_mb / elapsed:>8.1f}   (* chunk_text trên một chuỗi)")
+
+if __name__ == "__main__":
+    main()
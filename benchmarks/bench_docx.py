@@ -0,0 +1,81 @@
+"""
+Benchmark trích xuất DOCX lớn: extractor 'python-docx' (dựng toàn bộ DOM) so với 'xml'
+(đọc word/document.xml dạng streaming bằng expat).
+
+Chạy:
+    python benchmarks/bench_docx.py
+    python benchmarks/bench_docx.py --paragraphs 200000 --table-rows 20000
+
+Sinh một file DOCX tạm bằng python-docx (paragraph có nhiều run định dạng + một bảng),
+rồi đo thời gian và bộ nhớ đỉnh của từng extractor, mỗi extractor chạy trong một process
+riêng để số đo bộ nhớ không ảnh hưởng lẫn nhau. tracemalloc chỉ thấy bộ nhớ cấp phát qua Python
+(cây XML của lxml nằm ngoài), nên in thêm max RSS của process.
+"""
+import os
+import sys
+import time
+import argparse
+import resource
+import tempfile
+import zipfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import docx
+from processors.docx_processor import DOCX_EXTRACTORS, stream_docx
+
+def make_file(path, paragraphs, table_rows):
+    document = docx.Document()
+    for i in range(paragraphs):
+        para = document.add_paragraph(f"Điều {i}. ")
+        para.add_run("Bên mua ").bold = True
+        para.add_run("thanh toán hai tỷ đồng trong vòng 30 ngày kể từ ngày ký hợp đồng.").italic = True
+    if table_rows:
+        table = document.add_table(rows=table_rows, cols=3)
+        for i, row in enumerate(table.rows):
+            row.cells[0].text = str(i)
+            row.cells[1].text = "Căn hộ"
+            row.cells[2].text = "2.000.000.000"
+    document.save(path)
+
+def run(path, extractor):
+    # Đo thời gian và bộ nhớ ở hai lượt riêng: tracemalloc làm chậm đáng kể việc cấp phát
+    start = time.perf_counter()
+    chars = sum(len(segment) for segment in stream_docx(path, extractor=extractor))
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    for _ in stream_docx(path, extractor=extractor):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return chars, elapsed, peak, rss
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paragraphs", type=int, default=50000)
+    parser.add_argument("--table-rows", type=int, default=5000)
+    args = parser.parse_args()
+    spawn = multiprocessing.get_context("spawn")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.docx")
+        # max RSS được kế thừa qua fork/exec: sinh file trong process riêng để process chính luôn nhỏ
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+            pool.submit(make_file, path, args.paragraphs, args.table_rows).result()
+        with zipfile.ZipFile(path) as archive:
+            xml_size = archive.getinfo('word/document.xml').file_size
+        print(f"File: {os.path.getsize(path) / (1024 * 1024):.1f} MB "
+              f"(document.xml {xml_size / (1024 * 1024):.1f} MB), "
+              f"{args.paragraphs} paragraph, bảng {args.table_rows} hàng")
+        print(f"{'extractor':<12} {'ký tự':>10} {'giây':>8} {'tracemalloc (MB)':>17} {'max RSS (MB)':>13}")
+        for extractor in DOCX_EXTRACTORS:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                chars, elapsed, peak, rss = pool.submit(run, path, extractor).result()
+            print(f"{extractor:<12} {chars:>10} {elapsed:>8.2f} {peak / (1024 * 1024):>17.1f} {rss / (1024 * 1024):>13.1f}")
+
+if __name__ == "__main__":
+    main()
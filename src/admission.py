@@ -0,0 +1,220 @@
+import os
+import threading
+
+# Giới hạn nhận file của POST /upload/ (tính theo từng process server):
+# - Số request upload được nhận đồng thời (đang đọc body / lưu file), 0 = không giới hạn
+UPLOAD_MAX_CONCURRENCY = int(os.getenv("UPLOAD_MAX_CONCURRENCY", "4"))
+# - Giới hạn mỗi request: số file, kích thước mỗi file, kích thước body (theo Content-Length)
+UPLOAD_MAX_FILES = int(os.getenv("UPLOAD_MAX_FILES", "20"))
+UPLOAD_MAX_FILE_MB = float(os.getenv("UPLOAD_MAX_FILE_MB", "100"))
+UPLOAD_MAX_REQUEST_MB = float(os.getenv("UPLOAD_MAX_REQUEST_MB", "500"))
+# - Ngân sách việc đang chờ: file đã nhận nhưng job chưa xử lý xong, cộng các request đang nhận
+UPLOAD_MAX_PENDING_FILES = int(os.getenv("UPLOAD_MAX_PENDING_FILES", "200"))
+UPLOAD_MAX_PENDING_MB = float(os.getenv("UPLOAD_MAX_PENDING_MB", "2048"))
+# Số giây client nên đợi trước khi gửi lại (header Retry-After của response 429)
+UPLOAD_RETRY_AFTER = int(os.getenv("UPLOAD_RETRY_AFTER", "5"))
+
+_MB = 1024 * 1024
+
+class AdmissionRejected(Exception):
+    """
+    Request upload bị từ chối: status 429 (server đang bận / hết ngân sách), 413 (vượt giới hạn request)
+    hoặc 411 (không có Content-Length).
+    """
+
+    def __init__(self, status_code: int, detail: str, retry_after: int = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)} if self.retry_after is not None else None
+
+class AdmissionStats:
+    """Bộ đếm request / file được nhận và bị từ chối theo lý do (an toàn khi nhiều thread cùng cập nhật)."""
+
+    REJECTIONS = ('busy', 'pending_files', 'pending_bytes', 'too_many_files', 'request_too_large', 'file_too_large',
+                  'length_required')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted_requests = 0
+        self.accepted_files = 0
+        self.rejected = dict.fromkeys(self.REJECTIONS, 0)
+
+    def accept(self, requests: int = 0, files: int = 0):
+        with self._lock:
+            self.accepted_requests += requests
+            self.accepted_files += files
+
+    def reject(self, reason: str, count: int = 1):
+        with self._lock:
+            self.rejected[reason] += count
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'accepted_requests': self.accepted_requests,
+                'accepted_files': self.accepted_files,
+                'rejected': dict(self.rejected),
+                'rejected_total': sum(self.rejected.values())
+            }
+
+class UploadTicket:
+    """Phần ngân sách đang giữ cho một request upload (trả lại khi request kết thúc)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.files = 0
+
+class IngestAdmission:
+    """
+    Kiểm soát lượng việc ingest server nhận (admission control):
+    - enter(size) / leave(ticket): mỗi request upload giữ một chỗ trong UPLOAD_MAX_CONCURRENCY và
+      size byte (Content-Length) trong ngân sách trong lúc đọc body / lưu file
+    - admit_files(ticket, count): giữ chỗ cho count file khi đã biết số file của request;
+      file_allowed(size): file vượt UPLOAD_MAX_FILE_MB bị bỏ qua (các file khác vẫn được nhận)
+    - track(ticket, job_id, size) / finish(job_id): file đã vào hàng đợi được tính vào ngân sách
+      (thay cho phần byte request đã giữ) cho tới khi job xử lý xong (worker gọi finish)
+    Không có Content-Length -> AdmissionRejected 411; vượt giới hạn của request -> AdmissionRejected 413; server đang bận / hết ngân sách -> AdmissionRejected
+    429 kèm Retry-After ngay lập tức (không chờ), để client gửi lại sau thay vì request bị treo.
+    Khi ngân sách đang trống, một request vẫn được nhận dù lớn hơn ngân sách (giới hạn kích thước
+    request riêng là UPLOAD_MAX_REQUEST_MB), để cấu hình lệch nhau không chặn upload mãi mãi.
+    """
+
+    def __init__(self, max_concurrency: int = None, max_pending_files: int = None, max_pending_bytes: int = None,
+                 max_files: int = None, max_file_bytes: int = None, max_request_bytes: int = None,
+                 retry_after: int = None):
+        self.max_concurrency = UPLOAD_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        self.max_files = UPLOAD_MAX_FILES if max_files is None else max_files
+        self.max_file_bytes = int(UPLOAD_MAX_FILE_MB * _MB) if max_file_bytes is None else max_file_bytes
+        self.max_request_bytes = int(UPLOAD_MAX_REQUEST_MB * _MB) if max_request_bytes is None else max_request_bytes
+        self.max_pending_files = UPLOAD_MAX_PENDING_FILES if max_pending_files is None else max_pending_files
+        self.max_pending_bytes = int(UPLOAD_MAX_PENDING_MB * _MB) if max_pending_bytes is None else max_pending_bytes
+        self.retry_after = UPLOAD_RETRY_AFTER if retry_after is None else retry_after
+        self.stats = AdmissionStats()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._reserved_bytes = 0
+        self._reserved_files = 0
+        self._jobs = {}            # job_id -> số byte của file đang chờ xử lý
+        self._job_bytes = 0
+
+    def request_limit(self) -> int:
+        """
+        Kích thước body tối đa của một request (0 = không giới hạn): UPLOAD_MAX_REQUEST_MB, và không
+        quá max_files file cỡ tối đa (body bị từ chối trước khi được đọc, không phải sau khi đã lưu tạm).
+        """
+        limits = [self.max_request_bytes]
+        if self.max_files and self.max_file_bytes:
+            limits.append(self.max_files * self.max_file_bytes)
+        return min((limit for limit in limits if limit), default=0)
+
+    def _busy(self, reason: str, detail: str):
+        self.stats.reject(reason)
+        return AdmissionRejected(429, detail, self.retry_after)
+
+    def enter(self, size: int = 0) -> UploadTicket:
+        """
+        Nhận một request upload có body size byte (theo Content-Length). size None (không có Content-Length,
+        vd: body chunked) bị từ chối với 411: không biết trước kích thước thì không kiểm tra được giới hạn
+        request và ngân sách trước khi body được đọc.
+        """
+        if size is None:
+            self.stats.reject('length_required')
+            raise AdmissionRejected(411, "Upload phải có header Content-Length")
+        limit = self.request_limit()
+        if limit and size > limit:
+            self.stats.reject('request_too_large')
+            raise AdmissionRejected(413, f"Request quá lớn ({size} byte), tối đa {limit} byte")
+        with self._lock:
+            if self.max_concurrency and self._active >= self.max_concurrency:
+                raise self._busy('busy', f"Server đang nhận {self._active} upload khác, thử lại sau")
+            if self.max_pending_files and len(self._jobs) + self._reserved_files >= self.max_pending_files:
+                raise self._busy('pending_files', "Hàng đợi xử lý đã đầy (số file), thử lại sau")
+            pending = self._job_bytes + self._reserved_bytes
+            if self.max_pending_bytes and pending and pending + size > self.max_pending_bytes:
+                raise self._busy('pending_bytes', "Hàng đợi xử lý đã đầy (dung lượng), thử lại sau")
+            self._active += 1
+            self._reserved_bytes += size
+        self.stats.accept(requests=1)
+        return UploadTicket(size)
+
+    def admit_files(self, ticket: UploadTicket, count: int):
+        """Giữ chỗ cho count file của request trong ngân sách số file."""
+        if self.max_files and count > self.max_files:
+            self.stats.reject('too_many_files')
+            raise AdmissionRejected(413, f"Quá nhiều file trong một request ({count}), tối đa {self.max_files}")
+        with self._lock:
+            pending = len(self._jobs) + self._reserved_files
+            if self.max_pending_files and pending and pending + count > self.max_pending_files:
+                raise self._busy('pending_files', f"Hàng đợi xử lý chỉ còn nhận {max(self.max_pending_files - pending, 0)} file, thử lại sau")
+            ticket.files += count
+            self._reserved_files += count
+
+    def file_allowed(self, size) -> bool:
+        """File size byte có nằm trong giới hạn kích thước mỗi file không (size None = không biết, cho qua)."""
+        if self.max_file_bytes and size is not None and size > self.max_file_bytes:
+            self.stats.reject('file_too_large')
+            return False
+        return True
+
+    def track(self, ticket: UploadTicket, job_id: int, size: int):
+        """
+        File của request đã vào hàng đợi (job_id): giữ trong ngân sách tới khi finish(job_id).
+        size byte được chuyển từ phần request đã giữ (Content-Length) sang job, không tính hai lần.
+        """
+        with self._lock:
+            if ticket.files:
+                ticket.files -= 1
+                self._reserved_files -= 1
+            moved = min(size, ticket.size)
+            ticket.size -= moved
+            self._reserved_bytes -= moved
+            self._jobs[job_id] = size
+            self._job_bytes += size
+        self.stats.accept(files=1)
+
+    def leave(self, ticket: UploadTicket):
+        """Request kết thúc: trả lại chỗ và phần ngân sách chưa chuyển thành job."""
+        with self._lock:
+            self._active -= 1
+            self._reserved_bytes -= ticket.size
+            self._reserved_files -= ticket.files
+            ticket.size = ticket.files = 0
+
+    def finish(self, job_id: int):
+        """Job đã xử lý xong (thành công hay thất bại); job không được theo dõi thì bỏ qua."""
+        with self._lock:
+            self._job_bytes -= self._jobs.pop(job_id, 0)
+
+    def restore(self, jobs):
+        """Theo dõi lại các job đang chờ khi server khởi động: jobs là list (job_id, số byte)."""
+        with self._lock:
+            self._jobs = dict(jobs)
+            self._job_bytes = sum(self._jobs.values())
+
+    def as_dict(self):
+        with self._lock:
+            state = {
+                'active_uploads': self._active,
+                'pending_files': len(self._jobs),
+                'pending_bytes': self._job_bytes,
+                'reserved_files': self._reserved_files,
+                'reserved_bytes': self._reserved_bytes,
+                'limits': {
+                    'max_concurrency': self.max_concurrency,
+                    'max_pending_files': self.max_pending_files,
+                    'max_pending_bytes': self.max_pending_bytes,
+                    'max_files_per_request': self.max_files,
+                    'max_file_bytes': self.max_file_bytes,
+                    'max_request_bytes': self.max_request_bytes,
+                    'request_limit_bytes': self.request_limit()
+                }
+            }
+        return {**state, **self.stats.as_dict()}
+
+# Admission control dùng chung của server (app.py nhận request, job worker gọi finish)
+INGEST = IngestAdmission()
@@ -1,15 +1,88 @@
 import os
-import shutil
+import json
+import uuid
+import hashlib
+import logging
 import threading
-from typing import List
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Form, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from database import get_db_session, Document, Chunk, get_unique_filename
-from main import process_file, process_directory
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import (
+    get_db_session, get_async_db_session, init_database, Document, Chunk,
+    create_job, requeue_running_jobs, list_jobs, JOB_PENDING, find_document_by_hash, get_chunk_sets, dispose_async_engine,
+    get_job_async, list_jobs_async, search_chunks_async, search_documents_by_name_async, get_all_documents_async,
+    get_document_async, get_chunks_async, get_chunk_sets_async, get_chunk_range_async, iter_chunks_async
+)
+from main import process_directory, rechunk_document, DEDUP_POLICY, DEDUP_POLICIES, PROCESSORS
+from jobs import JobWorkerPool
+from chunker import parse_chunk_modes
+import ocr
+import chunk_store
+import extract_cache
+import admission
+from admission import AdmissionRejected
 
-app = FastAPI(title="OCR Pipeline App")
+# Worker xử lý job nền cho các file upload
+job_pool = JobWorkerPool()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_database()
+    # Tiếp tục các job bị gián đoạn ở lần chạy trước
+    requeued = requeue_running_jobs()
+    if requeued:
+        logging.info(f"Đưa lại {requeued} job bị gián đoạn vào hàng đợi.")
+    # Job còn trong hàng đợi từ lần chạy trước vẫn chiếm ngân sách upload
+    admission.INGEST.restore(_pending_upload_sizes())
+    job_pool.start()
+    yield
+    job_pool.stop()
+    # Ghi nốt chunks vật lý còn trong hàng đợi (sau khi job cuối cùng đã ghi DB xong)
+    chunk_store.WRITE_BEHIND.shutdown()
+    await dispose_async_engine()
+
+def _pending_upload_sizes() -> list:
+    """(job_id, kích thước file) của các job đang chờ xử lý."""
+    sizes = []
+    for job in list_jobs(JOB_PENDING, limit=None):
+        try:
+            sizes.append((job['id'], os.path.getsize(job['file_path'])))
+        except OSError:
+            sizes.append((job['id'], 0))
+    return sizes
+
+app = FastAPI(title="OCR Pipeline App", lifespan=lifespan)
+
+@app.middleware("http")
+async def upload_admission(request: Request, call_next):
+    """
+    Admission control cho POST /upload/ (xem admission.py): kiểm tra trước khi body được đọc,
+    request không có Content-Length, vượt giới hạn hoặc đến lúc server đã nhận đủ việc bị từ chối ngay
+    (411 / 413 / 429 + Retry-After).
+    """
+    if request.method != "POST" or request.url.path.rstrip("/") != "/upload":
+        return await call_next(request)
+    # Không có Content-Length (body chunked) -> 411: server HTTP đảm bảo body không dài hơn Content-Length
+    try:
+        size = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        size = None
+    ingest = admission.INGEST
+    try:
+        ticket = ingest.enter(size)
+    except AdmissionRejected as e:
+        return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+    request.state.upload_ticket = ticket
+    try:
+        return await call_next(request)
+    finally:
+        ingest.leave(ticket)
 
 # Lấy đường dẫn tuyệt đối của thư mục chứa file này
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -29,8 +102,109 @@ if not os.path.exists(UPLOAD_DIR):
 if not os.path.exists(CHUNKS_DIR):
     os.makedirs(CHUNKS_DIR)
 
-# Các định dạng file được hỗ trợ
-SUPPORTED_EXTENSIONS = {'.pdf', '.docx', '.txt'}
+# Các định dạng file được hỗ trợ: theo registry processor (kể cả processor từ entry point),
+# kiểm tra đuôi file không import processor
+SUPPORTED_EXTENSIONS = PROCESSORS
+
+# Kích thước mỗi lần đọc khi lưu file upload (1MB)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def _reserve_upload_path(filename: str) -> str:
+    """
+    Chọn đường dẫn chưa dùng trong UPLOAD_DIR và tạo sẵn file rỗng bằng O_EXCL (không cần database).
+    Dùng tên file nếu còn trống, ngược lại thêm một mã ngẫu nhiên ngắn. Tên document không phụ thuộc
+    tên file trên đĩa: được cấp khi job lưu document (xem database._add_document).
+    """
+    name, ext = os.path.splitext(filename)
+    candidate = filename
+    while True:
+        path = os.path.join(UPLOAD_DIR, candidate)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.close(fd)
+            return path
+        except FileExistsError:
+            candidate = f"{name}_{uuid.uuid4().hex[:8]}{ext}"
+
+def _save_upload(source, file_path: str) -> str:
+    """
+    Ghi file upload (file tạm Starlette đã nhận) ra đĩa theo từng khối, không đọc toàn bộ vào bộ nhớ.
+    Tính SHA-256 ngay trong lúc ghi. Trả về: hash dạng hex
+    """
+    sha = hashlib.sha256()
+    with open(file_path, "wb") as buffer:
+        while True:
+            data = source.read(UPLOAD_CHUNK_SIZE)
+            if not data:
+                break
+            sha.update(data)
+            buffer.write(data)
+    return sha.hexdigest()
+
+def _store_upload(file: UploadFile, new_filename: str, chunk_modes: list, dedup_policy: str):
+    """
+    Lưu một file upload và đưa vào hàng đợi. Chạy trong threadpool (run_in_threadpool):
+    cấp tên, ghi đĩa và truy vấn database đều là thao tác chặn, không được chạy trên event loop.
+    Trả về: (kết quả cho response, kích thước file đã vào hàng đợi hoặc None)
+    """
+    file_path = _reserve_upload_path(new_filename)
+    try:
+        # Lưu file vào máy
+        content_hash = _save_upload(file.file, file_path)
+
+        # Trùng nội dung với document đã có -> không cần xử lý
+        if dedup_policy == 'skip':
+            existing_id = find_document_by_hash(content_hash, chunk_modes)
+            if existing_id is not None:
+                os.remove(file_path)
+                return {
+                    "filename": file.filename,
+                    "status": "duplicate",
+                    "document_id": existing_id,
+                    "message": f"Nội dung trùng với document {existing_id}, bỏ qua"
+                }, None
+
+        # Đưa vào hàng đợi, worker nền sẽ xử lý với chunk_mode được chọn
+        job_id = create_job(file.filename, file_path, chunk_mode=",".join(chunk_modes),
+                            content_hash=content_hash, dedup_policy=dedup_policy, document_name=new_filename)
+    except Exception:
+        # Không để lại file rỗng / dở dang trong UPLOAD_DIR
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
+    return {
+        "filename": file.filename,
+        "status": "queued",
+        "job_id": job_id,
+        "message": "Đã nhận file, đang chờ xử lý"
+    }, os.path.getsize(file_path)
+
+def _parse_chunk_modes(chunk_mode: str) -> list:
+    try:
+        return parse_chunk_modes(chunk_mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+async def _check_chunk_set(db: AsyncSession, document_id: int, chunk_mode: Optional[str]) -> list:
+    """Các bộ chunks của document; 404 nếu không có document hoặc không có bộ chunks chunk_mode (None = bộ chính)."""
+    chunk_sets = await get_chunk_sets_async(document_id, session=db)
+    if not chunk_sets:
+        raise HTTPException(status_code=404, detail="Document not found")
+    if chunk_mode is not None and all(s["chunk_mode"] != chunk_mode for s in chunk_sets):
+        raise HTTPException(status_code=404, detail=f"Document không có bộ chunks chunk_mode={chunk_mode}")
+    return chunk_sets
+
+def _chunk_json(chunk) -> dict:
+    """Chunk (ORM) cho response: nội dung đã giải nén, không kèm cột lưu trữ nén (content_z, content_codec)."""
+    return {
+        "id": chunk.id,
+        "document_id": chunk.document_id,
+        "chunk_index": chunk.chunk_index,
+        "content": chunk.content,
+        "char_count": chunk.char_count,
+        "page_number": chunk.page_number,
+        "chunk_mode": chunk.chunk_mode
+    }
 
 @app.get("/", response_class=HTMLResponse)
 async def read_root():
@@ -42,9 +216,28 @@ async def read_root():
 
 @app.post("/upload/")
 async def upload_files(
+    request: Request,
     files: List[UploadFile] = File(...),
-    chunk_mode: str = Form("sentence")
+    chunk_mode: str = Form("sentence"),
+    dedup_policy: str = Form(DEDUP_POLICY)
 ):
+    """
+    Nhận file upload và đưa vào hàng đợi xử lý nền.
+    chunk_mode: một hoặc nhiều chunk mode phân cách bằng dấu phẩy (vd: "sentence,paragraph"):
+    file được trích xuất một lần, document có một bộ chunks cho mỗi mode (mode đầu tiên là bộ chính).
+    Số file mỗi request, kích thước mỗi file và lượng file đang chờ xử lý bị giới hạn (xem admission.py):
+    hàng đợi đầy -> 429 kèm Retry-After, không file nào của request được nhận.
+    """
+    chunk_modes = _parse_chunk_modes(chunk_mode)
+    if dedup_policy not in DEDUP_POLICIES:
+        raise HTTPException(status_code=400, detail=f"dedup_policy phải là một trong: {', '.join(DEDUP_POLICIES)}")
+    ingest = admission.INGEST
+    ticket = request.state.upload_ticket
+    try:
+        ingest.admit_files(ticket, len(files))
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers=e.headers)
+
     results = []
     for file in files:
         try:
@@ -54,46 +247,174 @@ async def upload_files(
                 results.append({
                     "filename": file.filename, 
                     "status": "error", 
-                    "message": f"File không được hỗ trợ. Chỉ chấp nhận: {', '.join(SUPPORTED_EXTENSIONS)}"
+                    "message": f"File không được hỗ trợ. Chỉ chấp nhận: {', '.join(sorted(SUPPORTED_EXTENSIONS))}"
+                })
+                continue
+
+            if not ingest.file_allowed(file.size):
+                results.append({
+                    "filename": file.filename,
+                    "status": "error",
+                    "message": f"File quá lớn ({file.size} byte), tối đa {ingest.max_file_bytes} byte"
                 })
                 continue
             
-            # Thêm suffix mode vào tên file (ví dụ: file_sentence.txt hoặc file_paragraph.txt)
+            # Thêm suffix mode vào tên file (ví dụ: file_sentence.txt hoặc file_sentence_paragraph.txt)
             name_only, extension = os.path.splitext(file.filename)
-            new_filename = f"{name_only}_{chunk_mode}{extension}"
-            
-            # Lấy tên file duy nhất để tránh trùng lặp
-            unique_filename = get_unique_filename(new_filename)
-            file_path = os.path.join(UPLOAD_DIR, unique_filename)
-            
-            # Lưu file vào máy
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            # Xử lý file với chunk_mode được chọn
-            result = process_file(file_path, chunk_mode=chunk_mode)
-            if result:
-                results.append({"filename": file.filename, "status": "success", "message": "Đã xử lý và lưu vào database"})
-            else:
-                results.append({"filename": file.filename, "status": "error", "message": "Không thể xử lý file"})
+            new_filename = f"{name_only}_{'_'.join(chunk_modes)}{extension}"
+
+            result, size = await run_in_threadpool(_store_upload, file, new_filename, chunk_modes, dedup_policy)
+            if size is not None:
+                ingest.track(ticket, result["job_id"], size)
+            results.append(result)
         except Exception as e:
             results.append({"filename": file.filename, "status": "error", "message": str(e)})
-            
+
+    job_pool.notify()
     return {"results": results}
 
+# Các endpoint đọc dùng database async (xem database.get_async_engine): chờ database không chiếm
+# thread của threadpool. Endpoint ghi (upload, sửa, xóa, rechunk) vẫn dùng session đồng bộ.
+@app.get("/jobs/{job_id}")
+async def get_job_detail(job_id: int, db: AsyncSession = Depends(get_async_db_session)):
+    """Xem trạng thái của một job xử lý nền"""
+    job = await get_job_async(job_id, session=db)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/jobs")
+async def get_jobs(status: Optional[str] = None, limit: int = 100, db: AsyncSession = Depends(get_async_db_session)):
+    """Danh sách job (mới nhất trước), lọc theo status: pending, running, done, failed"""
+    return await list_jobs_async(status, limit, session=db)
+
+@app.get("/upload/stats")
+def get_upload_stats():
+    """Admission control của upload: số upload đang nhận, hàng đợi (file / byte chờ xử lý), giới hạn, số lần từ chối"""
+    return admission.INGEST.as_dict()
+
+@app.get("/ocr/stats")
+def get_ocr_stats():
+    """Thống kê OCR cộng dồn của server: số trang, thời gian mỗi trang, tỉ lệ cache hit"""
+    return {"enabled": ocr.ocr_available(), **ocr.OCR_STATS.as_dict()}
+
+@app.get("/extract-cache/stats")
+def get_extract_cache_stats():
+    """Thống kê extraction cache của server: hit / miss, số mục đã ghi, số mục bị dọn"""
+    cache = extract_cache.EXTRACT_CACHE
+    return {"enabled": cache.enabled, **cache.stats.as_dict()}
+
+@app.get("/artifacts/stats")
+def get_artifact_stats():
+    """Thống kê ghi chunks vật lý (write-behind): số artifact đã ghi / bị bỏ / lỗi, số lần thử lại, hàng đợi"""
+    writer = chunk_store.WRITE_BEHIND
+    return {
+        "workers": writer.workers,
+        "format": chunk_store.CHUNK_FORMAT,
+        "fsync": chunk_store.CHUNK_FSYNC,
+        "pending": writer.pending(),
+        **writer.stats.as_dict()
+    }
+
+@app.get("/search")
+async def search(q: str, limit: int = 20, offset: int = 0, db: AsyncSession = Depends(get_async_db_session)):
+    """Tìm kiếm full-text trong nội dung chunks, kết quả xếp theo độ liên quan kèm đoạn trích"""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Thiếu từ khóa tìm kiếm")
+    limit = max(1, min(limit, 100))
+    offset = max(0, offset)
+
+    # Lấy dư một dòng để biết còn trang sau hay không
+    hits = await search_chunks_async(q, limit=limit + 1, offset=offset, session=db)
+    return {
+        "query": q,
+        "limit": limit,
+        "offset": offset,
+        "results": hits[:limit],
+        "has_more": len(hits) > limit
+    }
+
 @app.get("/documents/")
-def get_documents(db: Session = Depends(get_db_session)):
-    docs = db.query(Document).order_by(Document.upload_date.desc()).all()
-    return docs
+async def get_documents(limit: int = 100, after: Optional[str] = None, db: AsyncSession = Depends(get_async_db_session)):
+    """
+    Danh sách documents (mới nhất trước), phân trang bằng cursor:
+    truyền next_cursor của trang trước vào after để lấy trang tiếp theo.
+    """
+    try:
+        return await get_all_documents_async(limit=max(1, min(limit, 1000)), after=after, session=db)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/documents/search")
+async def search_documents(q: str, mode: str = "substring", limit: int = 50,
+                           db: AsyncSession = Depends(get_async_db_session)):
+    """
+    Tìm document theo tên file bằng index trigram.
+    mode=substring: tên chứa chuỗi q; mode=similarity: tên gần giống q, xếp theo độ tương đồng
+    """
+    if mode not in ("substring", "similarity"):
+        raise HTTPException(status_code=400, detail="mode phải là substring hoặc similarity")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Thiếu từ khóa tìm kiếm")
+    return await search_documents_by_name_async(q, limit=max(1, min(limit, 100)), mode=mode, session=db)
 
 @app.get("/documents/{document_id}")
-def get_document_detail(document_id: int, db: Session = Depends(get_db_session)):
-    doc = db.query(Document).filter(Document.id == document_id).first()
+async def get_document_detail(document_id: int, chunk_mode: Optional[str] = None,
+                              db: AsyncSession = Depends(get_async_db_session)):
+    """Chi tiết document, danh sách bộ chunks và chunks của bộ chunk_mode (mặc định bộ chính)"""
+    doc = await get_document_async(document_id, session=db)
     if not doc:
         raise HTTPException(status_code=404, detail="Document not found")
     
-    chunks = db.query(Chunk).filter(Chunk.document_id == document_id).order_by(Chunk.chunk_index).all()
-    return {"document": doc, "chunks": chunks}
+    chunk_sets = await _check_chunk_set(db, document_id, chunk_mode)
+    chunks = await get_chunks_async(document_id, chunk_mode, session=db)
+    return {"document": doc, "chunk_sets": chunk_sets, "chunks": [_chunk_json(chunk) for chunk in chunks]}
+
+@app.post("/documents/{document_id}/rechunk")
+def rechunk(document_id: int, chunk_mode: str = Form(...)):
+    """
+    Chunk lại document từ file gốc theo một hoặc nhiều chunk mode (phân cách bằng dấu phẩy), trích xuất một lần.
+    Mode chưa có được thêm thành bộ chunks mới của document, mode đã có được thay thế.
+    """
+    chunk_modes = _parse_chunk_modes(chunk_mode)
+    try:
+        counts = rechunk_document(document_id, chunk_modes)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if counts is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    return {"document_id": document_id, "rechunked": counts, "chunk_sets": get_chunk_sets(document_id)}
+
+@app.get("/documents/{document_id}/chunks")
+async def get_document_chunks(
+    document_id: int,
+    start: int = 0,
+    end: Optional[int] = None,
+    limit: int = 100,
+    format: str = "json",
+    chunk_mode: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db_session)
+):
+    """
+    Lấy chunks của document theo khoảng chunk_index [start, end), trong bộ chunks chunk_mode (mặc định bộ chính).
+    format=json: một trang tối đa limit chunks, kèm next_start để lấy trang sau
+    format=ndjson: stream toàn bộ khoảng, mỗi dòng một chunk (bộ nhớ không phụ thuộc kích thước document);
+    các trang được đọc bằng session riêng vì stream chạy sau khi session của request đã đóng
+    """
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format phải là json hoặc ndjson")
+    await _check_chunk_set(db, document_id, chunk_mode)
+
+    start = max(0, start)
+    if format == "ndjson":
+        lines = (json.dumps(chunk, ensure_ascii=False) + "\n"
+                 async for chunk in iter_chunks_async(document_id, start, end, chunk_mode=chunk_mode))
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    return await get_chunk_range_async(document_id, start=start, end=end, limit=max(1, min(limit, 1000)),
+                                       chunk_mode=chunk_mode, session=db)
 
 @app.put("/documents/{document_id}")
 def update_document(document_id: int, new_name: str, db: Session = Depends(get_db_session)):
@@ -103,7 +424,11 @@ def update_document(document_id: int, new_name: str, db: Session = Depends(get_d
         raise HTTPException(status_code=404, detail="Document not found")
     
     doc.file_name = new_name
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Đã có document tên {new_name}")
     db.refresh(doc)
     return {"message": "Document updated", "document": doc}
 
@@ -0,0 +1,104 @@
+import os
+import zlib
+from functools import lru_cache
+from collections import Counter
+
+# Nén nội dung chunk trong database (cột chunks.content_z, xem database.py):
+# - none: lưu text thường trong chunks.content (mặc định)
+# - zlib: deflate (thư viện chuẩn), dùng dictionary chung của corpus nếu đã train
+# - zstd: cần package zstandard (pip install zstandard)
+CHUNK_COMPRESSION_CODECS = ('none', 'zlib', 'zstd')
+CHUNK_COMPRESSION = os.getenv("CHUNK_COMPRESSION", "none")
+# Mức nén (mặc định của từng codec nếu không đặt)
+CHUNK_COMPRESSION_LEVEL = int(os.getenv("CHUNK_COMPRESSION_LEVEL", "0")) or None
+# Chunk ngắn hơn số byte này được lưu text thường (nén không có lợi)
+CHUNK_COMPRESSION_MIN_BYTES = int(os.getenv("CHUNK_COMPRESSION_MIN_BYTES", "64"))
+# Kích thước dictionary chung (zlib chỉ dùng được tối đa 32KB cuối của dictionary)
+CHUNK_DICT_SIZE = int(os.getenv("CHUNK_DICT_SIZE", str(32 * 1024)))
+
+_ZLIB_WBITS = -15      # Raw deflate: không header / checksum, tiết kiệm 6 byte mỗi chunk
+_ZLIB_MAX_DICT = 32 * 1024
+
+def check_codec(codec):
+    if codec not in CHUNK_COMPRESSION_CODECS:
+        raise ValueError(f"CHUNK_COMPRESSION không hợp lệ: {codec} (chọn một trong: {', '.join(CHUNK_COMPRESSION_CODECS)})")
+    if codec == 'zstd':
+        _zstd()
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("CHUNK_COMPRESSION=zstd cần package zstandard (pip install zstandard)")
+    return zstandard
+
+def codec_tag(codec, dictionary_id=None):
+    """Giá trị cột content_codec: 'zlib' hoặc 'zlib:<id dictionary>'."""
+    return codec if dictionary_id is None else f"{codec}:{dictionary_id}"
+
+def parse_tag(tag):
+    """'zlib:3' -> ('zlib', 3); 'zlib' -> ('zlib', None)"""
+    codec, _, dictionary_id = tag.partition(":")
+    return codec, (int(dictionary_id) if dictionary_id else None)
+
+def compress(text, codec, dictionary=None, level=None):
+    """Nén text (UTF-8) bằng codec, dictionary: bytes của dictionary chung (hoặc None)."""
+    data = text.encode("utf-8")
+    level = level or CHUNK_COMPRESSION_LEVEL
+    if codec == 'zlib':
+        compressor = _zlib_compressor(dictionary, level or zlib.Z_DEFAULT_COMPRESSION).copy()
+        return compressor.compress(data) + compressor.flush()
+    if codec == 'zstd':
+        zstandard = _zstd()
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        return zstandard.ZstdCompressor(level=level or 3, dict_data=dict_data, write_checksum=False).compress(data)
+    raise ValueError(f"Codec không hợp lệ: {codec}")
+
+@lru_cache(maxsize=8)
+def _zlib_compressor(dictionary, level):
+    # Compressor đã nạp sẵn dictionary, mỗi chunk dùng một bản copy (rẻ hơn nạp lại dictionary mỗi lần)
+    kwargs = {'zdict': dictionary} if dictionary else {}
+    return zlib.compressobj(level, zlib.DEFLATED, _ZLIB_WBITS, **kwargs)
+
+def decompress(data, codec, dictionary=None):
+    if codec == 'zlib':
+        kwargs = {'zdict': dictionary} if dictionary else {}
+        decompressor = zlib.decompressobj(_ZLIB_WBITS, **kwargs)
+        return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+    if codec == 'zstd':
+        zstandard = _zstd()
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+        return zstandard.ZstdDecompressor(dict_data=dict_data).decompress(data).decode("utf-8")
+    raise ValueError(f"Codec không hợp lệ: {codec}")
+
+def train_dictionary(samples, codec, size=None):
+    """
+    Tạo dictionary chung từ các chunk mẫu của corpus: chunk nhỏ nén riêng lẻ gần như không có gì để
+    tham chiếu lại, dictionary cung cấp sẵn các chuỗi hay gặp (từ, cụm từ, tiêu đề lặp lại...).
+    - zstd: zstandard.train_dictionary
+    - zlib: các từ / cụm 2-3 từ lặp lại nhiều nhất, xếp tăng dần theo số byte tiết kiệm được
+      (deflate mã hóa khoảng cách gần rẻ hơn, nên chuỗi có lợi nhất nằm cuối dictionary)
+    """
+    size = size or CHUNK_DICT_SIZE
+    samples = [sample for sample in samples if sample]
+    if codec == 'zstd':
+        return _zstd().train_dictionary(size, [s.encode("utf-8") for s in samples]).as_bytes()
+    if codec != 'zlib':
+        raise ValueError(f"Codec không hợp lệ: {codec}")
+
+    counts = Counter()
+    for sample in samples:
+        words = sample.split()
+        for n in (1, 2, 3):
+            counts.update(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+    scored = sorted(((count - 1) * len(gram.encode("utf-8")), gram) for gram, count in counts.items() if count > 1)
+
+    picked, total = [], 0
+    limit = min(size, _ZLIB_MAX_DICT)
+    for _, gram in reversed(scored):
+        length = len(gram.encode("utf-8")) + 1
+        if total + length > limit:
+            continue
+        picked.append(gram)
+        total += length
+    return " ".join(reversed(picked)).encode("utf-8")
@@ -0,0 +1,531 @@
+import os
+import mmap
+import time
+import queue
+import atexit
+import shutil
+import struct
+import logging
+import threading
+from collections import deque
+from itertools import accumulate
+
+# Định dạng lưu chunks vật lý của mỗi document (đường dẫn gốc: chunks_data/<tên>_<mode>_chunks):
+# - files: thư mục chứa mỗi chunk một file chunk_<i>.txt (như cũ)
+# - packed: hai file <gốc>.pack (nội dung UTF-8 các chunk nối liền nhau) và <gốc>.idx (offset kết thúc
+#   của từng chunk), đọc ngẫu nhiên chunk thứ N qua mmap mà không phải đọc các chunk khác
+CHUNK_FORMATS = ('files', 'packed')
+CHUNK_FORMAT = os.getenv("CHUNK_FORMAT", "files")
+
+# fsync khi ghi chunks vật lý:
+# - none: không fsync, dựa vào page cache của OS (như cũ)
+# - commit: fsync một lần khi artifact hoàn tất (packed: .pack/.idx trước khi đổi tên; files: từng file chunk)
+# - always: fsync sau mỗi lô chunks
+CHUNK_FSYNC_POLICIES = ('none', 'commit', 'always')
+CHUNK_FSYNC = os.getenv("CHUNK_FSYNC", "none")
+
+PACK_SUFFIX = ".pack"
+INDEX_SUFFIX = ".idx"
+# File .idx: magic (8 byte) rồi mỗi chunk một uint64 little-endian = offset byte kết thúc chunk trong .pack
+_INDEX_MAGIC = b"OCRCHK\x00\x01"
+_OFFSET = struct.Struct("<Q")
+
+def _check_options(chunk_format, fsync):
+    if chunk_format not in CHUNK_FORMATS:
+        raise ValueError(f"Định dạng chunks không hợp lệ: {chunk_format} (chọn một trong: {', '.join(CHUNK_FORMATS)})")
+    if fsync not in CHUNK_FSYNC_POLICIES:
+        raise ValueError(f"Chính sách fsync không hợp lệ: {fsync} (chọn một trong: {', '.join(CHUNK_FSYNC_POLICIES)})")
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def _sync_dir(path):
+    """fsync thư mục để việc tạo / đổi tên file trong đó bền vững (bỏ qua trên hệ điều hành không hỗ trợ)."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class ChunkDirWriter:
+    """Ghi mỗi chunk một file chunk_<i>.txt; thư mục chỉ được tạo khi có chunk đầu tiên."""
+
+    def __init__(self, path, fsync=None):
+        self.path = path
+        self.fsync = fsync or CHUNK_FSYNC
+        self.count = 0
+
+    def write(self, content):
+        self.write_batch([content])
+
+    def write_batch(self, contents):
+        """Ghi một lô chunks; gọi lại với cùng lô sau lỗi sẽ ghi đè đúng các file đó."""
+        if not contents:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        for i, content in enumerate(contents, start=self.count):
+            with open(os.path.join(self.path, f"chunk_{i}.txt"), "w", encoding="utf-8") as f:
+                f.write(content)
+                if self.fsync != 'none':
+                    _sync(f)
+        self.count += len(contents)
+
+    def close(self):
+        if self.count and self.fsync != 'none':
+            _sync_dir(self.path)
+
+    def abort(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class PackedChunkWriter:
+    """
+    Ghi chunks vào <path>.pack + <path>.idx. Trong lúc ghi dùng file .tmp, khi close() mới đổi tên
+    (file .idx sau cùng), nên reader không bao giờ thấy artifact ghi dở.
+    """
+
+    def __init__(self, path, fsync=None):
+        self.path = path
+        self.fsync = fsync or CHUNK_FSYNC
+        self.count = 0
+        self._offset = 0                    # Số byte đã ghi xong vào .pack
+        self._index_size = len(_INDEX_MAGIC)  # Số byte đã ghi xong vào .idx
+        self._data = None
+        self._index = None
+
+    def write(self, content):
+        self.write_batch([content])
+
+    def write_batch(self, contents):
+        """
+        Ghi một lô chunks. Vị trí ghi chỉ được cập nhật khi cả lô ghi xong, nên có thể gọi lại
+        với cùng lô sau lỗi: phần ghi dở của lần trước bị cắt bỏ.
+        """
+        if not contents:
+            return
+        if self._data is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._data = open(self.path + PACK_SUFFIX + ".tmp", "wb")
+            self._index = open(self.path + INDEX_SUFFIX + ".tmp", "wb")
+            self._index.write(_INDEX_MAGIC)
+        data = [content.encode("utf-8") for content in contents]
+        ends = list(accumulate(map(len, data), initial=self._offset))[1:]
+        for f, position, payload in ((self._data, self._offset, b"".join(data)),
+                                     (self._index, self._index_size, b"".join(map(_OFFSET.pack, ends)))):
+            f.seek(position)
+            f.truncate()
+            f.write(payload)
+            if self.fsync == 'always':
+                _sync(f)
+        self._offset = ends[-1]
+        self._index_size += len(ends) * _OFFSET.size
+        self.count += len(contents)
+
+    def _close_files(self):
+        for f in (self._data, self._index):
+            if f is not None:
+                f.close()
+
+    def close(self):
+        if self._data is None:
+            return
+        if self.fsync != 'none':
+            for f in (self._data, self._index):
+                if not f.closed:
+                    _sync(f)
+        self._close_files()
+        # Gọi lại được sau lỗi: file nào đã đổi tên thì bỏ qua
+        for suffix in (PACK_SUFFIX, INDEX_SUFFIX):
+            if os.path.exists(self.path + suffix + ".tmp"):
+                os.replace(self.path + suffix + ".tmp", self.path + suffix)
+        if self.fsync != 'none':
+            _sync_dir(os.path.dirname(self.path) or ".")
+
+    def abort(self):
+        self._close_files()
+        remove_chunks(self.path)
+
+def open_writer(path, chunk_format=None, fsync=None):
+    """
+    Writer cho định dạng chunk_format (mặc định CHUNK_FORMAT) với chính sách fsync (mặc định CHUNK_FSYNC):
+    write(content) / write_batch(contents) theo đúng thứ tự chunk_index, close() khi xong, abort() để bỏ.
+    """
+    chunk_format = chunk_format or CHUNK_FORMAT
+    fsync = fsync or CHUNK_FSYNC
+    _check_options(chunk_format, fsync)
+    writer = PackedChunkWriter if chunk_format == 'packed' else ChunkDirWriter
+    return writer(path, fsync)
+
+def remove_chunks(path):
+    """Xóa chunks vật lý của một document ở cả hai định dạng (kể cả file .tmp ghi dở)."""
+    shutil.rmtree(path, ignore_errors=True)
+    for suffix in (PACK_SUFFIX, INDEX_SUFFIX):
+        for name in (path + suffix, path + suffix + ".tmp"):
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+
+def replace_chunks(src, dst):
+    """
+    Thay chunks vật lý tại dst bằng chunks đã ghi xong tại src (src không có chunk nào thì chỉ xóa dst).
+    Gọi lại được sau lỗi giữa chừng: file packed nào đã chuyển sang dst thì bỏ qua.
+    """
+    if os.path.isdir(src):
+        remove_chunks(dst)
+        os.replace(src, dst)
+        return
+    parts = [suffix for suffix in (PACK_SUFFIX, INDEX_SUFFIX) if os.path.exists(src + suffix)]
+    if not parts:
+        remove_chunks(dst)
+        return
+    shutil.rmtree(dst, ignore_errors=True)
+    # File .idx đổi tên sau cùng, như PackedChunkWriter.close()
+    for suffix in parts:
+        os.replace(src + suffix, dst + suffix)
+
+class PackedChunkReader:
+    """
+    Đọc artifact packed qua mmap: len(reader) là số chunk, reader[n] trả về nội dung chunk thứ n
+    (chỉ đọc đúng vùng byte của chunk đó). Dùng như context manager hoặc gọi close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = self._data = None
+        with open(path + INDEX_SUFFIX, "rb") as f:
+            self._index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._index[:len(_INDEX_MAGIC)] != _INDEX_MAGIC:
+            self.close()
+            raise ValueError(f"File index chunks không hợp lệ: {path + INDEX_SUFFIX}")
+        self._count = (len(self._index) - len(_INDEX_MAGIC)) // _OFFSET.size
+        with open(path + PACK_SUFFIX, "rb") as f:
+            # mmap không nhận file rỗng (document có các chunk rỗng)
+            if os.fstat(f.fileno()).st_size:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _end(self, n):
+        return _OFFSET.unpack_from(self._index, len(_INDEX_MAGIC) + n * _OFFSET.size)[0]
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += self._count
+        if not 0 <= n < self._count:
+            raise IndexError(f"Chunk {n} không tồn tại (có {self._count} chunks)")
+        start = self._end(n - 1) if n else 0
+        end = self._end(n)
+        return self._data[start:end].decode("utf-8") if end > start else ""
+
+    def __iter__(self):
+        for n in range(self._count):
+            yield self[n]
+
+    def close(self):
+        for m in (self._index, self._data):
+            if m is not None:
+                m.close()
+        self._index = self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ChunkDirReader:
+    """Đọc chunks định dạng files với cùng giao diện PackedChunkReader."""
+
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"Không tìm thấy chunks: {path}")
+        self.path = path
+        self._count = None
+
+    def __len__(self):
+        if self._count is None:
+            self._count = sum(1 for name in os.listdir(self.path)
+                              if name.startswith("chunk_") and name.endswith(".txt"))
+        return self._count
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        try:
+            with open(os.path.join(self.path, f"chunk_{n}.txt"), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise IndexError(f"Chunk {n} không tồn tại trong {self.path}") from None
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_reader(path):
+    """Mở chunks vật lý của một document, tự nhận định dạng (packed nếu có <path>.idx)."""
+    if os.path.exists(path + INDEX_SUFFIX):
+        return PackedChunkReader(path)
+    return ChunkDirReader(path)
+
+def read_chunk(path, n):
+    """Nội dung chunk thứ n của document có chunks lưu tại path (đường dẫn gốc, xem CHUNK_FORMATS)."""
+    with open_reader(path) as reader:
+        return reader[n]
+
+# Ghi chunks vật lý kiểu write-behind: bước ghi DB chỉ đưa chunks vào hàng đợi, thread nền ghi ra đĩa.
+# Số thread ghi (0 = ghi ngay trong thread gọi, không dùng hàng đợi)
+CHUNK_WRITE_WORKERS = int(os.getenv("CHUNK_WRITE_WORKERS", "2"))
+# Số lô tối đa chờ trong hàng đợi của mỗi thread: đầy thì bước ghi DB phải chờ (giới hạn bộ nhớ)
+CHUNK_WRITE_QUEUE = int(os.getenv("CHUNK_WRITE_QUEUE", "64"))
+# Số chunks mỗi lô đưa vào hàng đợi
+CHUNK_WRITE_BATCH = int(os.getenv("CHUNK_WRITE_BATCH", "256"))
+# Số lần thử lại khi ghi lỗi (chờ 0.1s, 0.2s, 0.4s...), hết lượt thì artifact bị bỏ và ghi nhận lỗi
+CHUNK_WRITE_RETRIES = int(os.getenv("CHUNK_WRITE_RETRIES", "3"))
+CHUNK_WRITE_RETRY_DELAY = 0.1
+
+# Hậu tố đường dẫn tạm của artifact thay thế chunks đã có (ChunkWriteBehind.open(..., replace=True))
+STAGING_SUFFIX = ".new"
+
+# Sentinel báo cho thread ghi dừng lại
+_STOP = object()
+
+class WriteBehindStats:
+    """Thống kê ghi chunks vật lý (an toàn khi nhiều thread cùng cập nhật)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.committed = 0         # Số artifact đã ghi xong
+        self.aborted = 0           # Số artifact bị bỏ vì ghi DB lỗi
+        self.failed = 0            # Số artifact ghi lỗi sau khi hết lượt thử lại
+        self.chunks_written = 0
+        self.retries = 0
+        self.blocked_seconds = 0.0  # Tổng thời gian bước ghi DB phải chờ vì hàng đợi đầy
+        self.recent_failures = deque(maxlen=20)
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def record_failure(self, path, error):
+        with self._lock:
+            self.failed += 1
+            self.recent_failures.append({'path': path, 'error': str(error)})
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'committed': self.committed,
+                'aborted': self.aborted,
+                'failed': self.failed,
+                'chunks_written': self.chunks_written,
+                'retries': self.retries,
+                'blocked_seconds': round(self.blocked_seconds, 3),
+                'recent_failures': list(self.recent_failures)
+            }
+
+class _Artifact:
+    """
+    Chunks vật lý của một document đang được ghi qua ChunkWriteBehind.
+    Phía gọi: write(content) rồi commit() (sau khi DB commit) hoặc abort().
+    writer chỉ được thread ghi của artifact dùng tới. Artifact có target được ghi ở path tạm và chỉ
+    thay chunks tại target khi commit.
+    """
+
+    def __init__(self, owner, path, chunk_format, fsync, worker, target=None):
+        self._owner = owner
+        self._worker = worker
+        self._batch = []
+        self.path = path
+        self.target = target
+        self.chunk_format = chunk_format
+        self.fsync = fsync
+        self.writer = None
+        self.failed = False
+
+    def write(self, content):
+        self._batch.append(content)
+        if len(self._batch) >= self._owner.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._batch:
+            self._owner._submit(self._worker, (self, 'write', self._batch))
+            self._batch = []
+
+    def commit(self):
+        self._flush()
+        self._owner._submit(self._worker, (self, 'commit', None))
+
+    def abort(self):
+        self._batch = []
+        self._owner._submit(self._worker, (self, 'abort', None))
+
+class ChunkWriteBehind:
+    """
+    Ghi chunks vật lý trên pool thread nền với hàng đợi có giới hạn.
+    Mỗi artifact luôn do cùng một thread ghi (giữ đúng thứ tự chunks), chọn theo path: các artifact cùng
+    path (vd: document được chunk lại khi lần ghi đầu còn trong hàng đợi) được ghi lần lượt, không bao giờ
+    cùng lúc vào cùng file .tmp / .pack / .idx, và artifact mở sau thắng; ghi lỗi được thử lại
+    CHUNK_WRITE_RETRIES lần, hết lượt thì artifact bị bỏ, lỗi được log và đếm trong stats.
+    drain() chờ ghi xong mọi thứ đã đưa vào hàng đợi, shutdown() drain rồi dừng các thread
+    (cũng được gọi tự động khi process thoát).
+    """
+
+    def __init__(self, workers=None, queue_size=None, batch_size=None, retries=None):
+        self.workers = CHUNK_WRITE_WORKERS if workers is None else workers
+        self.queue_size = queue_size or CHUNK_WRITE_QUEUE
+        self.batch_size = batch_size or CHUNK_WRITE_BATCH
+        self.retries = CHUNK_WRITE_RETRIES if retries is None else retries
+        self.stats = WriteBehindStats()
+        self._queues = []
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def open(self, path, chunk_format=None, fsync=None, replace=False):
+        """
+        Bắt đầu artifact mới tại path (xem open_writer). replace=True: chunks được ghi vào
+        <path>.new, chunks cũ tại path chỉ bị thay khi commit (abort giữ nguyên chunks cũ).
+        """
+        chunk_format = chunk_format or CHUNK_FORMAT
+        fsync = fsync or CHUNK_FSYNC
+        _check_options(chunk_format, fsync)
+        worker = hash(os.path.abspath(path)) % max(self.workers, 1)
+        if replace:
+            return _Artifact(self, path + STAGING_SUFFIX, chunk_format, fsync, worker, target=path)
+        return _Artifact(self, path, chunk_format, fsync, worker)
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self._threads = [
+                threading.Thread(target=self._run, args=(q,), name=f"chunk-writer-{i}", daemon=True)
+                for i, q in enumerate(self._queues)
+            ]
+            for t in self._threads:
+                t.start()
+        atexit.register(self.shutdown)
+
+    def _submit(self, worker, item):
+        if self.workers <= 0:
+            self._apply(*item)
+            return
+        if not self._threads:
+            self._start()
+        q = self._queues[worker]
+        try:
+            q.put_nowait(item)
+        except queue.Full:
+            started = time.perf_counter()
+            q.put(item)
+            self.stats.add(blocked_seconds=time.perf_counter() - started)
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is _STOP:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            self._apply(*item)
+
+    def _apply(self, artifact, op, contents):
+        if artifact.failed:
+            return
+        if op == 'abort':
+            if artifact.writer is not None:
+                artifact.writer.abort()
+            self.stats.add(aborted=1)
+            return
+        for attempt in range(self.retries + 1):
+            try:
+                if artifact.writer is None:
+                    if artifact.target is not None:
+                        # Bỏ phần ghi dở của lần thay thế trước (vd: process bị dừng giữa chừng)
+                        remove_chunks(artifact.path)
+                    artifact.writer = open_writer(artifact.path, artifact.chunk_format, artifact.fsync)
+                if op == 'write':
+                    artifact.writer.write_batch(contents)
+                    self.stats.add(chunks_written=len(contents))
+                else:
+                    artifact.writer.close()
+                    if artifact.target is not None:
+                        replace_chunks(artifact.path, artifact.target)
+                    if artifact.writer.count:
+                        self.stats.add(committed=1)
+                        logging.info(f"Đã lưu {artifact.writer.count} chunks vào: {artifact.target or artifact.path}")
+                return
+            except Exception as e:
+                if attempt < self.retries:
+                    self.stats.add(retries=1)
+                    logging.warning(f"Lỗi khi lưu chunks vật lý {artifact.path}: {e}, "
+                                    f"thử lại ({attempt + 1}/{self.retries})")
+                    time.sleep(CHUNK_WRITE_RETRY_DELAY * 2 ** attempt)
+                    continue
+                logging.error(f"Lỗi khi lưu chunks vật lý {artifact.path}: {e}, bỏ artifact")
+                artifact.failed = True
+                self.stats.record_failure(artifact.path, e)
+                try:
+                    artifact.writer.abort()
+                except Exception:
+                    pass
+
+    def pending(self):
+        """Số lô đang chờ trong hàng đợi."""
+        return sum(q.qsize() for q in self._queues)
+
+    def drain(self, timeout=None) -> bool:
+        """Chờ ghi xong mọi lô đã đưa vào hàng đợi. Trả về False nếu hết timeout (giây)."""
+        if not self._threads:
+            return True
+        markers = []
+        for q in self._queues:
+            marker = threading.Event()
+            q.put(marker)
+            markers.append(marker)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for marker in markers:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not marker.wait(remaining):
+                return False
+        return True
+
+    def shutdown(self, timeout=None) -> bool:
+        """Drain rồi dừng các thread ghi (dùng lại được: lần ghi sau sẽ khởi động lại thread)."""
+        with self._lock:
+            threads, queues = self._threads, self._queues
+        if not threads:
+            return True
+        drained = self.drain(timeout)
+        if not drained:
+            logging.error(f"Hết thời gian chờ ghi chunks vật lý, còn {self.pending()} lô trong hàng đợi.")
+        for q in queues:
+            q.put(_STOP)
+        for t in threads:
+            t.join(timeout)
+        with self._lock:
+            self._threads, self._queues = [], []
+        atexit.unregister(self.shutdown)
+        return drained
+
+# Write-behind dùng chung của pipeline (xem GET /artifacts/stats)
+WRITE_BEHIND = ChunkWriteBehind()
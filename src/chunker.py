@@ -1,74 +1,501 @@
+import os
 import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import accumulate
 
-def chunk_text(text, mode="sentence", max_size=1000):
+# Các chế độ chunking
+CHUNK_MODES = ("sentence", "paragraph", "token", "sliding")
+
+# Chế độ token / sliding: số token tối đa mỗi chunk và số token lặp lại giữa hai chunk liền nhau
+CHUNK_TOKEN_BUDGET = int(os.getenv("CHUNK_TOKEN_BUDGET", "256"))
+CHUNK_TOKEN_OVERLAP = int(os.getenv("CHUNK_TOKEN_OVERLAP", "32"))
+
+# Dấu kết thúc câu và một câu hoàn chỉnh (chế độ sentence)
+_SENTENCE_END = re.compile(r'[.!?]')
+_SENTENCE = re.compile(r'[^.!?]*[.!?]')
+
+def parse_chunk_modes(value):
+    """
+    'sentence,paragraph' (hoặc list) -> ['sentence', 'paragraph']: danh sách chunk mode không trùng, giữ thứ tự.
+    Raise ValueError nếu rỗng hoặc có mode không hợp lệ.
+    """
+    parts = value.split(",") if isinstance(value, str) else value
+    modes = list(dict.fromkeys(part.strip() for part in parts if part.strip()))
+    invalid = [mode for mode in modes if mode not in CHUNK_MODES]
+    if invalid or not modes:
+        raise ValueError(f"chunk_mode phải là một hoặc nhiều (phân cách bằng dấu phẩy) trong: {', '.join(CHUNK_MODES)}")
+    return modes
+
+def chunk_text(text, mode="sentence", max_size=1000, max_tokens=None, overlap_tokens=None):
+    """Chia văn bản thành danh sách chunks (xem chunk_text_iter)."""
     if not text:
         return []
+    return list(chunk_text_iter(text, mode=mode, max_size=max_size,
+                                max_tokens=max_tokens, overlap_tokens=overlap_tokens))
 
-    text = text.strip()
-    chunks = []
-    current = ""
-
-    # --- Tách đoạn hoặc câu ---
-    if mode == "paragraph":
-        parts = [p.strip() for p in text.split("\n") if p.strip()]
-        glue = "\n"
-
-    else:  # mode == "sentence"
-        # Regex: tách câu có . ? !
-        parts = re.findall(r'[^.!?]*[.!?]', text)
-        parts = [s.strip() for s in parts if s.strip()]
-        glue = " "
-        
-        # Fallback: nếu không có câu nào, chia theo max_size
-        if not parts:
-            parts = [text[i:i+max_size] for i in range(0, len(text), max_size)]
-            return [p.strip() for p in parts if p.strip()]
+def _iter_pieces(text):
+    if isinstance(text, str):
+        yield text
+    elif text is not None:
+        yield from text
+
+def chunk_text_iter(pieces, mode="sentence", max_size=1000, max_tokens=None, overlap_tokens=None):
+    """
+    Chia văn bản thành chunks theo kiểu streaming (generator).
+    pieces: chuỗi, hoặc iterable các mảnh văn bản (trang, đoạn...) được nối liền nhau
+    mode: 'sentence' (tách theo . ? !), 'paragraph' (tách theo xuống dòng), tối đa max_size ký tự/chunk;
+          'token' / 'sliding': giới hạn theo số token (xem chunk_tokens_iter)
+    Kết quả giống hệt chunk_text trên toàn bộ văn bản ghép lại, nhưng chunk được trả ra
+    sau mỗi mảnh; bộ nhớ chỉ gồm mảnh hiện tại, chunk đang build và câu/đoạn dở dang.
+    """
+    if mode in ("token", "sliding"):
+        yield from chunk_tokens_iter(pieces, mode=mode, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+        return
+
+    paragraph = mode == "paragraph"
+    glue = "\n" if paragraph else " "
 
     # ==========================================================
-    # XỬ LÝ TỪNG PHẦN (câu hoặc đoạn) ĐỂ TẠO CHUNKS
+    # GHÉP CÁC PHẦN (câu hoặc đoạn) THÀNH CHUNKS
     # ==========================================================
     # Thuật toán:
-    # - Duyệt qua từng phần (câu/đoạn) đã tách
     # - Cố gắng ghép nhiều phần vào 1 chunk sao cho không vượt max_size
-    # - Nếu 1 phần đơn lẻ đã vượt max_size thì chia nhỏ phần đó
+    # - Nếu 1 phần đơn lẻ đã vượt max_size thì chia nhỏ phần đó thành các mảnh max_size
+    # Chunk đang build được giữ dạng list các phần (nối bằng join khi lưu),
+    # tránh cộng chuỗi lặp đi lặp lại.
     # ==========================================================
-    
-    for p in parts:
-        # Thêm ký tự nối (dấu cách hoặc xuống dòng) sau mỗi phần
-        item = p + glue
-
-        # ----- TRƯỜNG HỢP 1: Phần hiện tại QUÁ DÀI (> max_size) -----
-        # Ví dụ: Một câu dài 1500 ký tự, max_size = 1000
-        # => Phải chia câu đó thành nhiều chunks nhỏ hơn
-        if len(item) > max_size:
-            # Lưu chunk đang build (nếu có) trước khi xử lý phần dài
-            if current:
-                chunks.append(current.strip())
-                current = ""
-
-            # Chia phần dài thành nhiều mảnh, mỗi mảnh <= max_size
-            start = 0
-            while start < len(item):
-                cut = item[start:start + max_size]
-                chunks.append(cut.strip())
-                start += max_size
-
-            continue  # Bỏ qua logic ghép bên dưới, xử lý phần tiếp theo
-
-        # ----- TRƯỜNG HỢP 2: Có thể GHÉP vào chunk hiện tại -----
-        # Kiểm tra nếu ghép thêm phần này vẫn không vượt max_size
-        if len(current) + len(item) <= max_size:
-            current += item  # Ghép vào chunk đang build
-        else:
+    glue_len = len(glue)
+    current = []
+    current_len = 0
+
+    def split_part(rest):
+        # Chia phần dài (kèm ký tự nối) thành nhiều mảnh, mỗi mảnh <= max_size
+        item = rest + glue
+        return [item[i:i + max_size].strip() for i in range(0, len(item), max_size)]
+
+    def pack(parts):
+        """Ghép các phần hoàn chỉnh (đã strip, khác rỗng) vào chunk đang build. Trả về các chunk đã đầy."""
+        nonlocal current, current_len
+        done = []
+        chunk, chunk_len = current, current_len
+        for p in parts:
+            item_len = len(p) + glue_len
+            # ----- TRƯỜNG HỢP 1: Phần hiện tại QUÁ DÀI (> max_size) -----
+            if item_len > max_size:
+                if chunk:
+                    done.append(glue.join(chunk))
+                    chunk, chunk_len = [], 0
+                done.extend(split_part(p))
+            # ----- TRƯỜNG HỢP 2: Có thể GHÉP vào chunk hiện tại -----
+            elif chunk_len + item_len <= max_size:
+                chunk.append(p)
+                chunk_len += item_len
             # ----- TRƯỜNG HỢP 3: Ghép sẽ VƯỢT max_size -----
-            # Lưu chunk hiện tại và bắt đầu chunk mới với phần này
-            chunks.append(current.strip())
-            current = item
+            else:
+                done.append(glue.join(chunk))
+                chunk, chunk_len = [p], item_len
+        current, current_len = chunk, chunk_len
+        return done
+
+    def flush():
+        nonlocal current, current_len
+        done = [glue.join(current)] if current else []
+        current, current_len = [], 0
+        return done
+
+    # ==========================================================
+    # TÁCH ĐOẠN HOẶC CÂU TỪ LUỒNG VĂN BẢN
+    # ==========================================================
+    # pending: câu/đoạn dở dang (chưa gặp dấu kết thúc), đã bỏ khoảng trắng đầu.
+    # Khi phần dở dang chắc chắn dài hơn max_size, các mảnh đầu của nó được
+    # trả ra sớm (splitting=True) để bộ nhớ không tăng theo độ dài phần đó.
+    pending = []
+    pending_len = 0
+    splitting = False
+    started = False
+    # Chế độ sentence: đã gặp dấu kết câu nào chưa (chưa gặp thì có thể rơi vào fallback)
+    has_sentence = False
+    # Có được trả sớm các mảnh của phần dở dang không
+    # (sentence: chỉ khi chưa có câu nào, vì phần đuôi không có dấu kết câu sẽ bị bỏ)
+    early_split = True
+
+    def take_pending(extra=""):
+        nonlocal pending, pending_len
+        text = "".join(pending) + extra
+        pending = []
+        pending_len = 0
+        return text
+
+    def emit_early():
+        nonlocal splitting, early_split, pending_len
+        done = []
+        text = take_pending()
+        # Chế độ paragraph: khoảng trắng cuối dòng sẽ bị strip nên không tính
+        available = len(text.rstrip()) if paragraph else len(text)
+        while available >= max_size:
+            cut = text[:max_size].strip()
+            if not cut and not paragraph:
+                # Mảnh rỗng: sentence giữ lại, fallback bỏ đi -> chờ biết chắc mới trả
+                early_split = False
+                break
+            if not splitting:
+                done.extend(flush())
+                splitting = True
+            done.append(cut)
+            text = text[max_size:]
+            available -= max_size
+        if text:
+            pending.append(text)
+            pending_len = len(text)
+        return done
+
+    def finish_part(text):
+        nonlocal splitting
+        if splitting:
+            # Phần đã được chia sớm: chia tiếp từ vị trí cắt trước đó
+            splitting = False
+            return split_part(text.rstrip())
+        p = text.strip()
+        return pack((p,)) if p else []
+
+    for piece in _iter_pieces(pieces):
+        if not started:
+            piece = piece.lstrip()
+            if not piece:
+                continue
+            started = True
+
+        if paragraph:
+            lines = piece.split("\n")
+            tail = lines.pop()
+            if lines:
+                yield from finish_part(take_pending(lines[0]))
+                yield from pack([p for p in map(str.strip, lines[1:]) if p])
+        else:
+            # Vị trí ngay sau dấu kết câu cuối cùng trong mảnh
+            end = max(piece.rfind("."), piece.rfind("!"), piece.rfind("?")) + 1
+            tail = piece[end:]
+            if end:
+                pos = _SENTENCE_END.search(piece).end()
+                yield from finish_part(take_pending(piece[:pos]))
+                has_sentence = True
+                yield from pack([p for p in map(str.strip, _SENTENCE.findall(piece, pos, end)) if p])
+
+        if not pending and not splitting:
+            tail = tail.lstrip()
+        if tail:
+            pending.append(tail)
+            pending_len += len(tail)
+
+        if pending_len >= max_size and early_split and (paragraph or not has_sentence):
+            yield from emit_early()
+
+    rest = take_pending()
+    if paragraph:
+        yield from finish_part(rest)
+    elif not has_sentence:
+        # Fallback: không có câu nào, chia theo max_size (bỏ mảnh rỗng)
+        for start in range(0, len(rest), max_size):
+            cut = rest[start:start + max_size].strip()
+            if cut:
+                yield cut
+        return
+    # Chế độ sentence: phần cuối không có dấu kết câu bị bỏ qua (giống chunk_text trước đây)
 
     # ==========================================================
     # LƯU CHUNK CUỐI CÙNG (nếu còn dữ liệu trong buffer)
     # ==========================================================
-    if current:
-        chunks.append(current.strip())
+    yield from flush()
+
+
+# ==========================================================
+# TÁCH CÂU (có xử lý tiếng Việt) VÀ ĐẾM TOKEN
+# ==========================================================
+
+# Từ viết tắt thường gặp, dấu chấm sau chúng không kết thúc câu (so khớp không phân biệt hoa thường)
+_ABBREVIATIONS = frozenset({
+    "tp", "q", "p", "tx", "tt", "h", "ths", "ts", "pgs", "gs", "bs", "ks", "cn", "ls", "đ/c", "th.s",
+    "nxb", "tr", "st", "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "no", "vs", "fig", "e.g", "i.e",
+})
+# Viết tắt có thể đứng cuối câu: chỉ kết thúc câu nếu sau đó là chữ hoa
+_TRAILING_ABBREVIATIONS = frozenset({"v.v", "etc", "vv"})
+
+# Ứng viên ranh giới câu: dãy . ! ? … (có thể kèm dấu đóng ngoặc/nháy) trước khoảng trắng, hoặc một dòng trống.
+# Bắt đầu bằng một tập ký tự để re quét nhanh tới ứng viên
+_BOUNDARY = re.compile(r'[.!?…\n](?:(?<=\n)[ \t\r\f\v]*\n|(?<!\n)[.!?…]*["\'”’»)\]]*(?=\s))')
+_TRAILING_MARKS = ".!?…\"'”’»)] \t\r\n\f\v"
+_WORD_BEFORE = re.compile(r'[\w./]+')
+_NEXT_CHAR = re.compile(r'\s*(\S)')
+
+# Câu dở dang dài hơn ngưỡng này bị cắt tại khoảng trắng gần nhất (giữ bộ nhớ có giới hạn)
+_MAX_SENTENCE_CHARS = 20000
+
+def _is_boundary(text: str, mark_start: int, mark: str, next_char: str) -> bool:
+    """Quyết định dấu chấm / dấu ba chấm tại mark_start có thực sự kết thúc câu (next_char: ký tự kế tiếp)."""
+    next_upper = next_char.isupper() or not next_char.isalpha()
+    if mark[0] == "…" or mark.startswith(".."):
+        # Dấu ba chấm giữa câu ("chờ... rồi đi") không kết thúc câu
+        return next_upper
+
+    # Từ đứng ngay trước dấu chấm: so khớp trên chuỗi đảo ngược để không phải thử từng vị trí
+    word = _WORD_BEFORE.match(text[max(0, mark_start - 32):mark_start][::-1])
+    if word is None:
+        return True
+    word = word.group()[::-1].lower().rstrip(".")
+    if word in _ABBREVIATIONS:
+        return False
+    if word in _TRAILING_ABBREVIATIONS:
+        return next_upper
+    # Chữ cái viết tắt tên người: "Nguyễn V. An"
+    if len(word) == 1 and text[mark_start - 1].isupper():
+        return False
+    return True
+
+def split_sentences_iter(pieces):
+    """
+    Tách luồng văn bản thành các câu (đã strip, khác rỗng), có xử lý:
+    - Viết tắt (TP., ThS., PGS., v.v. ...), chữ cái đầu tên người
+    - Số thập phân / phân cách nghìn (3.14, 1.000.000): dấu chấm không có khoảng trắng phía sau
+    - Dấu ba chấm (... hoặc …): chỉ kết thúc câu khi câu sau bắt đầu bằng chữ hoa
+    - Dòng trống luôn kết thúc câu; phần cuối không có dấu kết câu vẫn được giữ lại
+    """
+    next_char_at = _NEXT_CHAR.match
+    buf = ""
+    scan_from = 0
+    for piece in _iter_pieces(pieces):
+        buf += piece
+        start = 0
+        deferred = None
+        for match in _BOUNDARY.finditer(buf, scan_from):
+            mark = match.group()
+            end = match.end()
+            # Dòng trống, ! và ? luôn kết thúc câu
+            if mark[0] not in "\n!?":
+                next_char = next_char_at(buf, end)
+                if next_char is None:
+                    # Chưa thấy ký tự tiếp theo: chờ mảnh sau rồi mới quyết định
+                    deferred = match.start()
+                    break
+                if not _is_boundary(buf, match.start(), mark, next_char.group(1)):
+                    continue
+            sentence = buf[start:end].strip()
+            if sentence:
+                yield sentence
+            start = end
+
+        if len(buf) - start > _MAX_SENTENCE_CHARS:
+            cut = buf.rfind(" ", start, len(buf) - 1)
+            if cut <= start:
+                cut = len(buf)
+            sentence = buf[start:cut].strip()
+            if sentence:
+                yield sentence
+            start = cut
+
+        buf = buf[start:]
+        # Lần sau quét lại từ ứng viên đang chờ, hoặc từ đầu dãy dấu câu / khoảng trắng ở cuối
+        # (ứng viên có thể nối sang mảnh sau: "..", dấu nháy, dòng trống)
+        scan_from = len(buf.rstrip(_TRAILING_MARKS))
+        if deferred is not None and deferred >= start:
+            scan_from = min(scan_from, deferred - start)
+
+    sentence = buf.strip()
+    if sentence:
+        yield sentence
+
+def split_sentences(text: str) -> list:
+    """Tách văn bản thành danh sách câu (xem split_sentences_iter)."""
+    return list(split_sentences_iter(text or ""))
+
+# Token xấp xỉ: mỗi từ / số / dấu câu; từ dài được tính thêm 1 token cho mỗi CHARS_PER_TOKEN ký tự
+# (gần với BPE cho tiếng Việt, nơi phần lớn âm tiết ngắn), không cần tải tokenizer thật
+CHARS_PER_TOKEN = 4
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+_LONG_WORD = re.compile(r'\w{%d,}' % (CHARS_PER_TOKEN + 1))
+
+def count_tokens(text: str) -> int:
+    """Ước lượng số token của văn bản (xấp xỉ nhanh, không dùng tokenizer của model)."""
+    extra = sum((len(word) - 1) // CHARS_PER_TOKEN for word in _LONG_WORD.findall(text))
+    return len(_TOKEN.findall(text)) + extra
+
+def _token_units(text: str, offset: int, budget: int) -> list:
+    """
+    Danh sách (start, end, cost) các token của text (vị trí cộng thêm offset).
+    Token dài hơn ngân sách (vd: chuỗi base64) được cắt thành nhiều đơn vị theo số ký tự.
+    """
+    step = budget * CHARS_PER_TOKEN
+    units = []
+    for match in _TOKEN.finditer(text):
+        start, end = match.span()
+        length = end - start
+        if length <= CHARS_PER_TOKEN:
+            units.append((offset + start, offset + end, 1))
+        elif length <= step:
+            units.append((offset + start, offset + end, 1 + (length - 1) // CHARS_PER_TOKEN))
+        else:
+            for cut in range(start, end, step):
+                piece_len = min(step, end - cut)
+                units.append((offset + cut, offset + cut + piece_len, 1 + (piece_len - 1) // CHARS_PER_TOKEN))
+    return units
+
+def chunk_tokens_iter(pieces, mode="token", max_tokens=None, overlap_tokens=None):
+    """
+    Chia văn bản thành chunks theo ngân sách token, có phần gối đầu (overlap) giữa hai chunk liền nhau.
+    mode='token': ghép nguyên câu cho tới max_tokens; overlap là các câu cuối của chunk trước
+                  (tổng <= overlap_tokens). Câu dài hơn ngân sách được chia theo token.
+    mode='sliding': cửa sổ trượt max_tokens token, bước max_tokens - overlap_tokens, không theo ranh giới câu.
+    Các câu được nối bằng một dấu cách; nội dung trong câu giữ nguyên.
+    """
+    budget = max_tokens or CHUNK_TOKEN_BUDGET
+    overlap = CHUNK_TOKEN_OVERLAP if overlap_tokens is None else overlap_tokens
+    if budget < 1:
+        raise ValueError("max_tokens phải >= 1")
+    if not 0 <= overlap < budget:
+        raise ValueError("overlap_tokens phải trong khoảng [0, max_tokens)")
+
+    sentences = split_sentences_iter(pieces)
+    if mode == "sliding":
+        yield from _sliding_windows(sentences, budget, overlap)
+        return
+
+    # buf chứa văn bản từ đầu cửa sổ; vị trí trong units là vị trí tuyệt đối (buf bắt đầu tại base)
+    buf = ""
+    base = 0
+    window = deque()   # các đơn vị (start, end, cost) trong chunk đang build
+    window_cost = 0
+    fresh = False      # cửa sổ có đơn vị mới (chưa nằm trong chunk nào) hay không
+
+    for sentence in sentences:
+        if buf:
+            buf += " "
+        sentence_start = base + len(buf)
+        buf += sentence
+
+        cost = count_tokens(sentence)
+        if cost <= budget:
+            units = [(sentence_start, sentence_start + len(sentence), cost)]
+        else:
+            # Câu dài hơn ngân sách: bắt đầu chunk mới (None) rồi chia câu theo token
+            units = [None] + _token_units(sentence, sentence_start, budget)
+
+        for unit in units:
+            cost = budget + 1 if unit is None else unit[2]
+            if window and window_cost + cost > budget:
+                if fresh:
+                    yield buf[window[0][0] - base:window[-1][1] - base]
+                    fresh = False
+                # Giữ lại phần cuối làm overlap, đủ chỗ cho đơn vị mới
+                while window and (window_cost > overlap or (unit and window_cost + cost > budget)):
+                    window_cost -= window.popleft()[2]
+                keep_from = window[0][0] if window else (unit[0] if unit else sentence_start)
+                buf = buf[keep_from - base:]
+                base = keep_from
+            if unit is None:
+                continue
+            window.append(unit)
+            window_cost += cost
+            fresh = True
+
+    if window and fresh:
+        yield buf[window[0][0] - base:window[-1][1] - base]
+
+def _sliding_windows(sentences, budget, overlap):
+    """
+    Cửa sổ trượt theo token. Dùng tổng tích lũy chi phí token (cum) và bisect để nhảy thẳng tới
+    ranh giới cửa sổ, không phải xử lý từng token trong Python.
+    """
+    buf = ""
+    base = 0
+    starts, ends = [], []
+    cum = [0]          # cum[k] = tổng chi phí của các token [0, k) trong buffer
+    first = 0          # token đầu của cửa sổ hiện tại
+    emitted = 0        # các token [0, emitted) đã nằm trong một chunk
+
+    for sentence in sentences:
+        if buf:
+            buf += " "
+        offset = base + len(buf)
+        buf += sentence
+
+        spans = [match.span() for match in _TOKEN.finditer(sentence)]
+        step = budget * CHARS_PER_TOKEN
+        if len(sentence) > step and max(end - start for start, end in spans) > step:
+            units = _token_units(sentence, offset, budget)
+            spans = [(start - offset, end - offset) for start, end, _ in units]
+            costs = [cost for _, _, cost in units]
+        else:
+            costs = [1 + (end - start - 1) // CHARS_PER_TOKEN for start, end in spans]
+        starts.extend([start + offset for start, _ in spans])
+        ends.extend([end + offset for _, end in spans])
+        cum.extend(accumulate(costs, initial=cum[-1]))
+        cum.pop(len(cum) - len(costs) - 1)
+
+        # Trả ra mọi cửa sổ đã đầy (token kế tiếp không còn vừa ngân sách)
+        while cum[-1] - cum[first] > budget:
+            last = bisect_right(cum, cum[first] + budget) - 1   # cửa sổ gồm token [first, last)
+            yield buf[starts[first] - base:ends[last - 1] - base]
+            emitted = last
+            # Cửa sổ sau: giữ phần cuối <= overlap và đủ chỗ cho token last
+            first = max(bisect_left(cum, cum[last] - overlap), bisect_left(cum, cum[last + 1] - budget))
+
+        # Bỏ các token đã trượt qua để bộ nhớ không tăng theo độ dài văn bản
+        if first > 4096:
+            del starts[:first], ends[:first], cum[:first]
+            emitted -= first
+            first = 0
+            keep_from = starts[0] if starts else base + len(buf)
+            buf = buf[keep_from - base:]
+            base = keep_from
+
+    if len(starts) > emitted:
+        yield buf[starts[first] - base:ends[-1] - base]
+
+# ==========================================================
+# VỊ TRÍ CỦA CHUNK TRONG VĂN BẢN GỐC
+# ==========================================================
+# Số ký tự đầu chunk dùng để dò vị trí (đủ dài để không khớp nhầm)
+_LOCATE_PREFIX = 80
+
+def _prefix_pattern(chunk: str):
+    """Regex khớp phần đầu chunk trong văn bản gốc, cho phép khoảng trắng tùy ý giữa các từ."""
+    words = chunk[:_LOCATE_PREFIX].split()
+    if not words:
+        return None
+    return re.compile(r'\s*'.join(re.escape(word) for word in words))
+
+def chunk_text_offsets_iter(pieces, mode="sentence", max_size=1000, max_tokens=None, overlap_tokens=None):
+    """
+    Như chunk_text_iter nhưng yield (offset, chunk) với offset là vị trí ký tự bắt đầu của chunk
+    trong văn bản gốc (None nếu không tìm thấy).
+    Chunk có thể khác văn bản gốc ở khoảng trắng giữa các câu/đoạn (được nối bằng " " hoặc "\n"),
+    nên phần đầu chunk được so khớp với khoảng trắng tùy ý. Chunk sau luôn bắt đầu sau chunk trước
+    (kể cả sliding), nên chỉ cần giữ văn bản từ vị trí chunk trước trở đi: bộ nhớ không phụ thuộc
+    độ dài văn bản.
+    """
+    pending = []
+
+    def record():
+        for piece in _iter_pieces(pieces):
+            pending.append(piece)
+            yield piece
 
-    return chunks
+    window = ""   # Văn bản gốc từ vị trí base
+    base = 0
+    pos = 0       # Chunk kế tiếp bắt đầu từ vị trí này trở đi
+    for chunk in chunk_text_iter(record(), mode=mode, max_size=max_size,
+                                 max_tokens=max_tokens, overlap_tokens=overlap_tokens):
+        if pending:
+            window += "".join(pending)
+            pending.clear()
+        pattern = _prefix_pattern(chunk)
+        match = pattern.search(window, pos - base) if pattern else None
+        if match is None:
+            yield None, chunk
+            continue
+        yield base + match.start(), chunk
+        pos = base + match.start() + 1
+        # Bỏ phần đã đi qua khi nó chiếm quá nửa window (chi phí cắt chuỗi được chia đều)
+        if pos - base > len(window) // 2:
+            window = window[pos - base:]
+            base = pos
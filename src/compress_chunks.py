@@ -0,0 +1,54 @@
+"""
+Nén lại nội dung chunks đã lưu trong database theo lô (xem CHUNK_COMPRESSION trong chunk_codec.py).
+
+Chạy:
+    python src/compress_chunks.py --codec zlib --train-dict
+    python src/compress_chunks.py --codec none          # giải nén về text thường
+
+Sau khi nén lại, đặt CHUNK_COMPRESSION cùng codec để chunks ghi mới cũng được nén.
+Chỉ áp dụng với SQLite (trên PostgreSQL content phải là text thường cho index full-text).
+"""
+import argparse
+import chunk_codec
+import database
+
+def parse_args(argv=None):
+    """Đọc tham số dòng lệnh."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--codec", default=chunk_codec.CHUNK_COMPRESSION, choices=chunk_codec.CHUNK_COMPRESSION_CODECS,
+                        help=f"Codec đích (mặc định CHUNK_COMPRESSION: {chunk_codec.CHUNK_COMPRESSION})")
+    parser.add_argument("--train-dict", action="store_true",
+                        help="Train dictionary mới từ các chunk hiện có trước khi nén lại")
+    parser.add_argument("--samples", type=int, default=2000, help="Số chunk mẫu để train dictionary")
+    parser.add_argument("--dict-size", type=int, default=chunk_codec.CHUNK_DICT_SIZE,
+                        help=f"Kích thước dictionary (byte, mặc định {chunk_codec.CHUNK_DICT_SIZE})")
+    parser.add_argument("--batch-size", type=int, default=database.CHUNK_BATCH_SIZE,
+                        help=f"Số chunks mỗi lô / transaction (mặc định {database.CHUNK_BATCH_SIZE})")
+    return parser.parse_args(argv)
+
+def _format_stats(stats):
+    ratio = f"x{stats['ratio']:.2f}" if stats['ratio'] else "-"
+    return (f"{stats['chunks']} chunks ({stats['compressed_chunks']} nén), "
+            f"{stats['raw_bytes']:,} byte text -> {stats['stored_bytes']:,} byte lưu trữ ({ratio})")
+
+def main(argv=None):
+    args = parse_args(argv)
+    if database.engine.dialect.name != 'sqlite':
+        raise SystemExit(f"Nén chunks chỉ áp dụng với SQLite, không áp dụng với {database.engine.dialect.name}.")
+    database.init_database()
+    print(f"Trước: {_format_stats(database.chunk_storage_stats())}")
+
+    if args.train_dict and args.codec != 'none':
+        dictionary_id = database.train_chunk_dictionary(args.codec, args.samples, args.dict_size)
+        print(f"Dictionary {args.codec} mới: id {dictionary_id}" if dictionary_id else "Chưa có chunk nào để train dictionary.")
+
+    def progress(stats):
+        print(f"  đã duyệt {stats['rows']} chunks, ghi lại {stats['updated']}", flush=True)
+
+    result = database.recompress_chunks(args.codec, args.batch_size, progress=progress)
+    after = database.chunk_storage_stats()
+    print(f"Sau: {_format_stats(after)}")
+    return {**result, 'storage': after}
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,23 @@
+import io
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey
+import re
+import csv
+import json
+import base64
+import sqlite3
+import logging
+from sqlalchemy import (
+    create_engine, event, inspect, text, select, update, bindparam, literal, func, tuple_, or_, exists, Column, Index,
+    Integer, BigInteger, Boolean, String, Text, LargeBinary, DateTime, ForeignKey, UniqueConstraint
+)
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 from datetime import datetime
 from dotenv import load_dotenv
+import chunk_codec
 
 load_dotenv()
 
@@ -15,15 +30,25 @@ class Document(Base):
     __tablename__ = 'documents'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
+    # Tên document duy nhất (unique index uq_documents_file_name), được cấp khi thêm document (xem _add_document)
     file_name = Column(String, nullable=False)
     file_path = Column(String, nullable=False)
     file_type = Column(String, nullable=False)
     file_size = Column(Integer, nullable=True)
     upload_date = Column(DateTime, default=datetime.utcnow)
     chunk_count = Column(Integer, default=0)
+    content_hash = Column(String(64), nullable=True, index=True)  # SHA-256 nội dung file gốc
+    chunk_mode = Column(String, nullable=True)
     
     chunks = relationship("Chunk", back_populates="document", cascade="all, delete-orphan")
 
+    # Phục vụ phân trang keyset theo (upload_date, id)
+    # Tên duy nhất là unique index (thêm được vào bảng SQLite đã có, khác với UNIQUE constraint)
+    __table_args__ = (
+        Index('ix_documents_upload_date_id', 'upload_date', 'id'),
+        Index('uq_documents_file_name', 'file_name', unique=True),
+    )
+
 class Chunk(Base):
     __tablename__ = 'chunks'
 
@@ -32,16 +57,373 @@ class Chunk(Base):
     chunk_index = Column(Integer, nullable=False)
     content = Column(Text, nullable=False)
     char_count = Column(Integer, nullable=False)
+    page_number = Column(Integer, nullable=True)  # Trang chứa phần đầu chunk (chỉ với PDF)
+    # Bộ chunks chứa chunk này: NULL = bộ chính (theo documents.chunk_mode, gồm mọi dữ liệu cũ),
+    # khác NULL = bộ chunks bổ sung theo chunk mode khác của cùng document (xem replace_chunk_sets)
+    chunk_mode = Column(String, nullable=True)
+    # Nội dung đã nén (xem chunk_codec.py): content_codec là codec + id dictionary (vd: 'zlib:3'),
+    # khi đó content = '' và nội dung thật nằm trong content_z. NULL = content là text thường.
+    content_z = Column(LargeBinary, nullable=True)
+    content_codec = Column(String, nullable=True)
     
     document = relationship("Document", back_populates="chunks")
 
+    # Truy vấn chunks của một bộ chunks theo khoảng chunk_index
+    __table_args__ = (Index('ix_chunks_document_id_mode_chunk_index', 'document_id', 'chunk_mode', 'chunk_index'),)
+
+class ChunkDictionary(Base):
+    """
+    Dictionary nén dùng chung cho chunks của corpus (train từ các chunk mẫu, xem compress_chunks.py).
+    Không bao giờ sửa / xóa dictionary đang được chunk tham chiếu: dictionary mới luôn là dòng mới.
+    """
+    __tablename__ = 'chunk_dictionaries'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    codec = Column(String, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+    sample_count = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+# Trạng thái của job xử lý nền
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+class Job(Base):
+    __tablename__ = 'jobs'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    file_name = Column(String, nullable=False)  # Tên file gốc khi upload
+    document_name = Column(String, nullable=True)  # Tên gốc của document sẽ tạo (hậu tố (n) cấp khi lưu)
+    file_path = Column(String, nullable=False)  # Đường dẫn file đã lưu trên đĩa
+    chunk_mode = Column(String, nullable=False, default="sentence")
+    content_hash = Column(String(64), nullable=True)
+    dedup_policy = Column(String, nullable=True)
+    status = Column(String, nullable=False, default=JOB_PENDING, index=True)
+    document_id = Column(Integer, ForeignKey('documents.id', ondelete='SET NULL'), nullable=True)
+    error = Column(Text, nullable=True)
+    attempts = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class FileNameCounter(Base):
+    """
+    Bộ đếm hậu tố (n) đã cấp cho mỗi tên file gốc, giúp việc cấp tên document chỉ tốn O(1) truy vấn.
+    Khóa chính trên base_name đảm bảo hai request đồng thời không cùng khởi tạo bộ đếm.
+    """
+    __tablename__ = 'file_name_counters'
+
+    base_name = Column(String, primary_key=True)
+    last_suffix = Column(Integer, nullable=False, default=0)  # 0 = tên gốc, n = tên(n)
+
+class SourceFile(Base):
+    """
+    Manifest của các file nguồn đã ingest từ thư mục (dùng cho chế độ sync/watch).
+    Nếu size + mtime không đổi thì coi như file không đổi, không cần đọc lại.
+    """
+    __tablename__ = 'source_files'
+    __table_args__ = (UniqueConstraint('path', 'chunk_mode', name='uq_source_files_path_mode'),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    path = Column(String, nullable=False)  # Đường dẫn tuyệt đối
+    chunk_mode = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    mtime_ns = Column(BigInteger, nullable=False)
+    content_hash = Column(String(64), nullable=True)
+    document_id = Column(Integer, ForeignKey('documents.id', ondelete='SET NULL'), nullable=True)
+    # True: document do sync tạo khi xử lý file này (được retire khi file biến mất / bị thay thế).
+    # False / NULL (dòng cũ): document đã có, file chỉ trùng nội dung (skip / link) -> không bao giờ bị retire
+    owned = Column(Boolean, nullable=True, default=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+# Cấu hình text search của PostgreSQL cho tìm kiếm full-text ('simple': không stemming, phù hợp tiếng Việt)
+FTS_CONFIG = os.getenv("FTS_CONFIG", "simple")
+# Kiểm tra ngay khi nạp module: DDL của cột tsvector không nhận tham số nên phải chèn tên cấu hình vào SQL
+if not FTS_CONFIG.isidentifier():
+    raise ValueError(f"FTS_CONFIG không hợp lệ: {FTS_CONFIG}")
+
+# Nén nội dung chunks (CHUNK_COMPRESSION, xem chunk_codec.py). Chỉ áp dụng với SQLite: index full-text của
+# PostgreSQL là cột tsvector GENERATED từ chunks.content nên content phải là text thường; trên PostgreSQL
+# CHUNK_COMPRESSION bị bỏ qua (kèm cảnh báo) và compress_chunks.py không chạy.
+# Cache dictionary theo id (dictionary không bao giờ bị sửa, chỉ thêm mới)
+_chunk_dictionaries = {}
+_compression_warned = set()
+
+def _dictionary_data(dictionary_id, fetch):
+    data = _chunk_dictionaries.get(dictionary_id)
+    if data is None:
+        data = _chunk_dictionaries[dictionary_id] = fetch(dictionary_id)
+    return data
+
+def _decode_content(content, content_z, content_codec, fetch):
+    """Nội dung text của chunk; fetch(id) -> bytes: đọc dictionary khi chưa có trong cache."""
+    if not content_codec:
+        return content
+    codec, dictionary_id = chunk_codec.parse_tag(content_codec)
+    dictionary = _dictionary_data(dictionary_id, fetch) if dictionary_id is not None else None
+    return chunk_codec.decompress(content_z, codec, dictionary)
+
+def _session_fetch(session):
+    return lambda dictionary_id: session.execute(
+        select(ChunkDictionary.data).where(ChunkDictionary.id == dictionary_id)
+    ).scalar_one()
+
+def _sqlite_chunk_text(dbapi_connection, content, content_z, content_codec):
+    fetch = lambda dictionary_id: dbapi_connection.execute(
+        "SELECT data FROM chunk_dictionaries WHERE id = ?", (dictionary_id,)
+    ).fetchone()[0]
+    return _decode_content(content, content_z, content_codec, fetch)
+
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    """Hàm SQL chunk_text(content, content_z, content_codec) cho view chunks_text / index FTS5."""
+    raw = dbapi_connection
+    if not isinstance(raw, sqlite3.Connection):
+        # aiosqlite: hàm chạy trên thread của aiosqlite, đọc dictionary thẳng từ sqlite3.Connection bên dưới
+        # (như dialect aiosqlite của SQLAlchemy), không qua adapter async
+        raw = getattr(getattr(dbapi_connection, 'driver_connection', None), '_conn', None)
+        if not isinstance(raw, sqlite3.Connection):
+            return
+    dbapi_connection.create_function("chunk_text", 3, lambda *args: _sqlite_chunk_text(raw, *args), deterministic=True)
+
+# Đăng ký cho mọi engine (kể cả engine tạo ngoài module này, vd: trong test / benchmark)
+event.listen(Engine, "connect", _register_sqlite_functions)
+
+def _load_chunk(chunk, context):
+    # Chunk đọc qua ORM (get_chunks, API) luôn có content là text đã giải nén
+    if chunk.content_codec:
+        fetch = _session_fetch(context.session)
+        set_committed_value(chunk, 'content', _decode_content(chunk.content, chunk.content_z, chunk.content_codec, fetch))
+
+event.listen(Chunk, "load", _load_chunk)
+
+def _chunk_encoder(session, codec: str = None):
+    """
+    Hàm nén dict chunk (content -> content_z + content_codec) theo codec (mặc định CHUNK_COMPRESSION),
+    dùng dictionary mới nhất của codec nếu có. Trả về None nếu không nén (codec 'none' / không phải SQLite).
+    Chunk ngắn hơn CHUNK_COMPRESSION_MIN_BYTES, hoặc nén không nhỏ hơn, được giữ là text thường.
+    """
+    codec = codec or chunk_codec.CHUNK_COMPRESSION
+    chunk_codec.check_codec(codec)
+    if codec == 'none':
+        return None
+    dialect = session.get_bind().dialect.name
+    if dialect != 'sqlite':
+        if dialect not in _compression_warned:
+            _compression_warned.add(dialect)
+            logging.warning(f"CHUNK_COMPRESSION={codec} không áp dụng với {dialect}, chunks được lưu dạng text thường.")
+        return None
+
+    latest = session.execute(
+        select(ChunkDictionary.id, ChunkDictionary.data)
+        .where(ChunkDictionary.codec == codec).order_by(ChunkDictionary.id.desc()).limit(1)
+    ).first()
+    dictionary = latest.data if latest else None
+    tag = chunk_codec.codec_tag(codec, latest.id if latest else None)
+
+    def encode(row):
+        raw_size = len(row['content'].encode('utf-8'))
+        if raw_size >= chunk_codec.CHUNK_COMPRESSION_MIN_BYTES:
+            data = chunk_codec.compress(row['content'], codec, dictionary)
+            if len(data) < raw_size:
+                row.update(content='', content_z=data, content_codec=tag)
+        return row
+    return encode
+
+# SQLite: bảng FTS5 "external content" trỏ tới view chunks_text (nội dung chunks đã giải nén bằng hàm
+# chunk_text), được cập nhật bằng trigger mỗi khi chunks được thêm / xóa / sửa
+_SQLITE_FTS_DDL = [
+    "CREATE VIEW IF NOT EXISTS chunks_text AS "
+    "SELECT id, chunk_text(content, content_z, content_codec) AS content FROM chunks",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5("
+    "content, content='chunks_text', content_rowid='id', tokenize='unicode61 remove_diacritics 0')",
+    "CREATE TRIGGER IF NOT EXISTS chunks_fts_ai AFTER INSERT ON chunks BEGIN "
+    "INSERT INTO chunks_fts(rowid, content) VALUES (new.id, chunk_text(new.content, new.content_z, new.content_codec)); END",
+    "CREATE TRIGGER IF NOT EXISTS chunks_fts_ad AFTER DELETE ON chunks BEGIN "
+    "INSERT INTO chunks_fts(chunks_fts, rowid, content) "
+    "VALUES ('delete', old.id, chunk_text(old.content, old.content_z, old.content_codec)); END",
+    "CREATE TRIGGER IF NOT EXISTS chunks_fts_au AFTER UPDATE OF content, content_z, content_codec ON chunks BEGIN "
+    "INSERT INTO chunks_fts(chunks_fts, rowid, content) "
+    "VALUES ('delete', old.id, chunk_text(old.content, old.content_z, old.content_codec)); "
+    "INSERT INTO chunks_fts(rowid, content) VALUES (new.id, chunk_text(new.content, new.content_z, new.content_codec)); END",
+]
+_SQLITE_FTS_DROP = [
+    "DROP TRIGGER IF EXISTS chunks_fts_ai",
+    "DROP TRIGGER IF EXISTS chunks_fts_ad",
+    "DROP TRIGGER IF EXISTS chunks_fts_au",
+    "DROP TABLE IF EXISTS chunks_fts",
+    "DROP VIEW IF EXISTS chunks_text",
+]
+
+def _setup_fulltext(connection):
+    """
+    Tạo index full-text cho nội dung chunks (idempotent):
+    - PostgreSQL: cột tsvector GENERATED (tự cập nhật khi INSERT/COPY) + GIN index
+    - SQLite: view chunks_text + bảng FTS5 + trigger
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text(
+            "ALTER TABLE chunks ADD COLUMN IF NOT EXISTS content_tsv tsvector "
+            f"GENERATED ALWAYS AS (to_tsvector('{FTS_CONFIG}'::regconfig, content)) STORED"
+        ))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_chunks_content_tsv ON chunks USING GIN (content_tsv)"))
+    elif dialect == 'sqlite':
+        existing = connection.execute(text("SELECT sql FROM sqlite_master WHERE name = 'chunks_fts'")).scalar()
+        if existing and 'chunks_text' not in existing:
+            # Bảng FTS5 của phiên bản cũ đọc thẳng chunks.content (chưa biết chunk nén): tạo lại
+            for statement in _SQLITE_FTS_DROP:
+                connection.execute(text(statement))
+            existing = None
+        for statement in _SQLITE_FTS_DDL:
+            connection.execute(text(statement))
+        if not existing:
+            # Index lại các chunks đã có trước khi tạo bảng FTS
+            connection.execute(text("INSERT INTO chunks_fts(chunks_fts) VALUES ('rebuild')"))
+
+def _drop_fulltext(connection):
+    """Xóa bảng FTS5 + view khi bảng chunks bị xóa (SQLite). PostgreSQL: cột tsvector bị xóa cùng bảng."""
+    if connection.dialect.name == 'sqlite':
+        for statement in _SQLITE_FTS_DROP:
+            connection.execute(text(statement))
+
+# Tìm kiếm tên file theo trigram: ngưỡng độ tương đồng tối thiểu (giống mặc định của pg_trgm)
+NAME_SIMILARITY_THRESHOLD = 0.3
+
+# SQLite: bảng FTS5 với tokenizer trigram (tương đương pg_trgm) trên documents.file_name
+_SQLITE_NAME_INDEX_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS documents_name_fts USING fts5("
+    "file_name, content='documents', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS documents_name_fts_ai AFTER INSERT ON documents BEGIN "
+    "INSERT INTO documents_name_fts(rowid, file_name) VALUES (new.id, new.file_name); END",
+    "CREATE TRIGGER IF NOT EXISTS documents_name_fts_ad AFTER DELETE ON documents BEGIN "
+    "INSERT INTO documents_name_fts(documents_name_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name); END",
+    "CREATE TRIGGER IF NOT EXISTS documents_name_fts_au AFTER UPDATE OF file_name ON documents BEGIN "
+    "INSERT INTO documents_name_fts(documents_name_fts, rowid, file_name) VALUES ('delete', old.id, old.file_name); "
+    "INSERT INTO documents_name_fts(rowid, file_name) VALUES (new.id, new.file_name); END",
+]
+
+def _setup_name_index(connection):
+    """
+    Tạo index trigram cho tên file (idempotent) để tìm kiếm một phần không phải quét toàn bảng:
+    - PostgreSQL: extension pg_trgm + GIN index (dùng được cho ILIKE '%...%' và toán tử %)
+    - SQLite: bảng FTS5 tokenizer trigram + trigger
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_documents_file_name_trgm ON documents USING GIN (file_name gin_trgm_ops)"
+        ))
+    elif dialect == 'sqlite':
+        existed = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'documents_name_fts'")).first()
+        for statement in _SQLITE_NAME_INDEX_DDL:
+            connection.execute(text(statement))
+        if not existed:
+            connection.execute(text("INSERT INTO documents_name_fts(documents_name_fts) VALUES ('rebuild')"))
+
+def _drop_name_index(connection):
+    """Xóa bảng trigram của SQLite khi bảng documents bị xóa."""
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text("DROP TABLE IF EXISTS documents_name_fts"))
+
+event.listen(Document.__table__, "after_create", lambda target, connection, **kw: _setup_name_index(connection))
+event.listen(Document.__table__, "before_drop", lambda target, connection, **kw: _drop_name_index(connection))
+event.listen(Chunk.__table__, "after_create", lambda target, connection, **kw: _setup_fulltext(connection))
+event.listen(Chunk.__table__, "before_drop", lambda target, connection, **kw: _drop_fulltext(connection))
+# Bảng dictionary tạo lại (vd: database mới cùng URL) thì id cũ không còn ý nghĩa
+event.listen(ChunkDictionary.__table__, "after_create", lambda target, connection, **kw: _chunk_dictionaries.clear())
+
+# Số chunks ghi trong mỗi lượt executemany / COPY
+CHUNK_BATCH_SIZE = int(os.getenv("CHUNK_BATCH_SIZE", "1000"))
+# Số chunks đọc mỗi lượt từ server-side cursor khi stream chunks
+CHUNK_STREAM_BATCH_SIZE = int(os.getenv("CHUNK_STREAM_BATCH_SIZE", "500"))
+
+# Cấu hình connection pool của database server (áp dụng cho cả engine đồng bộ và async; SQLite bỏ qua).
+# Mỗi engine có pool riêng: số kết nối tối đa tới PostgreSQL là 2 * (DB_POOL_SIZE + DB_MAX_OVERFLOW).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Số giây chờ lấy kết nối khi pool đã dùng hết
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Kiểm tra kết nối trước khi lấy từ pool (bỏ kết nối đã bị server đóng)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# statement_timeout của PostgreSQL (ms, 0 = không giới hạn)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# URL cho engine async (mặc định suy từ DATABASE_URL: postgresql -> asyncpg, sqlite -> aiosqlite)
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+
+def _engine_options(url) -> dict:
+    """Tham số create_engine / create_async_engine theo cấu hình pool ở trên (SQLite: mặc định của SQLAlchemy)."""
+    if url.get_backend_name() == 'sqlite':
+        return {}
+    options = {'pool_pre_ping': DB_POOL_PRE_PING, 'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW,
+               'pool_timeout': DB_POOL_TIMEOUT}
+    if DB_STATEMENT_TIMEOUT_MS and url.get_backend_name() == 'postgresql':
+        if url.get_driver_name() == 'asyncpg':
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options['connect_args'] = {'options': f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
 # Engine và session factory toàn cục
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **_engine_options(make_url(DATABASE_URL)))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+def _upgrade_schema(bind):
+    """
+    Bổ sung các cột/index được thêm sau này vào bảng đã tồn tại
+    (create_all chỉ tạo bảng mới, không ALTER bảng cũ).
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(dialect=bind.dialect)
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}"))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+def _resolve_duplicate_names(bind):
+    """
+    Đổi tên các document trùng file_name của dữ liệu cũ (trước khi có unique index uq_documents_file_name):
+    document cũ nhất giữ tên, các document còn lại được cấp hậu tố (n) tiếp theo như document mới.
+    """
+    inspector = inspect(bind)
+    if not inspector.has_table('documents') or any(
+        index['name'] == 'uq_documents_file_name' for index in inspector.get_indexes('documents')
+    ):
+        return
+    session = sessionmaker(bind=bind, autoflush=False)()
+    try:
+        duplicated = session.query(Document.file_name).group_by(Document.file_name).having(func.count() > 1).all()
+        for (file_name,) in duplicated:
+            documents = session.query(Document).filter(Document.file_name == file_name).order_by(Document.id).all()
+            for document in documents[1:]:
+                document.file_name = _suffixed_name(file_name, _allocate_suffix(session, file_name, resync=True))
+                # flush để lần cấp tên sau thấy tên vừa đổi
+                session.flush()
+                logging.warning(f"Document {document.id} trùng tên {file_name}, đổi tên thành {document.file_name}")
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
 def init_database():
     """Tạo database và các bảng nếu chưa tồn tại."""
     Base.metadata.create_all(bind=engine)
+    # Phải chạy trước khi _upgrade_schema tạo unique index trên documents.file_name
+    _resolve_duplicate_names(engine)
+    _upgrade_schema(engine)
+    # Bảng chunks tạo từ phiên bản cũ chưa có index full-text
+    with engine.begin() as conn:
+        _setup_name_index(conn)
+        _setup_fulltext(conn)
     print("Khởi tạo database thành công.")
 
 def get_db_session():
@@ -56,21 +438,24 @@ def save_document(file_info: dict):
     """
     Lưu thông tin metadata của document.
     file_info: dict chứa các keys: file_name, file_path, file_type, file_size, chunk_count
+               (tùy chọn: content_hash, chunk_mode). file_name là tên gốc: nếu đã có document cùng tên thì
+               document được cấp tên có hậu tố (n) (xem _add_document), file_info['file_name'] được cập nhật
+               thành tên đã cấp.
     Trả về: id của document vừa tạo
     """
     session = SessionLocal()
     try:
-        new_doc = Document(
+        new_doc = _add_document(session, Document(
             file_name=file_info['file_name'],
             file_path=file_info['file_path'],
             file_type=file_info['file_type'],
             file_size=file_info.get('file_size'),
             chunk_count=file_info.get('chunk_count', 0),
+            content_hash=file_info.get('content_hash'),
+            chunk_mode=file_info.get('chunk_mode'),
             upload_date=datetime.utcnow()
-        )
-        session.add(new_doc)
+        ))
         session.commit()
-        session.refresh(new_doc)
         return new_doc.id
     except Exception as e:
         session.rollback()
@@ -78,77 +463,559 @@ def save_document(file_info: dict):
     finally:
         session.close()
 
-def save_chunks(document_id: int, chunks_data: list):
+def _copy_chunk_rows(session, rows: list):
+    """Ghi một lô chunks bằng COPY ... FROM STDIN (PostgreSQL + psycopg2), trong transaction hiện tại."""
+    buffer = io.StringIO()
+    # QUOTE_NONNUMERIC: chuỗi rỗng được quote nên COPY không hiểu nhầm thành NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+    for row in rows:
+        # page_number / chunk_mode None -> trường rỗng không quote, COPY hiểu là NULL
+        writer.writerow((row['document_id'], row['chunk_index'], row['content'], row['char_count'],
+                         row['page_number'], row['chunk_mode']))
+    buffer.seek(0)
+
+    dbapi_connection = session.connection().connection.dbapi_connection
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            "COPY chunks (document_id, chunk_index, content, char_count, page_number, chunk_mode) "
+            "FROM STDIN WITH (FORMAT csv)",
+            buffer
+        )
+
+def _insert_chunks(session, document_id: int, chunks_data, batch_size: int = None, chunk_mode: str = None) -> int:
+    """
+    Ghi chunks theo lô mà không tạo ORM object (không tốn identity map, không INSERT từng dòng):
+    - PostgreSQL (psycopg2): COPY ... FROM STDIN
+    - Backend khác: Core insert với executemany
+    chunk_mode: bộ chunks bổ sung (None = bộ chính của document, xem Chunk.chunk_mode)
+    Nội dung được nén theo CHUNK_COMPRESSION (xem _chunk_encoder).
+    Chạy trong transaction của session, KHÔNG commit.
+    Trả về: số chunks đã ghi
+    """
+    batch_size = batch_size or CHUNK_BATCH_SIZE
+    bind = session.get_bind()
+    use_copy = bind.dialect.name == 'postgresql' and bind.dialect.driver == 'psycopg2'
+    insert_stmt = Chunk.__table__.insert()
+    encode = _chunk_encoder(session)
+
+    def flush(rows):
+        if use_copy:
+            _copy_chunk_rows(session, rows)
+        else:
+            session.execute(insert_stmt, rows)
+
+    total = 0
+    batch = []
+    for chunk in chunks_data:
+        batch.append({
+            'document_id': document_id,
+            'chunk_index': chunk['chunk_index'],
+            'content': chunk['content'],
+            'char_count': chunk.get('char_count', len(chunk['content'])),
+            'page_number': chunk.get('page_number'),
+            'chunk_mode': chunk_mode,
+            'content_z': None,
+            'content_codec': None
+        })
+        if encode is not None:
+            encode(batch[-1])
+        if len(batch) >= batch_size:
+            flush(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        flush(batch)
+        total += len(batch)
+    return total
+
+def save_chunks(document_id: int, chunks_data: list, batch_size: int = None):
     """
     Lưu danh sách các chunks của document đó.
-    chunks_data: list các dict, mỗi dict chứa: chunk_index, content, char_count
+    chunks_data: list các dict, mỗi dict chứa: chunk_index, content, char_count (tùy chọn: page_number)
+    batch_size: số chunks mỗi lô ghi (mặc định CHUNK_BATCH_SIZE)
+    """
+    session = SessionLocal()
+    try:
+        _insert_chunks(session, document_id, chunks_data, batch_size)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def save_document_with_chunks(file_info: dict, chunks_data: list, job_id: int = None, batch_size: int = None,
+                              extra_chunk_sets: dict = None):
+    """
+    Lưu document và toàn bộ chunks của nó trong CÙNG MỘT transaction.
+    Nếu có lỗi ở bất kỳ bước nào thì rollback toàn bộ, không để lại document "mồ côi" thiếu chunks.
+    file_info: giống save_document (file_info['file_name'] là tên đã cấp khi chunks_data bắt đầu được đọc);
+               chunks_data: giống save_chunks, có thể là iterator (vd: generator
+               của pipeline streaming) - chunks được ghi theo lô ngay khi được tạo, không cần giữ hết trong bộ nhớ.
+               Nếu file_info không có chunk_count thì dùng số chunks thực tế đã ghi.
+    job_id: nếu có, đánh dấu job hoàn thành trong cùng transaction (tránh tạo document trùng khi job chạy lại)
+    batch_size: số chunks mỗi lô ghi (mặc định CHUNK_BATCH_SIZE)
+    extra_chunk_sets: dict chunk_mode -> chunks (giống chunks_data) của các bộ chunks bổ sung,
+                      được ghi lần lượt sau bộ chính (chunk_mode của file_info)
+    Trả về: id của document vừa tạo
+    """
+    session = SessionLocal()
+    try:
+        # flush để có id và tên của document trước khi tạo chunks (chưa commit)
+        new_doc = _add_document(session, Document(
+            file_name=file_info['file_name'],
+            file_path=file_info['file_path'],
+            file_type=file_info['file_type'],
+            file_size=file_info.get('file_size'),
+            chunk_count=file_info.get('chunk_count', 0),
+            content_hash=file_info.get('content_hash'),
+            chunk_mode=file_info.get('chunk_mode'),
+            upload_date=datetime.utcnow()
+        ))
+        # Tên đã cấp có trước khi chunks_data được đọc (vd: để chọn đường dẫn chunks vật lý)
+        file_info['file_name'] = new_doc.file_name
+        doc_id = new_doc.id
+
+        total = _insert_chunks(session, doc_id, chunks_data, batch_size)
+        if 'chunk_count' not in file_info:
+            new_doc.chunk_count = total
+        for chunk_mode, chunks in (extra_chunk_sets or {}).items():
+            if chunk_mode == new_doc.chunk_mode:
+                raise ValueError(f"Bộ chunks bổ sung trùng chunk_mode của document: {chunk_mode}")
+            _insert_chunks(session, doc_id, chunks, batch_size, chunk_mode=chunk_mode)
+
+        if job_id is not None:
+            _mark_job_done(session, job_id, doc_id)
+
+        session.commit()
+        return doc_id
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def _chunk_mode_clause(session, document_id: int, chunk_mode: str = None):
+    """Điều kiện lọc chunks thuộc bộ chunks chunk_mode của document (None = bộ chính)."""
+    if chunk_mode is not None:
+        primary_mode = session.query(Document.chunk_mode).filter(Document.id == document_id).scalar()
+        if chunk_mode != primary_mode:
+            return Chunk.chunk_mode == chunk_mode
+    return Chunk.chunk_mode.is_(None)
+
+def replace_chunk_sets(document_id: int, chunk_sets: dict, batch_size: int = None):
+    """
+    Tạo mới hoặc thay thế các bộ chunks của document đã có, trong CÙNG MỘT transaction.
+    chunk_sets: dict chunk_mode -> chunks (giống chunks_data của save_chunks, có thể là iterator),
+                được ghi lần lượt theo thứ tự của dict. Bộ chunks theo documents.chunk_mode là bộ chính
+                (cập nhật luôn documents.chunk_count), các mode khác là bộ bổ sung.
+    Trả về: dict chunk_mode -> số chunks đã ghi, hoặc None nếu không tìm thấy document
+    """
+    session = SessionLocal()
+    try:
+        document = session.query(Document).filter(Document.id == document_id).first()
+        if document is None:
+            return None
+
+        counts = {}
+        for chunk_mode, chunks in chunk_sets.items():
+            stored_mode = None if chunk_mode == document.chunk_mode else chunk_mode
+            session.query(Chunk).filter(
+                Chunk.document_id == document_id, _chunk_mode_clause(session, document_id, chunk_mode)
+            ).delete(synchronize_session=False)
+            counts[chunk_mode] = _insert_chunks(session, document_id, chunks, batch_size, chunk_mode=stored_mode)
+            if stored_mode is None:
+                document.chunk_count = counts[chunk_mode]
+
+        session.commit()
+        return counts
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def _get_chunk_sets(session, document_id: int) -> list:
+    document = session.query(Document.chunk_mode, Document.chunk_count).filter(Document.id == document_id).first()
+    if document is None:
+        return []
+    sets = [{'chunk_mode': document.chunk_mode, 'chunk_count': document.chunk_count, 'primary': True}]
+    rows = session.query(Chunk.chunk_mode, func.count()).filter(
+        Chunk.document_id == document_id, Chunk.chunk_mode.is_not(None)
+    ).group_by(Chunk.chunk_mode).order_by(Chunk.chunk_mode).all()
+    sets.extend({'chunk_mode': mode, 'chunk_count': count, 'primary': False} for mode, count in rows)
+    return sets
+
+def get_chunk_sets(document_id: int) -> list:
+    """
+    Các bộ chunks của document (bộ chính trước).
+    Trả về: list dict gồm chunk_mode, chunk_count, primary; list rỗng nếu không tìm thấy document
+    """
+    session = SessionLocal()
+    try:
+        return _get_chunk_sets(session, document_id)
+    finally:
+        session.close()
+
+def find_document_by_hash(content_hash: str, chunk_mode=None):
+    """
+    Tìm document (cũ nhất) có cùng hash nội dung (và có bộ chunks theo chunk_mode nếu truyền vào;
+    chunk_mode là list thì document phải có đủ bộ chunks cho mọi mode trong list).
+    Dùng index trên content_hash. Trả về: id của document hoặc None
+    """
+    session = SessionLocal()
+    try:
+        query = session.query(Document.id).filter(Document.content_hash == content_hash)
+        if chunk_mode is not None:
+            for mode in ([chunk_mode] if isinstance(chunk_mode, str) else chunk_mode):
+                query = query.filter(or_(
+                    Document.chunk_mode == mode,
+                    exists().where(Chunk.document_id == Document.id, Chunk.chunk_mode == mode)
+                ))
+        return query.order_by(Document.id).limit(1).scalar()
+    finally:
+        session.close()
+
+def link_document(source_document_id: int, file_info: dict, job_id: int = None):
+    """
+    Tạo document mới có cùng nội dung với document đã có mà không cần trích xuất lại:
+    chunks được sao chép ngay trong database (INSERT ... SELECT), cùng một transaction.
+    file_info: giống save_document (chunk_count lấy từ document nguồn)
+    job_id: nếu có, đánh dấu job hoàn thành trong cùng transaction
+    Trả về: id của document mới
     """
     session = SessionLocal()
     try:
-        chunks_objects = []
-        for chunk in chunks_data:
-            new_chunk = Chunk(
-                document_id=document_id,
-                chunk_index=chunk['chunk_index'],
-                content=chunk['content'],
-                char_count=chunk.get('char_count', len(chunk['content']))
+        source = session.query(Document).filter(Document.id == source_document_id).first()
+        if source is None:
+            raise ValueError(f"Không tìm thấy document nguồn {source_document_id}")
+
+        new_doc = _add_document(session, Document(
+            file_name=file_info['file_name'],
+            file_path=file_info['file_path'],
+            file_type=file_info.get('file_type', source.file_type),
+            file_size=file_info.get('file_size', source.file_size),
+            chunk_count=source.chunk_count,
+            content_hash=source.content_hash,
+            chunk_mode=source.chunk_mode,
+            upload_date=datetime.utcnow()
+        ))
+        file_info['file_name'] = new_doc.file_name
+        doc_id = new_doc.id
+
+        session.execute(
+            Chunk.__table__.insert().from_select(
+                ['document_id', 'chunk_index', 'content', 'char_count', 'page_number', 'chunk_mode',
+                 'content_z', 'content_codec'],
+                select(literal(doc_id), Chunk.chunk_index, Chunk.content, Chunk.char_count, Chunk.page_number,
+                       Chunk.chunk_mode, Chunk.content_z, Chunk.content_codec)
+                .where(Chunk.document_id == source_document_id)
             )
-            chunks_objects.append(new_chunk)
-        
-        session.add_all(chunks_objects)
+        )
+
+        if job_id is not None:
+            _mark_job_done(session, job_id, doc_id)
+
         session.commit()
+        return doc_id
     except Exception as e:
         session.rollback()
         raise e
     finally:
         session.close()
 
+def _get_document(session, document_id: int):
+    return session.query(Document).filter(Document.id == document_id).first()
+
 def get_document(document_id: int):
     """Truy vấn thông tin document theo ID."""
     session = SessionLocal()
     try:
-        return session.query(Document).filter(Document.id == document_id).first()
+        return _get_document(session, document_id)
     finally:
         session.close()
 
-def get_chunks(document_id: int):
-    """Truy vấn danh sách chunks của document theo ID."""
+def _get_chunks(session, document_id: int, chunk_mode: str = None):
+    return session.query(Chunk).filter(
+        Chunk.document_id == document_id, _chunk_mode_clause(session, document_id, chunk_mode)
+    ).order_by(Chunk.chunk_index).all()
+
+def get_chunks(document_id: int, chunk_mode: str = None):
+    """Truy vấn danh sách chunks của document theo ID (bộ chunks chunk_mode, mặc định bộ chính)."""
     session = SessionLocal()
     try:
-        return session.query(Chunk).filter(Chunk.document_id == document_id).order_by(Chunk.chunk_index).all()
+        return _get_chunks(session, document_id, chunk_mode)
     finally:
         session.close()
 
-def check_document_exists(file_name: str) -> bool:
-    """Kiểm tra xem document với tên file này đã tồn tại chưa."""
+def _chunk_range_query(document_id: int, start: int = 0, end: int = None, mode_clause=None):
+    """SELECT chunks của document có start <= chunk_index < end, theo thứ tự chunk_index (dòng đọc bằng _chunk_row)."""
+    stmt = select(Chunk.id, Chunk.chunk_index, Chunk.content, Chunk.char_count, Chunk.page_number,
+                  Chunk.content_z, Chunk.content_codec).where(
+        Chunk.document_id == document_id,
+        Chunk.chunk_mode.is_(None) if mode_clause is None else mode_clause,
+        Chunk.chunk_index >= start
+    )
+    if end is not None:
+        stmt = stmt.where(Chunk.chunk_index < end)
+    return stmt.order_by(Chunk.chunk_index)
+
+def _chunk_row(row, fetch) -> dict:
+    """Dòng của _chunk_range_query -> dict id, chunk_index, content (đã giải nén), char_count, page_number."""
+    item = dict(row._mapping)
+    item['content'] = _decode_content(item['content'], item.pop('content_z'), item.pop('content_codec'), fetch)
+    return item
+
+def _get_chunk_range(session, document_id: int, start: int = 0, end: int = None, limit: int = 100,
+                     chunk_mode: str = None) -> dict:
+    mode_clause = _chunk_mode_clause(session, document_id, chunk_mode)
+    rows = session.execute(_chunk_range_query(document_id, start, end, mode_clause).limit(limit + 1)).all()
+    fetch = _session_fetch(session)
+    items = [_chunk_row(row, fetch) for row in rows[:limit]]
+    next_start = rows[limit].chunk_index if len(rows) > limit else None
+    return {'items': items, 'next_start': next_start}
+
+def get_chunk_range(document_id: int, start: int = 0, end: int = None, limit: int = 100, chunk_mode: str = None) -> dict:
+    """
+    Lấy một trang chunks của document theo chunk_index (start <= chunk_index < end).
+    chunk_mode: bộ chunks cần lấy (mặc định bộ chính)
+    Trả về: {'items': [...], 'next_start': chunk_index bắt đầu trang sau hoặc None nếu đã hết}
+    """
     session = SessionLocal()
     try:
-        exists = session.query(Document.id).filter(Document.file_name == file_name).first() is not None
-        return exists
+        return _get_chunk_range(session, document_id, start, end, limit, chunk_mode)
     finally:
         session.close()
 
-def get_unique_filename(file_name: str) -> str:
+def iter_chunks(document_id: int, start: int = 0, end: int = None, batch_size: int = None, chunk_mode: str = None):
     """
-    Tạo tên file duy nhất bằng cách thêm (n) nếu trùng.
-    Ví dụ: file.txt -> file(1).txt
+    Duyệt chunks của document theo thứ tự chunk_index mà không tải hết vào bộ nhớ.
+    Dùng server-side cursor (yield_per): mỗi lần chỉ giữ batch_size dòng.
+    chunk_mode: bộ chunks cần duyệt (mặc định bộ chính)
+    Yield: dict gồm id, chunk_index, content, char_count, page_number
     """
     session = SessionLocal()
     try:
-        # Nếu chưa tồn tại thì trả về nguyên bản
-        if session.query(Document.id).filter(Document.file_name == file_name).first() is None:
-            return file_name
-        
-        name, ext = os.path.splitext(file_name)
-        counter = 1
-        while True:
-            new_name = f"{name}({counter}){ext}"
-            if session.query(Document.id).filter(Document.file_name == new_name).first() is None:
-                return new_name
-            counter += 1
+        mode_clause = _chunk_mode_clause(session, document_id, chunk_mode)
+        stmt = _chunk_range_query(document_id, start, end, mode_clause).execution_options(
+            yield_per=batch_size or CHUNK_STREAM_BATCH_SIZE
+        )
+        fetch = _session_fetch(session)
+        for row in session.execute(stmt):
+            yield _chunk_row(row, fetch)
+    finally:
+        session.close()
+
+def _check_compression_dialect(session):
+    """Nén chunks trong ứng dụng chỉ áp dụng với SQLite (xem CHUNK_COMPRESSION)."""
+    dialect = session.get_bind().dialect.name
+    if dialect != 'sqlite':
+        raise ValueError(f"Nén chunks chỉ áp dụng với SQLite, không áp dụng với {dialect}")
+
+def train_chunk_dictionary(codec: str, sample_count: int = 2000, size: int = None):
+    """
+    Train dictionary nén mới cho codec từ sample_count chunk mẫu (rải đều theo id trong bảng chunks)
+    và lưu vào chunk_dictionaries; chunks ghi / nén lại sau đó dùng dictionary này (chỉ với SQLite).
+    Trả về: id của dictionary, hoặc None nếu chưa có chunk nào
+    """
+    session = SessionLocal()
+    try:
+        _check_compression_dialect(session)
+        total = session.query(func.count(Chunk.id)).scalar()
+        if not total:
+            return None
+        step = max(total // sample_count, 1)
+        rows = session.execute(
+            select(Chunk.content, Chunk.content_z, Chunk.content_codec)
+            .where(Chunk.id % step == 0).order_by(Chunk.id).limit(sample_count)
+        ).all()
+        fetch = _session_fetch(session)
+        samples = [_decode_content(*row, fetch) for row in rows]
+        dictionary = ChunkDictionary(codec=codec, data=chunk_codec.train_dictionary(samples, codec, size),
+                                     sample_count=len(samples), created_at=datetime.utcnow())
+        session.add(dictionary)
+        session.commit()
+        return dictionary.id
+    except Exception as e:
+        session.rollback()
+        raise e
     finally:
         session.close()
 
+def recompress_chunks(codec: str = None, batch_size: int = None, progress=None) -> dict:
+    """
+    Nén lại (hoặc giải nén với codec 'none') các chunks đã có theo codec (mặc định CHUNK_COMPRESSION)
+    và dictionary mới nhất của codec, theo lô batch_size dòng (keyset theo id), mỗi lô một transaction.
+    Dòng đã đúng codec + dictionary được bỏ qua. Chạy lại sau khi dừng giữa chừng là an toàn.
+    Chỉ áp dụng với SQLite (ValueError với database khác, xem CHUNK_COMPRESSION).
+    progress: hàm nhận dict thống kê sau mỗi lô (tùy chọn)
+    Trả về: dict rows (số dòng đã duyệt), updated (số dòng đã ghi lại)
+    """
+    batch_size = batch_size or CHUNK_BATCH_SIZE
+    stats = {'rows': 0, 'updated': 0}
+    last_id = 0
+    while True:
+        session = SessionLocal()
+        try:
+            _check_compression_dialect(session)
+            rows = session.execute(
+                select(Chunk.id, Chunk.content, Chunk.content_z, Chunk.content_codec)
+                .where(Chunk.id > last_id).order_by(Chunk.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            encode = _chunk_encoder(session, codec)
+            fetch = _session_fetch(session)
+            changed = []
+            for row in rows:
+                item = {'content': _decode_content(row.content, row.content_z, row.content_codec, fetch),
+                        'content_z': None, 'content_codec': None}
+                if encode is not None:
+                    encode(item)
+                if item['content_codec'] != row.content_codec:
+                    changed.append({'b_id': row.id, 'b_content': item['content'],
+                                    'b_content_z': item['content_z'], 'b_content_codec': item['content_codec']})
+            if changed:
+                session.execute(
+                    update(Chunk.__table__).where(Chunk.__table__.c.id == bindparam('b_id')).values(
+                        content=bindparam('b_content'), content_z=bindparam('b_content_z'),
+                        content_codec=bindparam('b_content_codec')
+                    ),
+                    changed
+                )
+            session.commit()
+            stats['rows'] += len(rows)
+            stats['updated'] += len(changed)
+            last_id = rows[-1].id
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+        if progress is not None:
+            progress(dict(stats))
+    return stats
+
+def chunk_storage_stats() -> dict:
+    """
+    Dung lượng nội dung chunks: raw_bytes (text UTF-8), stored_bytes (dung lượng lưu thực tế:
+    content_z với chunk nén, pg_column_size với PostgreSQL), ratio = raw_bytes / stored_bytes.
+    """
+    session = SessionLocal()
+    try:
+        dialect = session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            sql = text("SELECT count(*) AS chunks, 0 AS compressed_chunks, "
+                       "coalesce(sum(octet_length(content)), 0) AS raw_bytes, "
+                       "coalesce(sum(pg_column_size(content)), 0) AS stored_bytes FROM chunks")
+        elif dialect == 'sqlite':
+            sql = text("SELECT count(*) AS chunks, count(content_codec) AS compressed_chunks, "
+                       "coalesce(sum(length(CAST(chunk_text(content, content_z, content_codec) AS BLOB))), 0) AS raw_bytes, "
+                       "coalesce(sum(CASE WHEN content_codec IS NULL THEN length(CAST(content AS BLOB)) "
+                       "ELSE length(content_z) END), 0) AS stored_bytes FROM chunks")
+        else:
+            sql = text("SELECT count(*) AS chunks, 0 AS compressed_chunks, "
+                       "coalesce(sum(length(content)), 0) AS raw_bytes, coalesce(sum(length(content)), 0) AS stored_bytes "
+                       "FROM chunks")
+        stats = dict(session.execute(sql).one()._mapping)
+        stats['ratio'] = round(stats['raw_bytes'] / stats['stored_bytes'], 3) if stats['stored_bytes'] else None
+        return stats
+    finally:
+        session.close()
+
+def check_document_exists(file_name: str) -> bool:
+    """Kiểm tra xem document với tên file này đã tồn tại chưa."""
+    session = SessionLocal()
+    try:
+        exists = session.query(Document.id).filter(Document.file_name == file_name).first() is not None
+        return exists
+    finally:
+        session.close()
+
+def _suffixed_name(file_name: str, suffix: int) -> str:
+    """file.txt, 2 -> file(2).txt (suffix 0 là tên gốc)."""
+    if suffix == 0:
+        return file_name
+    name, ext = os.path.splitext(file_name)
+    return f"{name}({suffix}){ext}"
+
+def _escape_like(value: str) -> str:
+    """Escape ký tự đặc biệt của LIKE (dùng kèm escape='\\')."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def _max_existing_suffix(session, file_name: str) -> int:
+    """
+    Hậu tố lớn nhất đang được dùng bởi documents cho tên gốc này (một truy vấn LIKE).
+    Trả về -1 nếu chưa có document nào dùng tên này, 0 nếu chỉ có tên gốc.
+    Chỉ dùng khi khởi tạo bộ đếm cho dữ liệu có sẵn trước khi có bảng file_name_counters,
+    hoặc khi đồng bộ lại bộ đếm sau khi tên được cấp đã bị chiếm.
+    """
+    name, ext = os.path.splitext(file_name)
+    pattern = f"{_escape_like(name)}(%){_escape_like(ext)}"
+    suffix_re = re.compile(rf"^{re.escape(name)}\((\d+)\){re.escape(ext)}$")
+
+    rows = session.query(Document.file_name).filter(
+        (Document.file_name == file_name) | Document.file_name.like(pattern, escape='\\')
+    ).all()
+
+    best = -1
+    for (existing,) in rows:
+        if existing == file_name:
+            best = max(best, 0)
+            continue
+        match = suffix_re.match(existing)
+        if match:
+            best = max(best, int(match.group(1)))
+    return best
+
+def _allocate_suffix(session, file_name: str, resync: bool = False) -> int:
+    """
+    Cấp hậu tố tiếp theo cho tên gốc (chưa commit).
+    UPDATE ... + 1 khóa dòng bộ đếm nên các request đồng thời nhận hậu tố khác nhau.
+    resync: đưa bộ đếm lên ít nhất hậu tố lớn nhất đang được documents dùng (sau khi tên được cấp đã bị chiếm).
+    Raise IntegrityError nếu request khác vừa khởi tạo bộ đếm cùng lúc (caller thử lại).
+    """
+    if resync:
+        used = _max_existing_suffix(session, file_name)
+        session.query(FileNameCounter).filter(
+            FileNameCounter.base_name == file_name, FileNameCounter.last_suffix < used
+        ).update({FileNameCounter.last_suffix: used}, synchronize_session=False)
+    updated = session.query(FileNameCounter).filter(
+        FileNameCounter.base_name == file_name
+    ).update({FileNameCounter.last_suffix: FileNameCounter.last_suffix + 1}, synchronize_session=False)
+    if updated:
+        return session.query(FileNameCounter.last_suffix).filter(
+            FileNameCounter.base_name == file_name
+        ).scalar()
+
+    # Chưa có bộ đếm: khởi tạo từ dữ liệu documents hiện có
+    suffix = _max_existing_suffix(session, file_name) + 1
+    session.add(FileNameCounter(base_name=file_name, last_suffix=suffix))
+    session.flush()
+    return suffix
+
+def _add_document(session, document: Document, max_retries: int = 5) -> Document:
+    """
+    Thêm document (flush, chưa commit) với tên duy nhất cấp từ document.file_name (tên gốc).
+    Phải là bước ghi đầu tiên của transaction: hậu tố (n) lấy từ bộ đếm file_name_counters và được
+    commit cùng document, nên tên chỉ bị tiêu tốn khi document thực sự được lưu.
+    Unique index trên documents.file_name đảm bảo không có hai document trùng tên; nếu tên được cấp
+    đã bị chiếm (document đổi tên thủ công, file gốc tên dạng "a(1).txt", request đồng thời) hoặc
+    request khác vừa khởi tạo bộ đếm, transaction được rollback và cấp lại tên.
+    Ví dụ: file.txt -> file.txt, file(1).txt, file(2).txt...
+    """
+    base_name = document.file_name
+    for attempt in range(max_retries + 1):
+        try:
+            document.file_name = _suffixed_name(base_name, _allocate_suffix(session, base_name, resync=attempt > 0))
+            session.add(document)
+            session.flush()
+            return document
+        except IntegrityError:
+            session.rollback()
+            if attempt == max_retries:
+                raise
+
 def delete_document(document_id: int) -> bool:
     """
     Xóa document theo ID (cascade xóa luôn tất cả chunks liên quan).
@@ -195,63 +1062,549 @@ def update_document(document_id: int, update_data: dict) -> bool:
     finally:
         session.close()
 
-def search_documents_by_name(search_term: str, limit: int = 50) -> list:
+def _document_to_dict(doc) -> dict:
+    return {
+        'id': doc.id,
+        'file_name': doc.file_name,
+        'file_path': doc.file_path,
+        'file_type': doc.file_type,
+        'file_size': doc.file_size,
+        'upload_date': doc.upload_date,
+        'chunk_count': doc.chunk_count,
+        'content_hash': doc.content_hash,
+        'chunk_mode': doc.chunk_mode
+    }
+
+def _trigrams(value: str) -> set:
+    """Tập trigram của chuỗi theo cách của pg_trgm: chữ thường, tách từ, mỗi từ được đệm '  ' ở đầu và ' ' ở cuối."""
+    grams = set()
+    for word in re.findall(r"[^\W_]+", value.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def _trigram_similarity(a: str, b: str) -> float:
+    """Độ tương đồng trigram (tương đương similarity() của pg_trgm)."""
+    ta, tb = _trigrams(a), _trigrams(b)
+    if not ta or not tb:
+        return 0.0
+    return len(ta & tb) / len(ta | tb)
+
+def _search_documents_by_name(session, search_term: str, limit: int, mode: str) -> list:
+    if mode not in ('substring', 'similarity'):
+        raise ValueError(f"mode không hợp lệ: {mode}")
+    if not search_term or not search_term.strip():
+        return []
+
+    dialect = session.get_bind().dialect.name
+
+    if mode == 'similarity':
+        if dialect == 'postgresql':
+            # Toán tử % dùng GIN index để lọc ứng viên, similarity() để xếp hạng
+            score = func.similarity(Document.file_name, search_term)
+            rows = session.query(Document, score).filter(
+                Document.file_name.op('%')(search_term)
+            ).order_by(score.desc(), Document.id).limit(limit).all()
+        else:
+            if dialect == 'sqlite':
+                # Lấy ứng viên có chung trigram qua FTS5, sau đó tính độ tương đồng
+                lowered = search_term.lower()
+                grams = {lowered[i:i + 3] for i in range(len(lowered) - 2)}
+                if not grams:
+                    return []
+                match = " OR ".join('"' + g.replace('"', '""') + '"' for g in grams)
+                candidates = session.query(Document).filter(text(
+                    "documents.id IN (SELECT rowid FROM documents_name_fts "
+                    "WHERE documents_name_fts MATCH :match ORDER BY rank LIMIT :candidates)"
+                )).params(match=match, candidates=max(limit * 20, 200)).all()
+            else:
+                candidates = session.query(Document).all()
+            rows = [(doc, _trigram_similarity(doc.file_name, search_term)) for doc in candidates]
+            rows = [row for row in rows if row[1] >= NAME_SIMILARITY_THRESHOLD]
+            rows.sort(key=lambda row: (-row[1], row[0].id))
+            rows = rows[:limit]
+
+        return [dict(_document_to_dict(doc), similarity=float(sim)) for doc, sim in rows]
+
+    query = session.query(Document)
+    if dialect == 'sqlite' and len(search_term) >= 3:
+        # Chuỗi >= 3 ký tự: tra index trigram (phrase query = tìm chuỗi con)
+        query = query.filter(text(
+            "documents.id IN (SELECT rowid FROM documents_name_fts WHERE documents_name_fts MATCH :phrase)"
+        )).params(phrase='"' + search_term.replace('"', '""') + '"')
+    else:
+        # PostgreSQL: ILIKE '%...%' dùng được GIN index gin_trgm_ops
+        query = query.filter(Document.file_name.ilike(f"%{_escape_like(search_term)}%", escape='\\'))
+
+    documents = query.order_by(Document.upload_date.desc()).limit(limit).all()
+
+    # Chuyển đổi sang dict để tránh lỗi detached session
+    return [_document_to_dict(doc) for doc in documents]
+
+def search_documents_by_name(search_term: str, limit: int = 50, mode: str = "substring") -> list:
     """
-    Tìm kiếm documents theo tên file (tìm kiếm không phân biệt hoa thường, tìm kiếm một phần).
+    Tìm kiếm documents theo tên file (không phân biệt hoa thường), dùng index trigram.
     search_term: chuỗi tìm kiếm
     limit: số lượng kết quả tối đa (mặc định 50)
-    Trả về: danh sách các document phù hợp
+    mode: 'substring' - tên chứa chuỗi tìm kiếm, mới nhất trước
+          'similarity' - tên gần giống chuỗi tìm kiếm (chịu được gõ sai), xếp theo độ tương đồng
+    Trả về: danh sách các document phù hợp (mode 'similarity' có thêm key 'similarity')
     """
     session = SessionLocal()
     try:
-        # Dùng ILIKE để tìm kiếm không phân biệt chữ hoa/thường
-        documents = session.query(Document).filter(
-            Document.file_name.ilike(f"%{search_term}%")
-        ).order_by(Document.upload_date.desc()).limit(limit).all()
-        
-        # Chuyển đổi sang dict để tránh lỗi detached session
-        results = []
-        for doc in documents:
-            results.append({
-                'id': doc.id,
-                'file_name': doc.file_name,
-                'file_path': doc.file_path,
-                'file_type': doc.file_type,
-                'file_size': doc.file_size,
-                'upload_date': doc.upload_date,
-                'chunk_count': doc.chunk_count
-            })
-        return results
+        return _search_documents_by_name(session, search_term, limit, mode)
+    finally:
+        session.close()
+
+def _fts5_query(search_term: str) -> str:
+    """Chuyển chuỗi người dùng nhập thành truy vấn FTS5 an toàn: mỗi từ được quote, nối bằng AND."""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in search_term.split())
+
+def _search_chunks(session, search_term: str, limit: int, offset: int) -> list:
+    if not search_term or not search_term.strip():
+        return []
+
+    dialect = session.get_bind().dialect.name
+    params = {'limit': limit, 'offset': offset}
+    if dialect == 'postgresql':
+        sql = text("""
+            SELECT c.id AS chunk_id, c.document_id, d.file_name, c.chunk_index,
+                   COALESCE(c.chunk_mode, d.chunk_mode) AS chunk_mode,
+                   ts_rank_cd(c.content_tsv, q) AS rank,
+                   ts_headline(CAST(:cfg AS regconfig), c.content, q,
+                               'StartSel=<b>, StopSel=</b>, MaxWords=30, MinWords=10') AS snippet
+            FROM chunks c
+            JOIN documents d ON d.id = c.document_id,
+                 websearch_to_tsquery(CAST(:cfg AS regconfig), :q) q
+            WHERE c.content_tsv @@ q
+            ORDER BY rank DESC, c.id
+            LIMIT :limit OFFSET :offset
+        """)
+        params.update(q=search_term, cfg=FTS_CONFIG)
+    elif dialect == 'sqlite':
+        sql = text("""
+            SELECT c.id AS chunk_id, c.document_id, d.file_name, c.chunk_index,
+                   COALESCE(c.chunk_mode, d.chunk_mode) AS chunk_mode,
+                   -bm25(chunks_fts) AS rank,
+                   snippet(chunks_fts, 0, '<b>', '</b>', '...', 16) AS snippet
+            FROM chunks_fts
+            JOIN chunks c ON c.id = chunks_fts.rowid
+            JOIN documents d ON d.id = c.document_id
+            WHERE chunks_fts MATCH :q
+            ORDER BY bm25(chunks_fts), c.id
+            LIMIT :limit OFFSET :offset
+        """)
+        params['q'] = _fts5_query(search_term)
+    else:
+        # Backend khác: quét tuần tự bằng LIKE, không xếp hạng
+        sql = text("""
+            SELECT c.id AS chunk_id, c.document_id, d.file_name, c.chunk_index,
+                   COALESCE(c.chunk_mode, d.chunk_mode) AS chunk_mode,
+                   0 AS rank, substr(c.content, 1, 200) AS snippet
+            FROM chunks c JOIN documents d ON d.id = c.document_id
+            WHERE lower(c.content) LIKE lower(:q)
+            ORDER BY c.id
+            LIMIT :limit OFFSET :offset
+        """)
+        params['q'] = f"%{search_term}%"
+
+    return [dict(row._mapping) for row in session.execute(sql, params)]
+
+def search_chunks(search_term: str, limit: int = 20, offset: int = 0) -> list:
+    """
+    Tìm kiếm full-text trong nội dung chunks, xếp hạng theo độ liên quan.
+    PostgreSQL: tsvector + GIN (websearch_to_tsquery, ts_rank_cd, ts_headline)
+    SQLite: FTS5 (bm25, snippet)
+    Trả về: danh sách dict gồm chunk_id, document_id, file_name, chunk_index, chunk_mode (bộ chunks chứa chunk),
+            rank (càng lớn càng liên quan), snippet
+    """
+    session = SessionLocal()
+    try:
+        return _search_chunks(session, search_term, limit, offset)
     finally:
         session.close()
 
-def get_all_documents(limit: int = 100, offset: int = 0) -> list:
+def encode_cursor(upload_date, document_id: int) -> str:
+    """Mã hóa vị trí (upload_date, id) của document cuối trang thành cursor dạng chuỗi."""
+    raw = json.dumps([upload_date.isoformat() if upload_date else None, document_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str):
+    """Giải mã cursor. Trả về: (upload_date, id). Raise ValueError nếu cursor không hợp lệ."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        upload_date, document_id = json.loads(raw)
+        return (datetime.fromisoformat(upload_date) if upload_date else None), int(document_id)
+    except Exception:
+        raise ValueError(f"Cursor không hợp lệ: {cursor}")
+
+def _get_all_documents(session, limit: int, after: str) -> dict:
+    query = session.query(Document)
+    if after:
+        upload_date, document_id = decode_cursor(after)
+        query = query.filter(tuple_(Document.upload_date, Document.id) < tuple_(upload_date, document_id))
+
+    # Lấy dư một dòng để biết còn trang sau hay không
+    documents = query.order_by(Document.upload_date.desc(), Document.id.desc()).limit(limit + 1).all()
+
+    page = documents[:limit]
+    next_cursor = None
+    if len(documents) > limit and page:
+        next_cursor = encode_cursor(page[-1].upload_date, page[-1].id)
+    return {'items': [_document_to_dict(doc) for doc in page], 'next_cursor': next_cursor}
+
+def get_all_documents(limit: int = 100, after: str = None) -> dict:
     """
-    Lấy danh sách tất cả documents với phân trang.
+    Lấy danh sách documents (mới nhất trước) với phân trang keyset theo (upload_date, id).
+    Mỗi trang chỉ đọc limit dòng từ index, không phụ thuộc trang sâu bao nhiêu (khác OFFSET).
     limit: số lượng kết quả tối đa
-    offset: vị trí bắt đầu
-    Trả về: danh sách các document
+    after: cursor next_cursor của trang trước (None = trang đầu)
+    Trả về: {'items': [...], 'next_cursor': cursor của trang sau hoặc None nếu đã hết}
     """
     session = SessionLocal()
     try:
-        documents = session.query(Document).order_by(
-            Document.upload_date.desc()
-        ).offset(offset).limit(limit).all()
-        
-        results = []
-        for doc in documents:
-            results.append({
-                'id': doc.id,
-                'file_name': doc.file_name,
-                'file_path': doc.file_path,
-                'file_type': doc.file_type,
-                'file_size': doc.file_size,
-                'upload_date': doc.upload_date,
-                'chunk_count': doc.chunk_count
-            })
-        return results
+        return _get_all_documents(session, limit, after)
+    finally:
+        session.close()
+
+def load_manifest(directory_prefix: str, chunk_mode: str) -> dict:
+    """
+    Đọc manifest của các file nằm trong thư mục (một truy vấn duy nhất).
+    Trả về: dict path -> {size, mtime_ns, content_hash, document_id, owned}
+    """
+    session = SessionLocal()
+    try:
+        rows = session.query(
+            SourceFile.path, SourceFile.size, SourceFile.mtime_ns,
+            SourceFile.content_hash, SourceFile.document_id, SourceFile.owned
+        ).filter(
+            SourceFile.path.startswith(directory_prefix, autoescape=True),
+            SourceFile.chunk_mode == chunk_mode
+        ).all()
+        return {
+            row.path: {
+                'size': row.size,
+                'mtime_ns': row.mtime_ns,
+                'content_hash': row.content_hash,
+                'document_id': row.document_id,
+                'owned': bool(row.owned)
+            }
+            for row in rows
+        }
+    finally:
+        session.close()
+
+def upsert_manifest_entry(path: str, chunk_mode: str, size: int, mtime_ns: int,
+                          content_hash: str = None, document_id: int = None, owned: bool = False):
+    """Thêm hoặc cập nhật một dòng manifest cho file nguồn (owned: document do sync tạo từ file này)."""
+    session = SessionLocal()
+    try:
+        entry = session.query(SourceFile).filter(
+            SourceFile.path == path, SourceFile.chunk_mode == chunk_mode
+        ).first()
+        if entry is None:
+            entry = SourceFile(path=path, chunk_mode=chunk_mode)
+            session.add(entry)
+        entry.size = size
+        entry.mtime_ns = mtime_ns
+        entry.content_hash = content_hash
+        entry.document_id = document_id
+        entry.owned = owned
+        entry.updated_at = datetime.utcnow()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def delete_manifest_entries(paths: list, chunk_mode: str) -> int:
+    """Xóa các dòng manifest của những file nguồn không còn tồn tại."""
+    if not paths:
+        return 0
+    session = SessionLocal()
+    try:
+        count = session.query(SourceFile).filter(
+            SourceFile.path.in_(paths), SourceFile.chunk_mode == chunk_mode
+        ).delete(synchronize_session=False)
+        session.commit()
+        return count
+    except Exception as e:
+        session.rollback()
+        raise e
     finally:
         session.close()
 
+def count_manifest_references(document_id: int) -> int:
+    """Số file nguồn trong manifest đang trỏ tới document (nhiều file trùng nội dung có thể dùng chung)."""
+    session = SessionLocal()
+    try:
+        return session.query(SourceFile).filter(SourceFile.document_id == document_id).count()
+    finally:
+        session.close()
+
+def _job_to_dict(job) -> dict:
+    """Chuyển Job sang dict để dùng ngoài session."""
+    return {
+        'id': job.id,
+        'file_name': job.file_name,
+        'file_path': job.file_path,
+        'document_name': job.document_name,
+        'chunk_mode': job.chunk_mode,
+        'content_hash': job.content_hash,
+        'dedup_policy': job.dedup_policy,
+        'status': job.status,
+        'document_id': job.document_id,
+        'error': job.error,
+        'attempts': job.attempts,
+        'created_at': job.created_at,
+        'updated_at': job.updated_at
+    }
+
+def _mark_job_done(session, job_id: int, document_id: int):
+    """Đánh dấu job hoàn thành trong session (transaction) hiện tại."""
+    session.query(Job).filter(Job.id == job_id).update({
+        Job.status: JOB_DONE,
+        Job.document_id: document_id,
+        Job.error: None,
+        Job.updated_at: datetime.utcnow()
+    }, synchronize_session=False)
+
+def complete_job(job_id: int, document_id: int):
+    """Đánh dấu job hoàn thành, gắn với document tương ứng (vd: document trùng nội dung đã có)."""
+    session = SessionLocal()
+    try:
+        _mark_job_done(session, job_id, document_id)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def create_job(file_name: str, file_path: str, chunk_mode: str = "sentence",
+               content_hash: str = None, dedup_policy: str = None, document_name: str = None) -> int:
+    """
+    Tạo job xử lý nền cho file đã được lưu trên đĩa.
+    document_name: tên gốc của document sẽ tạo (mặc định tên file trên đĩa), tên duy nhất được cấp khi lưu.
+    Trả về: id của job
+    """
+    session = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        job = Job(
+            file_name=file_name,
+            file_path=file_path,
+            document_name=document_name,
+            chunk_mode=chunk_mode,
+            content_hash=content_hash,
+            dedup_policy=dedup_policy,
+            status=JOB_PENDING,
+            attempts=0,
+            created_at=now,
+            updated_at=now
+        )
+        session.add(job)
+        session.commit()
+        session.refresh(job)
+        return job.id
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def claim_next_job():
+    """
+    Lấy job pending cũ nhất và chuyển sang running.
+    Dùng SELECT ... FOR UPDATE SKIP LOCKED (PostgreSQL) và UPDATE có điều kiện trạng thái,
+    nên nhiều worker (kể cả ở nhiều process) không bao giờ nhận cùng một job.
+    Trả về: dict của job hoặc None nếu hàng đợi trống
+    """
+    session = SessionLocal()
+    try:
+        while True:
+            job_id = session.query(Job.id).filter(
+                Job.status == JOB_PENDING
+            ).order_by(Job.id).with_for_update(skip_locked=True).limit(1).scalar()
+            if job_id is None:
+                session.commit()
+                return None
+
+            claimed = session.query(Job).filter(
+                Job.id == job_id, Job.status == JOB_PENDING
+            ).update({
+                Job.status: JOB_RUNNING,
+                Job.attempts: Job.attempts + 1,
+                Job.updated_at: datetime.utcnow()
+            }, synchronize_session=False)
+            session.commit()
+
+            # Worker khác đã nhận job này trước -> thử job tiếp theo
+            if claimed == 1:
+                job = session.query(Job).filter(Job.id == job_id).first()
+                return _job_to_dict(job)
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def fail_job(job_id: int, error: str):
+    """Đánh dấu job thất bại kèm thông báo lỗi."""
+    session = SessionLocal()
+    try:
+        session.query(Job).filter(Job.id == job_id).update({
+            Job.status: JOB_FAILED,
+            Job.error: error,
+            Job.updated_at: datetime.utcnow()
+        }, synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def requeue_running_jobs() -> int:
+    """
+    Đưa các job đang "running" về "pending" (dùng khi khởi động lại server).
+    Job bị gián đoạn giữa chừng sẽ được xử lý lại; việc ghi document + đánh dấu job done
+    nằm trong cùng transaction nên không tạo document trùng.
+    Trả về: số job được đưa lại hàng đợi
+    """
+    session = SessionLocal()
+    try:
+        count = session.query(Job).filter(Job.status == JOB_RUNNING).update({
+            Job.status: JOB_PENDING,
+            Job.updated_at: datetime.utcnow()
+        }, synchronize_session=False)
+        session.commit()
+        return count
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+def _get_job(session, job_id: int):
+    job = session.query(Job).filter(Job.id == job_id).first()
+    return _job_to_dict(job) if job else None
+
+def get_job(job_id: int):
+    """Truy vấn job theo ID. Trả về dict hoặc None."""
+    session = SessionLocal()
+    try:
+        return _get_job(session, job_id)
+    finally:
+        session.close()
+
+def _list_jobs(session, status: str = None, limit: int = 100) -> list:
+    query = session.query(Job)
+    if status:
+        query = query.filter(Job.status == status)
+    return [_job_to_dict(job) for job in query.order_by(Job.id.desc()).limit(limit).all()]
+
+def list_jobs(status: str = None, limit: int = 100) -> list:
+    """
+    Lấy danh sách job (mới nhất trước), có thể lọc theo trạng thái.
+    """
+    session = SessionLocal()
+    try:
+        return _list_jobs(session, status, limit)
+    finally:
+        session.close()
+
+# Truy cập database bất đồng bộ cho các endpoint đọc của API (asyncpg / aiosqlite): không giữ thread
+# của threadpool trong lúc chờ database. Các hàm *_async chạy cùng truy vấn với hàm đồng bộ tương ứng
+# qua AsyncSession.run_sync, trên session của request (get_async_db_session) hoặc một session mới.
+# Engine async được tạo ở lần dùng đầu tiên (CLI / job worker không cần driver async).
+_async_engine = None
+_async_session_factory = None
+
+def _async_url(url: str):
+    url = make_url(url)
+    if url.drivername in ('postgresql', 'postgresql+psycopg2'):
+        return url.set(drivername='postgresql+asyncpg')
+    if url.drivername in ('sqlite', 'sqlite+pysqlite'):
+        return url.set(drivername='sqlite+aiosqlite')
+    return url
+
+def get_async_engine():
+    """Engine async dùng chung (ASYNC_DATABASE_URL hoặc suy từ DATABASE_URL)."""
+    global _async_engine
+    if _async_engine is None:
+        url = make_url(ASYNC_DATABASE_URL) if ASYNC_DATABASE_URL else _async_url(DATABASE_URL)
+        _async_engine = create_async_engine(url, **_engine_options(url))
+    return _async_engine
+
+def AsyncSessionLocal():
+    """Tạo AsyncSession mới (tương tự SessionLocal)."""
+    global _async_session_factory
+    if _async_session_factory is None:
+        _async_session_factory = async_sessionmaker(get_async_engine(), autoflush=False, expire_on_commit=False)
+    return _async_session_factory()
+
+async def dispose_async_engine():
+    """Đóng các kết nối của engine async (khi tắt server)."""
+    global _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+    _async_engine = _async_session_factory = None
+
+async def get_async_db_session():
+    """Dependency FastAPI: một AsyncSession (một kết nối) cho cả request, tương tự get_db_session."""
+    async with AsyncSessionLocal() as session:
+        yield session
+
+async def _run_async(fn, *args, session=None):
+    """Chạy fn(session, *args) (hàm truy vấn đồng bộ) trên AsyncSession session, hoặc một session mới."""
+    if session is not None:
+        return await session.run_sync(fn, *args)
+    async with AsyncSessionLocal() as session:
+        return await session.run_sync(fn, *args)
+
+async def get_document_async(document_id: int, session=None):
+    return await _run_async(_get_document, document_id, session=session)
+
+async def get_chunks_async(document_id: int, chunk_mode: str = None, session=None):
+    return await _run_async(_get_chunks, document_id, chunk_mode, session=session)
+
+async def get_chunk_sets_async(document_id: int, session=None) -> list:
+    return await _run_async(_get_chunk_sets, document_id, session=session)
+
+async def get_chunk_range_async(document_id: int, start: int = 0, end: int = None, limit: int = 100,
+                                chunk_mode: str = None, session=None) -> dict:
+    return await _run_async(_get_chunk_range, document_id, start, end, limit, chunk_mode, session=session)
+
+async def iter_chunks_async(document_id: int, start: int = 0, end: int = None, batch_size: int = None,
+                            chunk_mode: str = None):
+    """
+    Như iter_chunks: duyệt chunks theo thứ tự chunk_index, mỗi lần đọc một trang batch_size dòng
+    bằng session riêng (transaction ngắn, không giữ kết nối trong lúc client đọc chậm).
+    """
+    batch_size = batch_size or CHUNK_STREAM_BATCH_SIZE
+    while start is not None:
+        page = await get_chunk_range_async(document_id, start, end, batch_size, chunk_mode)
+        for item in page['items']:
+            yield item
+        start = page['next_start']
+
+async def search_chunks_async(search_term: str, limit: int = 20, offset: int = 0, session=None) -> list:
+    return await _run_async(_search_chunks, search_term, limit, offset, session=session)
+
+async def search_documents_by_name_async(search_term: str, limit: int = 50, mode: str = "substring",
+                                         session=None) -> list:
+    return await _run_async(_search_documents_by_name, search_term, limit, mode, session=session)
+
+async def get_all_documents_async(limit: int = 100, after: str = None, session=None) -> dict:
+    return await _run_async(_get_all_documents, limit, after, session=session)
+
+async def get_job_async(job_id: int, session=None):
+    return await _run_async(_get_job, job_id, session=session)
+
+async def list_jobs_async(status: str = None, limit: int = 100, session=None) -> list:
+    return await _run_async(_list_jobs, status, limit, session=session)
+
 if __name__ == "__main__":
     init_database()
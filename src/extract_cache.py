@@ -0,0 +1,250 @@
+import os
+import json
+import zlib
+import codecs
+import struct
+import hashlib
+import logging
+import threading
+from processors.stream import TextStream
+
+# Cache kết quả trích xuất trên đĩa: (hash nội dung file + tên/phiên bản processor) -> text đã nén + metadata.
+# Chạy lại pipeline sau khi đổi chunker, hoặc ingest cùng file với chunk_mode khác, không phải parse lại file.
+EXTRACT_CACHE_ENABLED = os.getenv("EXTRACT_CACHE", "1") == "1"
+EXTRACT_CACHE_DIR = os.getenv(
+    "EXTRACT_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "extract_cache")
+)
+# Dung lượng tối đa của cache (MB); vượt quá thì xóa các mục lâu không dùng nhất (LRU theo mtime)
+EXTRACT_CACHE_MAX_MB = float(os.getenv("EXTRACT_CACHE_MAX_MB", "1024"))
+# Mức nén zlib (1 = nhanh nhất)
+EXTRACT_CACHE_LEVEL = int(os.getenv("EXTRACT_CACHE_LEVEL", "1"))
+
+# Khi dọn cache, xóa tới khi còn tỉ lệ này của dung lượng tối đa (tránh dọn lại sau mỗi lần ghi)
+_EVICT_TARGET = 0.9
+_READ_SIZE = 1024 * 1024
+# Mỗi mục cache: [text UTF-8 nén zlib][metadata JSON][độ dài metadata: uint64 little-endian]
+_TRAILER = struct.Struct("<Q")
+
+class CacheStats:
+    """Thống kê extraction cache (an toàn khi nhiều thread cùng cập nhật)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.errors = 0
+        self.bytes_written = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        """Các bộ đếm (dạng add(**counts) nhận được), vd: để cộng thống kê từ process con về process chính."""
+        with self._lock:
+            return {name: getattr(self, name) for name in ('hits', 'misses', 'writes', 'evictions', 'errors', 'bytes_written')}
+
+    def as_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'errors': self.errors,
+                'bytes_written': self.bytes_written
+            }
+
+class ExtractCache:
+    """
+    Cache trên đĩa cho TextStream của processor, mỗi mục một file <dir>/<key[:2]>/<key>.z.
+    get(key, filepath): TextStream đọc dần từ cache (None nếu chưa có);
+    record(key, stream): bọc stream của processor, ghi vào cache trong lúc stream được duyệt,
+    mục cache chỉ xuất hiện khi stream được duyệt hết (file tạm rồi đổi tên).
+    Giới hạn dung lượng do một process giữ (evicting): process con của pipeline (main.run_staged) chỉ
+    ghi mục cache và báo số byte về (stats.bytes_written), process chính gọi account() rồi dọn,
+    nên tổng dung lượng trên đĩa không vượt max_bytes dù có nhiều process cùng ghi.
+    """
+
+    def __init__(self, directory=None, max_mb=None, enabled=None, level=None):
+        self.directory = directory or EXTRACT_CACHE_DIR
+        self.max_bytes = int((EXTRACT_CACHE_MAX_MB if max_mb is None else max_mb) * 1024 * 1024)
+        self.enabled = EXTRACT_CACHE_ENABLED if enabled is None else enabled
+        self.level = EXTRACT_CACHE_LEVEL if level is None else level
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._size = None   # Tổng dung lượng ước lượng (tính khi cần dọn lần đầu)
+        self.evicting = True
+
+    @staticmethod
+    def key(content_hash, processor_tag):
+        return hashlib.sha256(f"{content_hash}\0{processor_tag}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.z")
+
+    def get(self, key, filepath):
+        """
+        TextStream đọc từ cache, metadata đầy đủ ngay từ đầu (file_name, file_size theo filepath hiện tại,
+        vì cùng nội dung có thể đến từ file khác tên). Trả về None nếu chưa có trong cache.
+        """
+        path = self._path(key)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            self.stats.add(misses=1)
+            return None
+        try:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(size - _TRAILER.size)
+            meta_size = _TRAILER.unpack(f.read(_TRAILER.size))[0]
+            data_size = size - _TRAILER.size - meta_size
+            f.seek(data_size)
+            metadata = json.loads(f.read(meta_size).decode("utf-8"))
+            # Đánh dấu mới dùng (LRU theo mtime)
+            os.utime(path)
+        except Exception as e:
+            f.close()
+            logging.warning(f"Mục extraction cache hỏng, bỏ qua: {path}: {e}")
+            self.stats.add(misses=1, errors=1)
+            self._remove(path)
+            return None
+        metadata.update(file_name=os.path.basename(filepath), file_size=os.path.getsize(filepath))
+        self.stats.add(hits=1)
+        return TextStream(metadata, self._iter_cached(f, data_size))
+
+    @staticmethod
+    def _iter_cached(f, data_size):
+        with f:
+            f.seek(0)
+            decompressor = zlib.decompressobj()
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            remaining = data_size
+            while remaining:
+                block = f.read(min(_READ_SIZE, remaining))
+                if not block:
+                    break
+                remaining -= len(block)
+                text = decoder.decode(decompressor.decompress(block))
+                if text:
+                    yield text
+            tail = decoder.decode(decompressor.flush(), final=True)
+            if tail:
+                yield tail
+
+    def record(self, key, stream):
+        """Bọc stream: segment được nén và ghi vào file tạm trong lúc đi qua, duyệt hết thì thành mục cache."""
+        return TextStream(stream.metadata, self._iter_recording(key, stream))
+
+    def _iter_recording(self, key, stream):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        f = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(tmp_path, "wb")
+        except OSError as e:
+            logging.warning(f"Không ghi được extraction cache {path}: {e}")
+            self.stats.add(errors=1)
+        compressor = zlib.compressobj(self.level)
+
+        done = False
+        try:
+            for segment in stream:
+                if f is not None:
+                    try:
+                        f.write(compressor.compress(segment.encode("utf-8")))
+                    except OSError as e:
+                        logging.warning(f"Không ghi được extraction cache {path}: {e}")
+                        self.stats.add(errors=1)
+                        f.close()
+                        self._remove(tmp_path)
+                        f = None
+                yield segment
+            if f is not None:
+                try:
+                    metadata = json.dumps(stream.metadata, ensure_ascii=False).encode("utf-8")
+                    f.write(compressor.flush())
+                    f.write(metadata)
+                    f.write(_TRAILER.pack(len(metadata)))
+                    f.close()
+                    os.replace(tmp_path, path)
+                    done = True
+                    size = os.path.getsize(path)
+                    self.stats.add(writes=1, bytes_written=size)
+                    if self.evicting:
+                        self.account(size)
+                except (OSError, TypeError, ValueError) as e:
+                    logging.warning(f"Không ghi được extraction cache {path}: {e}")
+                    self.stats.add(errors=1)
+        finally:
+            # Stream bị dừng giữa chừng (lỗi processor, bước sau dừng sớm): không để lại mục ghi dở
+            if f is not None and not done:
+                f.close()
+                self._remove(tmp_path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        """(mtime, size, path) của mọi mục cache."""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".z"):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+        return entries
+
+    def account(self, added):
+        """Cộng added byte vừa ghi vào dung lượng cache (kể cả do process khác ghi), vượt max_bytes thì dọn."""
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._entries())
+            else:
+                self._size += added
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Xóa các mục lâu không dùng nhất tới khi còn _EVICT_TARGET dung lượng tối đa (gọi khi giữ _lock)."""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * _EVICT_TARGET
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            self._remove(path)
+            total -= size
+            evicted += 1
+        self._size = total
+        if evicted:
+            self.stats.add(evictions=evicted)
+            logging.info(f"Extraction cache vượt {self.max_bytes // (1024 * 1024)}MB, đã xóa {evicted} mục cũ nhất.")
+
+    def clear(self):
+        for _, _, path in self._entries():
+            self._remove(path)
+        with self._lock:
+            self._size = 0
+
+# Cache dùng chung của pipeline (xem GET /extract-cache/stats)
+EXTRACT_CACHE = ExtractCache()
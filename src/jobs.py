@@ -0,0 +1,127 @@
+import os
+import logging
+import threading
+import admission
+from database import claim_next_job, fail_job
+from main import PROCESSORS, stream_chunk_sets, persist_stream, compute_file_hash, resolve_duplicate
+from chunker import parse_chunk_modes
+
+# Số thread worker xử lý job nền (0 = không chạy nền, dùng run_pending_jobs để xử lý thủ công)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Thời gian (giây) worker chờ giữa hai lần kiểm tra hàng đợi khi không có job mới
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1.0"))
+
+def run_job(job: dict) -> bool:
+    """
+    Xử lý một job đã được claim: (kiểm tra trùng) -> Extract -> Chunk -> Save DB.
+    job['chunk_mode'] có thể gồm nhiều mode phân cách bằng dấu phẩy: file được trích xuất một lần,
+    document có một bộ chunks cho mỗi mode (mode đầu tiên là bộ chính).
+    Job được đánh dấu done cùng transaction với việc ghi document, hoặc failed kèm lỗi.
+    Trả về True nếu thành công, False nếu thất bại.
+    """
+    filepath = job['file_path']
+    filename = os.path.basename(filepath)
+    ext = os.path.splitext(filename)[1].lower()
+
+    if ext not in PROCESSORS:
+        fail_job(job['id'], f"File không được hỗ trợ: {filename}")
+        return False
+
+    logging.info(f"[Job {job['id']}] Đang xử lý file: {filename} với chế độ chunking: {job['chunk_mode']}")
+    try:
+        chunk_modes = parse_chunk_modes(job['chunk_mode'])
+        # Kiểm tra lại trùng nội dung: các upload giống nhau có thể cùng nằm trong hàng đợi
+        content_hash = job.get('content_hash') or compute_file_hash(filepath)
+        # Tên gốc của document được chọn lúc upload; tên duy nhất được cấp khi lưu document
+        document_name = job.get('document_name') or filename
+        duplicate = resolve_duplicate(filepath, content_hash, chunk_modes,
+                                      job.get('dedup_policy'), job_id=job['id'], file_name=document_name)
+        if duplicate:
+            if duplicate[0] == 'skipped':
+                # File upload không được document nào tham chiếu
+                os.remove(filepath)
+            return True
+
+        # Chunks được tạo dần và ghi theo lô, không giữ toàn bộ file trong bộ nhớ
+        streamed = stream_chunk_sets(filepath, chunk_modes, content_hash=content_hash)
+        if not streamed:
+            fail_job(job['id'], "Không thể trích xuất nội dung (kết quả rỗng)")
+            return False
+
+        stream, chunk_sets = streamed
+        primary = chunk_sets.pop(chunk_modes[0])
+        persist_stream(filepath, ext, stream.metadata, primary, chunk_mode=chunk_modes[0],
+                       job_id=job['id'], content_hash=content_hash, file_name=document_name,
+                       extra_chunk_sets=chunk_sets)
+        return True
+    except Exception as e:
+        logging.error(f"[Job {job['id']}] Lỗi khi xử lý {filename}: {e}", exc_info=True)
+        fail_job(job['id'], str(e))
+        return False
+
+def run_pending_jobs(limit: int = None) -> int:
+    """
+    Xử lý tuần tự các job đang chờ ngay trong thread hiện tại (dùng cho CLI và test).
+    Trả về: số job đã xử lý
+    """
+    processed = 0
+    while limit is None or processed < limit:
+        job = claim_next_job()
+        if job is None:
+            break
+        run_job(job)
+        admission.INGEST.finish(job['id'])
+        processed += 1
+    return processed
+
+class JobWorkerPool:
+    """
+    Nhóm thread nền lấy job từ bảng jobs và xử lý.
+    Hàng đợi nằm trong database nên job còn nguyên sau khi server khởi động lại.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def start(self):
+        """Khởi động các thread worker."""
+        self._stopping.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        if self.workers:
+            logging.info(f"Đã khởi động {self.workers} job worker.")
+
+    def notify(self):
+        """Đánh thức worker ngay khi có job mới thay vì đợi hết poll_interval."""
+        self._wakeup.set()
+
+    def stop(self, timeout: float = None):
+        """Dừng worker sau khi job đang chạy hoàn tất."""
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                job = claim_next_job()
+            except Exception as e:
+                logging.error(f"Lỗi khi lấy job từ hàng đợi: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+
+            run_job(job)
+            # Trả lại phần ngân sách upload mà file của job đang giữ (xem admission.py)
+            admission.INGEST.finish(job['id'])
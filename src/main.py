@@ -1,12 +1,26 @@
 import os
 import sys
+import queue
+import json
+import hashlib
 import logging
-import logging
-from database import init_database, save_document, save_chunks, get_unique_filename
-from processors.txt_processor import process_txt
-from processors.pdf_processor import process_pdf
-from processors.docx_processor import process_docx
-from chunker import chunk_text
+import tempfile
+import argparse
+import threading
+import multiprocessing
+from bisect import bisect_right
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
+import database
+from database import (
+    init_database, save_document_with_chunks,
+    find_document_by_hash, link_document, complete_job, get_document, replace_chunk_sets
+)
+from processors.registry import REGISTRY
+from processors.stream import TextSpool
+import chunk_store
+import extract_cache
+from chunker import chunk_text_iter, chunk_text_offsets_iter, CHUNK_MODES
 
 # Cấu hình logging với UTF-8 encoding (hỗ trợ tiếng Việt trên Windows)
 logging.basicConfig(
@@ -21,108 +35,550 @@ logging.basicConfig(
 if sys.stdout.encoding != 'utf-8':
     sys.stdout.reconfigure(encoding='utf-8')
 
-# Ánh xạ đuôi file với processor tương ứng
-PROCESSORS = {
-    '.txt': process_txt,
-    '.pdf': process_pdf,
-    '.docx': process_docx
-}
+# Ánh xạ đuôi file với processor tương ứng (trả về dict content + metadata).
+# Processor (và PyPDF2 / python-docx / chardet) chỉ được import khi gặp file đuôi đó lần đầu,
+# processor bên thứ ba được nạp qua entry point (xem processors/registry.py).
+PROCESSORS = REGISTRY.processors
+
+# Processor dạng streaming (trả về TextStream, xem processors/stream.py), dùng cho pipeline chính
+STREAM_PROCESSORS = REGISTRY.stream_processors
+
+# Chính sách khi gặp file trùng nội dung (cùng SHA-256 và cùng chunk_mode) với document đã có:
+# - skip: bỏ qua, không tạo document mới
+# - link: tạo document mới, sao chép chunks từ document đã có (không trích xuất lại)
+# - reprocess: xử lý lại như file mới
+DEDUP_POLICIES = ('skip', 'link', 'reprocess')
+DEDUP_POLICY = os.getenv("DEDUP_POLICY", "skip")
+
+# Kích thước mỗi lần đọc khi tính hash (1MB)
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Sentinel báo cho thread writer dừng lại
+_STOP = object()
+
+def compute_file_hash(filepath):
+    """Tính SHA-256 của file theo từng khối (không đọc toàn bộ file vào bộ nhớ)."""
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def resolve_duplicate(filepath, content_hash, chunk_mode="sentence", policy=None, job_id=None, file_name=None):
+    """
+    Áp dụng chính sách trùng nội dung TRƯỚC khi chạy processor.
+    chunk_mode: một chunk mode hoặc list (document trùng phải có đủ các bộ chunks đó).
+    file_name: tên gốc của document khi link (vd: tên chọn lúc upload, mặc định tên file); tên duy nhất
+               được cấp khi document được thêm.
+    Trả về: None nếu file cần được xử lý bình thường,
+            ngược lại (action, document_id) với action là 'skipped' hoặc 'linked'.
+    """
+    policy = policy or DEDUP_POLICY
+    if policy == 'reprocess' or not content_hash:
+        return None
+
+    existing_id = find_document_by_hash(content_hash, chunk_mode)
+    if existing_id is None:
+        return None
+
+    filename = os.path.basename(filepath)
+    if policy == 'skip':
+        logging.info(f"Bỏ qua {filename}: trùng nội dung với document {existing_id}.")
+        if job_id is not None:
+            complete_job(job_id, existing_id)
+        return ('skipped', existing_id)
+
+    # policy == 'link'
+    file_info = {
+        'file_name': file_name or filename,
+        'file_path': filepath,
+        'file_type': os.path.splitext(filename)[1].lower(),
+        'file_size': os.path.getsize(filepath)
+    }
+    doc_id = link_document(existing_id, file_info, job_id=job_id)
+    logging.info(f"{filename} trùng nội dung với document {existing_id}. Đã liên kết thành document {doc_id}.")
+    return ('linked', doc_id)
+
+def _iter_chunk_dicts(stream, chunk_mode):
+    """Chunk nội dung của stream; processor có ghi offset từng trang (PDF) -> kèm page_number."""
+    page_offsets = stream.metadata.get('page_offsets')
+    if page_offsets is None:
+        located = ((None, content) for content in chunk_text_iter(stream, mode=chunk_mode))
+    else:
+        # page_offsets được processor bổ sung dần, luôn đã có trang chứa phần đầu chunk
+        located = chunk_text_offsets_iter(stream, mode=chunk_mode)
+
+    for i, (offset, content) in enumerate(located):
+        chunk = {
+            'chunk_index': i,
+            'content': content,
+            'char_count': len(content)
+        }
+        if page_offsets is not None:
+            chunk['page_number'] = bisect_right(page_offsets, offset) if offset is not None else None
+        yield chunk
+
+def _open_stream(filepath, ext, content_hash=None):
+    """
+    TextStream của processor cho filepath, qua extraction cache nếu bật (extract_cache.EXTRACT_CACHE):
+    cache hit thì không chạy processor; miss thì text được ghi vào cache trong lúc stream được duyệt.
+    """
+    cache = extract_cache.EXTRACT_CACHE
+    tag = REGISTRY.cache_tag(ext) if cache.enabled else None
+    if tag is None:
+        return STREAM_PROCESSORS[ext](filepath)
+    key = cache.key(content_hash or compute_file_hash(filepath), tag)
+    cached = cache.get(key, filepath)
+    if cached is not None:
+        return cached
+    return cache.record(key, STREAM_PROCESSORS[ext](filepath))
+
+def stream_file(filepath, chunk_mode="sentence", content_hash=None):
+    """
+    Giai đoạn Extract -> Chunk dạng streaming (không đụng tới database).
+    Processor trả text theo từng segment, chunker nhận dần và trả chunk ngay khi đủ,
+    nên bộ nhớ chỉ gồm segment hiện tại và chunk đang build, không phụ thuộc kích thước file.
+    Trả về (stream, chunks): stream là TextStream của processor (metadata được bổ sung trong lúc đọc),
+    chunks là iterator dict chunk (chunk_index, content, char_count, page_number nếu có) - chỉ duyệt được một lần;
+    hoặc None nếu processor bỏ qua file (vd: PDF scan). Chunk đầu tiên được đọc trước để biết điều này
+    trước khi ghi gì vào database.
+    content_hash: SHA-256 của file (nếu đã tính) cho extraction cache.
+    """
+    ext = os.path.splitext(filepath)[1].lower()
+    return _chunk_stream(_open_stream(filepath, ext, content_hash), chunk_mode)
+
+def _chunk_stream(stream, chunk_mode):
+    chunks = _iter_chunk_dicts(stream, chunk_mode)
+
+    first = next(chunks, None)
+    if first is None:
+        if stream.metadata.get('skipped'):
+            return None
+        return stream, iter(())
+    return stream, chain([first], chunks)
+
+def stream_chunk_sets(filepath, chunk_modes, content_hash=None):
+    """
+    Giống stream_file nhưng trích xuất một lần cho nhiều chunk mode (list, mode đầu tiên là bộ chính).
+    Bộ chunks đầu tiên được chunk trực tiếp từ processor, text đồng thời được ghi ra file tạm (TextSpool)
+    để các bộ sau chunk lại mà không chạy lại processor; bộ nhớ vẫn không phụ thuộc kích thước file.
+    Trả về (stream, chunk_sets): chunk_sets là dict chunk_mode -> iterator dict chunk theo thứ tự chunk_modes,
+    phải được duyệt lần lượt theo thứ tự đó; hoặc None nếu processor bỏ qua file.
+    """
+    first, *others = chunk_modes
+    ext = os.path.splitext(filepath)[1].lower()
+    source = _open_stream(filepath, ext, content_hash)
+    spool = TextSpool(source) if others else None
+
+    streamed = _chunk_stream(spool.stream if spool else source, first)
+    if streamed is None:
+        if spool:
+            spool.close()
+        return None
+    stream, chunks = streamed
+    chunk_sets = {first: chunks}
+    for i, chunk_mode in enumerate(others):
+        chunk_sets[chunk_mode] = _replay_chunks(spool, chunk_mode, last=i == len(others) - 1)
+    return stream, chunk_sets
 
-def process_file(filepath, chunk_mode="sentence"):
+def _replay_chunks(spool, chunk_mode, last):
+    try:
+        yield from _iter_chunk_dicts(spool.replay(), chunk_mode)
+    finally:
+        if last:
+            spool.close()
+
+def extract_file(filepath, chunk_mode="sentence", content_hash=None):
+    """
+    Giai đoạn CPU-bound: Extract -> Chunk (không đụng tới database), giữ toàn bộ kết quả trong bộ nhớ.
+    Hàm ở cấp module để có thể chạy trong process con của ProcessPoolExecutor.
+    Trả về dict gồm file_type, metadata, chunks, pages, cache_stats; hoặc None nếu không trích xuất được nội dung.
+    pages: số trang (bắt đầu từ 1) chứa phần đầu của từng chunk, None nếu processor không có thông tin trang.
+    cache_stats: thay đổi thống kê extraction cache trong lần gọi này (để process chính cộng lại).
+    """
+    stats_before = extract_cache.EXTRACT_CACHE.stats.snapshot()
+    streamed = stream_file(filepath, chunk_mode=chunk_mode, content_hash=content_hash)
+    if streamed is None:
+        return None
+
+    stream, chunks = streamed
+    chunks_data = list(chunks)
+    metadata = stream.metadata
+    has_pages = metadata.pop('page_offsets', None) is not None
+    stats_after = extract_cache.EXTRACT_CACHE.stats.snapshot()
+    return {
+        'file_type': os.path.splitext(filepath)[1].lower(),
+        'metadata': metadata,
+        'chunks': [chunk['content'] for chunk in chunks_data],
+        'pages': [chunk['page_number'] for chunk in chunks_data] if has_pages else None,
+        'cache_stats': {name: stats_after[name] - stats_before[name] for name in stats_after}
+    }
+
+def _chunks_dir(filepath, unique_filename, chunk_mode):
+    """
+    Đường dẫn gốc của chunks vật lý: tenfile_duoifile_mode_chunks (ví dụ: test_ocr_txt_sentence_chunks),
+    là thư mục chunk_<i>.txt (định dạng files) hoặc tiền tố của file .pack/.idx (định dạng packed).
+    Input ở folder nào thì chunks_data sẽ nằm ngang hàng với folder đó.
+    Ví dụ: input_docs/file.txt -> chunks_data/file_txt_mode_chunks
+    """
+    clean_filename = unique_filename.replace('.', '_')
+    parent_dir = os.path.dirname(filepath) # Folder chứa file
+    root_dir = os.path.dirname(parent_dir) # Folder cha của folder chứa file
+    return os.path.join(root_dir, "chunks_data", f"{clean_filename}_{chunk_mode}_chunks")
+
+class _ChunkSpool:
+    """
+    Duyệt hết iterator dict chunk (trích xuất, chunk, OCR... chạy tại đây) và ghi ra file tạm dạng JSON lines,
+    để bước ghi DB chỉ đọc lại từ file: transaction không mở trong lúc trích xuất, bộ nhớ vẫn không phụ
+    thuộc kích thước file. Duyệt lại (iter) được nhiều lần; gọi close() khi xong.
+    """
+
+    def __init__(self, chunks):
+        self._file = tempfile.TemporaryFile(mode="w+", encoding="utf-8")
+        self.count = 0
+        try:
+            for chunk in chunks:
+                self._file.write(json.dumps(chunk, ensure_ascii=False))
+                self._file.write("\n")
+                self.count += 1
+        except BaseException:
+            self._file.close()
+            raise
+
+    def __iter__(self):
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+
+    def close(self):
+        self._file.close()
+
+def _spool_chunk_sets(chunk_sets):
+    """_ChunkSpool cho từng bộ chunks theo đúng thứ tự (xem stream_chunk_sets); lỗi thì đóng các spool đã tạo."""
+    spools = {}
+    try:
+        for mode, chunks in chunk_sets.items():
+            spools[mode] = _ChunkSpool(chunks)
+    except BaseException:
+        for spool in spools.values():
+            spool.close()
+        raise
+    return spools
+
+def _queue_chunk_files(chunks, artifact):
+    """Đưa từng chunk vào artifact ghi nền (chunk_store.WRITE_BEHIND) khi chunk đi qua bước ghi DB."""
+    for chunk in chunks:
+        artifact.write(chunk['content'])
+        yield chunk
+
+def persist_stream(filepath, file_type, metadata, chunks, chunk_mode="sentence", job_id=None,
+                   content_hash=None, file_name=None, chunk_count=None, chunk_format=None, extra_chunk_sets=None,
+                   spool=True):
     """
-    Xử lý một file cụ thể: Extract -> Chunk -> Save DB.
-    Trả về True nếu thành công, False nếu thất bại.
+    Giai đoạn I/O-bound dạng streaming: Save DB + ghi file chunks vật lý.
+    chunks: iterator dict chunk (xem stream_file). Chunks được duyệt hết ra file tạm (_ChunkSpool) TRƯỚC khi
+    mở transaction, nên trích xuất / OCR không giữ transaction và lock của việc cấp tên document; sau đó được
+    ghi vào DB theo lô (CHUNK_BATCH_SIZE), bộ nhớ chỉ cỡ một lô chunks. Document và chunks được ghi trong
+    cùng một transaction ngắn (all-or-nothing).
+    Chunks vật lý được ghi nền (chunk_store.WRITE_BEHIND): thời gian xử lý chỉ gồm việc ghi DB,
+    artifact được hoàn tất sau khi DB commit thành công, hoặc bị bỏ nếu ghi DB lỗi.
+    Lỗi ghi chunks vật lý chỉ được log và đếm (GET /artifacts/stats), không làm hỏng document đã lưu.
+    job_id: job nền tương ứng (nếu có), được đánh dấu done trong cùng transaction.
+    content_hash: SHA-256 của file gốc, lưu vào document để phát hiện trùng lặp.
+    file_name: tên gốc của document (vd: tên chọn lúc upload, mặc định tên file); tên duy nhất được cấp
+               khi document được thêm, cùng transaction (xem database._add_document).
+    chunk_count: số chunks (nếu đã biết); mặc định đếm trong lúc ghi.
+    chunk_format: định dạng lưu chunks vật lý (files / packed, mặc định chunk_store.CHUNK_FORMAT).
+    extra_chunk_sets: dict chunk_mode -> iterator dict chunk của các bộ chunks bổ sung (xem stream_chunk_sets),
+                      ghi cùng transaction với document, mỗi bộ một artifact chunks vật lý riêng.
+    spool: False nếu chunks đã nằm sẵn trong bộ nhớ (vd: persist_file), duyệt thẳng trong transaction.
+    Trả về id của document vừa tạo.
+    """
+    filename = os.path.basename(filepath)
+    base_name = file_name or filename
+
+    chunk_sets = {chunk_mode: chunks, **(extra_chunk_sets or {})}
+    spools = _spool_chunk_sets(chunk_sets) if spool else {}
+    chunk_sets.update(spools)
+
+    # Chuẩn bị metadata document (đã đầy đủ sau khi stream được duyệt hết)
+    file_info = {
+        'file_name': base_name,
+        'file_path': filepath,
+        'file_type': file_type,
+        'file_size': metadata.get('file_size'),
+        'content_hash': content_hash,
+        'chunk_mode': chunk_mode
+    }
+    if chunk_count is not None:
+        file_info['chunk_count'] = chunk_count
+
+    artifacts = {}
+    def queued(mode, mode_chunks):
+        # Chạy khi save_document_with_chunks bắt đầu đọc chunks: document đã được cấp tên (file_info)
+        artifacts[mode] = chunk_store.WRITE_BEHIND.open(_chunks_dir(filepath, file_info['file_name'], mode), chunk_format)
+        yield from _queue_chunk_files(mode_chunks, artifacts[mode])
+
+    try:
+        # Lưu document + chunks vào database, chunks được chép sang hàng đợi ghi file vật lý khi đi qua
+        extra = {mode: queued(mode, sets) for mode, sets in chunk_sets.items() if mode != chunk_mode}
+        doc_id = save_document_with_chunks(file_info, queued(chunk_mode, chunk_sets[chunk_mode]), job_id=job_id,
+                                           extra_chunk_sets=extra)
+    except Exception:
+        for artifact in artifacts.values():
+            artifact.abort()
+        raise
+    finally:
+        for chunk_spool in spools.values():
+            chunk_spool.close()
+    for artifact in artifacts.values():
+        artifact.commit()
+    if file_info['file_name'] != base_name:
+        logging.info(f"Phát hiện trùng tên. Đổi tên từ {base_name} thành {file_info['file_name']}")
+
+    logging.info(f"Xử lý thành công {filename}. Đã lưu document {doc_id} và chunks vào DB.")
+    return doc_id
+
+def persist_file(filepath, extracted, chunk_mode="sentence", job_id=None, content_hash=None, file_name=None):
+    """
+    Giai đoạn I/O-bound cho kết quả của extract_file (xem persist_stream).
+    Trả về id của document vừa tạo.
+    """
+    chunks_text = extracted['chunks']
+    pages = extracted.get('pages')
+
+    def chunks():
+        for i, chunk_content in enumerate(chunks_text):
+            chunk = {
+                'chunk_index': i,
+                'content': chunk_content,
+                'char_count': len(chunk_content)
+            }
+            if pages:
+                chunk['page_number'] = pages[i]
+            yield chunk
+
+    return persist_stream(filepath, extracted['file_type'], extracted['metadata'], chunks(),
+                          chunk_mode=chunk_mode, job_id=job_id, content_hash=content_hash,
+                          file_name=file_name, chunk_count=len(chunks_text), spool=False)
+
+def ingest_file(filepath, chunk_mode="sentence", dedup_policy=None, content_hash=None):
+    """
+    Xử lý một file cụ thể: Hash -> (kiểm tra trùng) -> Extract -> Chunk -> Save DB (streaming, xem stream_file).
+    dedup_policy: skip | link | reprocess (mặc định DEDUP_POLICY)
+    content_hash: hash đã tính sẵn (nếu có) để không phải đọc file thêm lần nữa
+    Trả về (kết quả, document_id, created): kết quả là True nếu thành công, False nếu thất bại, None nếu bỏ qua;
+    document_id là document chứa nội dung file (kể cả document đã có khi bỏ qua vì trùng);
+    created là True nếu document được tạo bằng cách xử lý chính file này (không phải skip / link).
     """
     filename = os.path.basename(filepath)
     ext = os.path.splitext(filename)[1].lower()
     
     if ext not in PROCESSORS:
         logging.warning(f"Bỏ qua file không được hỗ trợ: {filename}")
-        return None  # None = bỏ qua, không phải thất bại
-
-    # Tạo tên file duy nhất nếu trùng tên
-    unique_filename = get_unique_filename(filename)
-    if unique_filename != filename:
-        logging.info(f"Phát hiện trùng tên. Đổi tên từ {filename} thành {unique_filename}")
+        return None, None, False  # None = bỏ qua, không phải thất bại
 
     logging.info(f"Đang xử lý file: {filename} với chế độ chunking: {chunk_mode}")
     
     try:
-        processor = PROCESSORS[ext]
-        result = processor(filepath)
+        content_hash = content_hash or compute_file_hash(filepath)
+        duplicate = resolve_duplicate(filepath, content_hash, chunk_mode, dedup_policy)
+        if duplicate:
+            action, doc_id = duplicate
+            return (None if action == 'skipped' else True), doc_id, False
+
+        streamed = stream_file(filepath, chunk_mode=chunk_mode, content_hash=content_hash)
 
-        if not result:
+        if not streamed:
             logging.warning(f"Không thể trích xuất nội dung từ {filename} (kết quả rỗng).")
-            return False
-
-        content = result['content']
-        metadata = result['metadata']
-        
-        # Chia nhỏ nội dung
-        chunks_text = chunk_text(content, mode=chunk_mode)
-        
-        # Chuẩn bị metadata document
-        file_info = {
-            'file_name': unique_filename,
-            'file_path': filepath,
-            'file_type': ext,
-            'file_size': metadata.get('file_size'),
-            'chunk_count': len(chunks_text)
-        }
-        
-        # Lưu document
-        doc_id = save_document(file_info)
-        
-        # Chuẩn bị dữ liệu chunks
-        chunks_data = []
-        for i, chunk_content in enumerate(chunks_text):
-            chunks_data.append({
-                'chunk_index': i,
-                'content': chunk_content,
-                'char_count': len(chunk_content)
-            })
-        
-        # Lưu chunks
-        # Lưu chunks vào database
-        save_chunks(doc_id, chunks_data)
-        
-        # Lưu chunks ra file vật lý
-        try:
-            # Tạo tên thư mục: tenfile_duoifile_chunks (ví dụ: test_ocr_txt_chunks)
-            clean_filename = unique_filename.replace('.', '_')
-            
-            # Logic: Input ở folder nào thì chunks_data sẽ nằm ngang hàng với folder đó
-            # Ví dụ: input_docs/file.txt -> chunks_data/file_txt_mode_chunks
-            parent_dir = os.path.dirname(filepath) # Folder chứa file
-            root_dir = os.path.dirname(parent_dir) # Folder cha của folder chứa file
-            chunks_base_dir = os.path.join(root_dir, "chunks_data")
-            
-            chunks_dir = os.path.join(chunks_base_dir, f"{clean_filename}_{chunk_mode}_chunks")
-            
-            if not os.path.exists(chunks_dir):
-                os.makedirs(chunks_dir)
-                
-            for i, chunk_content in enumerate(chunks_text):
-                chunk_filename = f"chunk_{i}.txt"
-                chunk_path = os.path.join(chunks_dir, chunk_filename)
-                with open(chunk_path, "w", encoding="utf-8") as f:
-                    f.write(chunk_content)
-            
-            logging.info(f"Đã lưu {len(chunks_text)} file chunks vào thư mục: {chunks_dir}")
-            
-        except Exception as e:
-            logging.error(f"Lỗi khi lưu file chunks vật lý: {e}")
+            return False, None, False
 
-        logging.info(f"Xử lý thành công {filename}. Đã lưu {len(chunks_data)} chunks vào DB.")
-        return True
+        stream, chunks = streamed
+        doc_id = persist_stream(filepath, ext, stream.metadata, chunks, chunk_mode=chunk_mode,
+                                content_hash=content_hash)
+        return True, doc_id, True
             
     except Exception as e:
         logging.error(f"Lỗi khi xử lý {filename}: {e}", exc_info=True)
-        return False
+        return False, None, False
 
-def process_directory(directory_path):
+def process_file(filepath, chunk_mode="sentence", dedup_policy=None):
+    """
+    Xử lý một file cụ thể: Extract -> Chunk -> Save DB (xem ingest_file).
+    Trả về True nếu thành công, False nếu thất bại, None nếu bỏ qua.
+    """
+    return ingest_file(filepath, chunk_mode=chunk_mode, dedup_policy=dedup_policy)[0]
+
+def rechunk_document(document_id, chunk_modes):
+    """
+    Tạo lại hoặc bổ sung các bộ chunks của document đã có từ file gốc, trích xuất một lần cho mọi
+    chunk mode (xem stream_chunk_sets; thường là cache hit của extraction cache).
+    Bộ chunks đã có của mode đó được thay thế trong cùng transaction, chunks vật lý được ghi lại.
+    Trả về dict chunk_mode -> số chunks, hoặc None nếu không tìm thấy document.
+    Raise FileNotFoundError nếu file gốc không còn, ValueError nếu không trích xuất được nội dung.
+    """
+    document = get_document(document_id)
+    if document is None:
+        return None
+    filepath = document.file_path
+    ext = os.path.splitext(filepath)[1].lower()
+    if ext not in PROCESSORS:
+        raise ValueError(f"File không được hỗ trợ: {os.path.basename(filepath)}")
+    if not os.path.isfile(filepath):
+        raise FileNotFoundError(f"Không còn file gốc của document {document_id}: {filepath}")
+
+    logging.info(f"Chunk lại document {document_id} ({document.file_name}) với chế độ: {', '.join(chunk_modes)}")
+    streamed = stream_chunk_sets(filepath, chunk_modes, document.content_hash)
+    if not streamed:
+        raise ValueError(f"Không thể trích xuất nội dung từ {os.path.basename(filepath)}")
+
+    # Chunk xong trước khi mở transaction thay thế bộ chunks (xem persist_stream)
+    spools = _spool_chunk_sets(streamed[1])
+    artifacts = {}
+    for chunk_mode in chunk_modes:
+        # Chunks mới được ghi ra chỗ tạm, chunks vật lý cũ chỉ bị thay sau khi DB commit
+        artifacts[chunk_mode] = chunk_store.WRITE_BEHIND.open(
+            _chunks_dir(filepath, document.file_name, chunk_mode), replace=True)
+    try:
+        counts = replace_chunk_sets(document_id, {
+            mode: _queue_chunk_files(chunks, artifacts[mode]) for mode, chunks in spools.items()
+        })
+    except Exception:
+        for artifact in artifacts.values():
+            artifact.abort()
+        raise
+    finally:
+        for spool in spools.values():
+            spool.close()
+    for artifact in artifacts.values():
+        artifact.commit()
+    return counts
+
+def _iter_files(directory_path):
+    """Duyệt đệ quy và trả về đường dẫn của từng file trong thư mục."""
+    for root, _, files in os.walk(directory_path):
+        for file in files:
+            yield os.path.join(root, file)
+
+def _init_extract_worker():
+    """
+    Khởi tạo process con của pipeline: không dùng lại kết nối database nào của process cha;
+    extraction cache chỉ được dọn ở process chính (writer cộng số byte process con đã ghi).
+    """
+    database.engine.dispose(close=False)
+    extract_cache.EXTRACT_CACHE.evicting = False
+
+def run_staged(filepaths, workers, chunk_mode="sentence", dedup_policy=None, on_done=None, hashes=None, queue_size=None):
+    """
+    Chế độ pipeline nhiều giai đoạn cho một danh sách file:
+    - Process pool (workers process) chạy extract + chunk (CPU-bound)
+    - Một thread writer duy nhất ghi DB + file chunks (I/O-bound), nhận kết quả qua queue có giới hạn
+    Queue có giới hạn tạo backpressure: khi writer chậm, việc submit file mới sẽ bị chặn lại
+    thay vì giữ kết quả của cả thư mục trong bộ nhớ.
+    Writer xử lý theo đúng thứ tự duyệt file nên việc đổi tên trùng giống hệt chế độ tuần tự.
+    File trùng nội dung (với DB hoặc với file trước đó trong batch) không được gửi sang process pool.
+    on_done(filepath, content_hash, document_id, created): gọi từ thread writer khi file đã có document tương ứng
+    (created: document được tạo bằng cách xử lý chính file đó, không phải skip / link tới document đã có).
+    hashes: dict filepath -> hash đã tính sẵn (nếu có)
+    Trả về: dict đếm success/fail/skip
+    """
+    policy = dedup_policy or DEDUP_POLICY
+    queue_size = queue_size or workers * 2
+    write_queue = queue.Queue(maxsize=queue_size)
+    counters = {'success': 0, 'fail': 0, 'skip': 0}
+    counters_lock = threading.Lock()
+    seen_hashes = set()
+
+    def count(key):
+        with counters_lock:
+            counters[key] += 1
+
+    def writer():
+        while True:
+            item = write_queue.get()
+            if item is _STOP:
+                break
+            filepath, content_hash, future = item
+            filename = os.path.basename(filepath)
+            try:
+                if future is None:
+                    # Trùng nội dung: bản gốc (nếu trong cùng batch) đã được ghi trước đó
+                    duplicate = resolve_duplicate(filepath, content_hash, chunk_mode, policy)
+                    if duplicate:
+                        count('skip' if duplicate[0] == 'skipped' else 'success')
+                        if on_done:
+                            on_done(filepath, content_hash, duplicate[1], False)
+                        continue
+                    # Bản gốc xử lý thất bại -> tự trích xuất file này
+                    extracted = extract_file(filepath, chunk_mode, content_hash)
+                else:
+                    extracted = future.result()
+                    if extracted:
+                        # Thống kê extraction cache của process con
+                        extract_cache.EXTRACT_CACHE.stats.add(**extracted['cache_stats'])
+                        if extracted['cache_stats']['bytes_written']:
+                            extract_cache.EXTRACT_CACHE.account(extracted['cache_stats']['bytes_written'])
+
+                if not extracted:
+                    logging.warning(f"Không thể trích xuất nội dung từ {filename} (kết quả rỗng).")
+                    count('fail')
+                    continue
+                doc_id = persist_file(filepath, extracted, chunk_mode=chunk_mode, content_hash=content_hash)
+                count('success')
+                if on_done:
+                    on_done(filepath, content_hash, doc_id, True)
+            except Exception as e:
+                logging.error(f"Lỗi khi xử lý {filename}: {e}", exc_info=True)
+                count('fail')
+
+    writer_thread = threading.Thread(target=writer, name="db-writer", daemon=True)
+    writer_thread.start()
+
+    try:
+        # spawn: process con khởi động sạch, không fork process đang có thread writer và kết nối DB mở
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_extract_worker) as pool:
+            for filepath in filepaths:
+                filename = os.path.basename(filepath)
+                ext = os.path.splitext(filepath)[1].lower()
+                if ext not in PROCESSORS:
+                    logging.warning(f"Bỏ qua file không được hỗ trợ: {filename}")
+                    count('skip')
+                    continue
+
+                try:
+                    content_hash = (hashes or {}).get(filepath) or compute_file_hash(filepath)
+                    is_duplicate = policy != 'reprocess' and (
+                        content_hash in seen_hashes
+                        or find_document_by_hash(content_hash, chunk_mode) is not None
+                    )
+                except Exception as e:
+                    logging.error(f"Lỗi khi xử lý {filename}: {e}", exc_info=True)
+                    count('fail')
+                    continue
+
+                if is_duplicate:
+                    # Không cần trích xuất, writer sẽ áp dụng chính sách trùng theo đúng thứ tự
+                    write_queue.put((filepath, content_hash, None))
+                    continue
+                seen_hashes.add(content_hash)
+
+                logging.info(f"Đang xử lý file: {filename} với chế độ chunking: {chunk_mode}")
+                future = pool.submit(extract_file, filepath, chunk_mode, content_hash)
+                # put() chặn khi queue đầy -> giới hạn số file đang xử lý dở
+                write_queue.put((filepath, content_hash, future))
+    finally:
+        write_queue.put(_STOP)
+        writer_thread.join()
+
+    return counters
+
+def process_directory(directory_path, workers=1, chunk_mode="sentence", dedup_policy=None):
     """
     Duyệt và xử lý toàn bộ file trong thư mục.
+    workers > 1: dùng pipeline nhiều giai đoạn (process pool + DB writer), xem run_staged.
+    dedup_policy: chính sách với file trùng nội dung (skip | link | reprocess)
+    Trả về: dict đếm success/fail/skip (None nếu không khởi tạo được)
     """
     # Khởi tạo database
     try:
@@ -138,30 +594,78 @@ def process_directory(directory_path):
 
     logging.info(f"Đang quét thư mục: {directory_path}")
     
-    count_success = 0
-    count_fail = 0
-    count_skip = 0
-    
-    for root, _, files in os.walk(directory_path):
-        for file in files:
-            filepath = os.path.join(root, file)
-            result = process_file(filepath)
+    if workers > 1:
+        logging.info(f"Chạy pipeline song song với {workers} workers.")
+        counters = run_staged(_iter_files(directory_path), workers, chunk_mode=chunk_mode, dedup_policy=dedup_policy)
+    else:
+        counters = {'success': 0, 'fail': 0, 'skip': 0}
+        for filepath in _iter_files(directory_path):
+            result = process_file(filepath, chunk_mode=chunk_mode, dedup_policy=dedup_policy)
             if result is True:
-                count_success += 1
+                counters['success'] += 1
             elif result is False:
-                count_fail += 1
+                counters['fail'] += 1
             else:  # result is None -> bỏ qua
-                count_skip += 1
+                counters['skip'] += 1
                 
-    logging.info(f"Hoàn thành xử lý batch. Thành công: {count_success}, Thất bại: {count_fail}, Bỏ qua: {count_skip}")
+    logging.info(f"Hoàn thành xử lý batch. Thành công: {counters['success']}, Thất bại: {counters['fail']}, Bỏ qua: {counters['skip']}")
+    cache = extract_cache.EXTRACT_CACHE
+    if cache.enabled:
+        stats = cache.stats.as_dict()
+        logging.info(f"Extraction cache: {stats['hits']} hit, {stats['misses']} miss, {stats['writes']} mục mới, {stats['evictions']} mục bị dọn.")
+    return counters
+
+def parse_args(argv=None):
+    """Đọc tham số dòng lệnh."""
+    parser = argparse.ArgumentParser(description="OCR Pipeline - xử lý batch tài liệu trong thư mục.")
+    parser.add_argument("directory", nargs="?", default="input_docs",
+                        help="Thư mục chứa file đầu vào (mặc định: input_docs)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Số process trích xuất song song (1 = tuần tự như cũ)")
+    parser.add_argument("--chunk-mode", default="sentence", choices=CHUNK_MODES,
+                        help="Chế độ chunking (mặc định: sentence). token/sliding: theo số token, "
+                             "cấu hình qua CHUNK_TOKEN_BUDGET và CHUNK_TOKEN_OVERLAP")
+    parser.add_argument("--dedup", default=DEDUP_POLICY, choices=DEDUP_POLICIES,
+                        help=f"Chính sách với file trùng nội dung (mặc định: {DEDUP_POLICY})")
+    parser.add_argument("--sync", action="store_true",
+                        help="Chỉ ingest file mới hoặc đã thay đổi so với lần chạy trước (dựa trên manifest)")
+    parser.add_argument("--retire", action="store_true",
+                        help="Khi sync/watch: xóa document có file nguồn đã bị xóa hoặc bị thay thế")
+    parser.add_argument("--watch", action="store_true",
+                        help="Sync rồi tiếp tục theo dõi thư mục, ingest file ngay khi xuất hiện")
+    parser.add_argument("--chunk-format", default=chunk_store.CHUNK_FORMAT, choices=chunk_store.CHUNK_FORMATS,
+                        help="Định dạng lưu chunks vật lý: files (mỗi chunk một file) hoặc packed "
+                             f"(mỗi document một file .pack + .idx) (mặc định: {chunk_store.CHUNK_FORMAT})")
+    parser.add_argument("--list-processors", action="store_true",
+                        help="Liệt kê processor theo đuôi file (có sẵn và từ entry point) rồi thoát")
+    return parser.parse_args(argv)
+
+def list_processors():
+    """In danh sách processor: đuôi file, hàm stream, nguồn (builtin / package cài qua entry point)."""
+    rows = REGISTRY.describe()
+    print(f"{'Đuôi':<8} {'Processor':<45} Nguồn")
+    for ext, target, source, _ in rows:
+        print(f"{ext:<8} {target:<45} {source}")
+    return rows
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        target_dir = sys.argv[1]
-    else:
-        target_dir = "input_docs"  # Thư mục mặc định
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-            logging.info(f"Đã tạo thư mục đầu vào mặc định: {target_dir}")
+    args = parse_args()
+    if args.list_processors:
+        list_processors()
+        sys.exit(0)
+    # Định dạng chunks là cấu hình lưu trữ chung (như CHUNK_FORMAT) cho mọi đường ghi: tuần tự, song song, sync
+    chunk_store.CHUNK_FORMAT = args.chunk_format
+    target_dir = args.directory
+    if target_dir == "input_docs" and not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+        logging.info(f"Đã tạo thư mục đầu vào mặc định: {target_dir}")
     
-    process_directory(target_dir)
+    if args.watch or args.sync:
+        from sync import sync_directory, watch_directory
+        run = watch_directory if args.watch else sync_directory
+        run(target_dir, workers=args.workers, chunk_mode=args.chunk_mode,
+            dedup_policy=args.dedup, retire=args.retire)
+    else:
+        process_directory(target_dir, workers=args.workers, chunk_mode=args.chunk_mode, dedup_policy=args.dedup)
+    # Chờ ghi xong chunks vật lý còn trong hàng đợi trước khi thoát
+    chunk_store.WRITE_BEHIND.shutdown()
@@ -0,0 +1,172 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# OCR cho trang PDF không có text layer (PDF scan). Chạy hoàn toàn local:
+# render trang bằng pdftoppm (poppler-utils) rồi nhận dạng bằng tesseract, đều qua subprocess.
+OCR_ENABLED = os.getenv("OCR_ENABLED", "0") == "1"
+TESSERACT_CMD = os.getenv("TESSERACT_CMD", "tesseract")
+PDFTOPPM_CMD = os.getenv("PDFTOPPM_CMD", "pdftoppm")
+OCR_LANG = os.getenv("OCR_LANG", "vie+eng")
+OCR_DPI = int(os.getenv("OCR_DPI", "300"))
+# Số trang OCR song song (mỗi thread chờ một process tesseract; mặc định: số CPU)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0")) or (os.cpu_count() or 1)
+# Thời gian tối đa (giây) cho một lần render / OCR một trang
+OCR_TIMEOUT = int(os.getenv("OCR_TIMEOUT", "300"))
+# Cache kết quả OCR theo hash ảnh trang: ingest lại cùng một bản scan không phải OCR lại
+OCR_CACHE_DIR = os.getenv(
+    "OCR_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ocr_cache")
+)
+
+class OcrStats:
+    """Thống kê OCR (an toàn khi nhiều thread cùng cập nhật)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pages = 0         # Số trang đã OCR (kể cả lấy từ cache)
+        self.cache_hits = 0
+        self.failures = 0
+        self.seconds = 0.0     # Tổng thời gian render + OCR của từng trang
+
+    def record(self, seconds, cache_hit=False, failed=False):
+        with self._lock:
+            self.pages += 1
+            self.cache_hits += cache_hit
+            self.failures += failed
+            self.seconds += seconds
+
+    def merge(self, other):
+        with self._lock:
+            self.pages += other.pages
+            self.cache_hits += other.cache_hits
+            self.failures += other.failures
+            self.seconds += other.seconds
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'pages': self.pages,
+                'cache_hits': self.cache_hits,
+                'cache_hit_rate': round(self.cache_hits / self.pages, 3) if self.pages else None,
+                'failures': self.failures,
+                'seconds': round(self.seconds, 3),
+                'seconds_per_page': round(self.seconds / self.pages, 3) if self.pages else None
+            }
+
+    def summary(self):
+        stats = self.as_dict()
+        if not stats['pages']:
+            return "OCR 0 trang"
+        return (f"OCR {stats['pages']} trang, {stats['seconds_per_page']}s/trang, "
+                f"cache hit {stats['cache_hits']}/{stats['pages']} ({stats['cache_hit_rate']:.0%}), "
+                f"lỗi {stats['failures']}")
+
+# Thống kê cộng dồn của process hiện tại (xem GET /ocr/stats)
+OCR_STATS = OcrStats()
+
+_warned_missing = False
+
+def ocr_available() -> bool:
+    """OCR được bật (OCR_ENABLED=1) và có đủ tesseract + pdftoppm."""
+    global _warned_missing
+    if not OCR_ENABLED:
+        return False
+    missing = [cmd for cmd in (TESSERACT_CMD, PDFTOPPM_CMD) if shutil.which(cmd) is None]
+    if missing:
+        if not _warned_missing:
+            logging.warning(f"OCR_ENABLED=1 nhưng không tìm thấy {', '.join(missing)}; bỏ qua bước OCR.")
+            _warned_missing = True
+        return False
+    return True
+
+def render_page(filepath, page_number) -> bytes:
+    """Render một trang PDF (bắt đầu từ 1) thành ảnh PNG với độ phân giải OCR_DPI."""
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp:
+        root = os.path.join(tmp, "page")
+        subprocess.run(
+            [PDFTOPPM_CMD, "-f", str(page_number), "-l", str(page_number), "-r", str(OCR_DPI),
+             "-png", "-singlefile", filepath, root],
+            check=True, capture_output=True, timeout=OCR_TIMEOUT
+        )
+        with open(root + ".png", "rb") as f:
+            return f.read()
+
+def _cache_path(key):
+    return os.path.join(OCR_CACHE_DIR, key[:2], f"{key}.txt")
+
+def ocr_image(image: bytes):
+    """
+    Nhận dạng text trong ảnh bằng tesseract (ngôn ngữ OCR_LANG).
+    Kết quả được cache theo SHA-256 của ảnh (kèm ngôn ngữ) trong OCR_CACHE_DIR.
+    Trả về: (text, cache_hit)
+    """
+    key = hashlib.sha256(OCR_LANG.encode() + b"\0" + image).hexdigest()
+    cache_path = _cache_path(key)
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return f.read(), True
+    except FileNotFoundError:
+        pass
+
+    with tempfile.TemporaryDirectory(prefix="ocr_") as tmp:
+        image_path = os.path.join(tmp, "page.png")
+        with open(image_path, "wb") as f:
+            f.write(image)
+        result = subprocess.run(
+            [TESSERACT_CMD, image_path, "stdout", "-l", OCR_LANG],
+            check=True, capture_output=True, timeout=OCR_TIMEOUT
+        )
+    # tesseract kết thúc mỗi trang bằng ký tự form feed
+    text = result.stdout.decode("utf-8", errors="replace").replace("\f", "").strip()
+
+    # Ghi file tạm rồi đổi tên: thread/process khác không đọc phải cache ghi dở
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, cache_path)
+    return text, False
+
+def ocr_page(filepath, page_number, stats: OcrStats = None) -> str:
+    """Render + OCR một trang PDF. Lỗi ở một trang chỉ được log, trang đó coi như không có text."""
+    stats = stats or OcrStats()
+    started = time.perf_counter()
+    try:
+        text, cache_hit = ocr_image(render_page(filepath, page_number))
+        stats.record(time.perf_counter() - started, cache_hit=cache_hit)
+        return text
+    except Exception as e:
+        logging.warning(f"OCR lỗi ở trang {page_number} của {filepath}: {e}")
+        stats.record(time.perf_counter() - started, failed=True)
+        return ""
+
+def fill_missing_pages(filepath, page_texts, workers=None, stats: OcrStats = None):
+    """
+    Yield text các trang theo đúng thứ tự; trang không có text (chỉ có khoảng trắng) được
+    render + OCR trên pool workers thread (mặc định OCR_WORKERS).
+    Tối đa workers * 2 trang nằm trong cửa sổ chờ, nên không cần đọc hết PDF trước khi OCR.
+    """
+    workers = workers or OCR_WORKERS
+    pending = deque()
+
+    def result(item):
+        return item if isinstance(item, str) else item.result()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr") as pool:
+        for page_number, text in enumerate(page_texts, start=1):
+            if text.strip():
+                pending.append(text)
+            else:
+                pending.append(pool.submit(ocr_page, filepath, page_number, stats))
+            while pending and (isinstance(pending[0], str) or len(pending) > workers * 2):
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
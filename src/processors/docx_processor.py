@@ -1,36 +1,150 @@
 import docx
 import os
+import zipfile
+from xml.parsers import expat
+from processors.stream import TextStream, collect
 
-def process_docx(filepath):
+# Tăng khi text / metadata trích xuất thay đổi, để bỏ qua các mục extraction cache cũ
+PROCESSOR_VERSION = "1"
+
+# Cách trích xuất DOCX:
+# - python-docx: dựng toàn bộ object model, chỉ lấy paragraph ở thân văn bản (bỏ qua bảng)
+# - xml: đọc word/document.xml dạng streaming bằng parser tăng dần, lấy cả text trong bảng
+DOCX_EXTRACTORS = ('python-docx', 'xml')
+DOCX_EXTRACTOR = os.getenv("DOCX_EXTRACTOR", "python-docx")
+# Số byte XML (đã giải nén) đưa cho parser mỗi lần
+DOCX_READ_SIZE = 64 * 1024
+
+# Tên thẻ WordprocessingML sau khi expat tách namespace ("<namespace> <tên>")
+_W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main '
+_P, _T, _TAB, _BR, _CR, _PPR, _TR, _TC = (_W + tag for tag in ('p', 't', 'tab', 'br', 'cr', 'pPr', 'tr', 'tc'))
+_BR_TYPE = _W + 'type'
+
+def cache_params():
+    """Cấu hình ảnh hưởng tới text trích xuất (phần của khóa extraction cache)."""
+    return f"extractor={DOCX_EXTRACTOR}"
+
+def _iter_paragraphs(filepath, metadata):
+    # Đọc file DOCX
+    doc = docx.Document(filepath)
+
+    # Các paragraph có text được nối bằng "\n" (ký tự nối đi kèm đầu paragraph sau)
+    count = 0
+    for para in doc.paragraphs:
+        if para.text.strip():
+            yield para.text if count == 0 else "\n" + para.text
+            count += 1
+    metadata['paragraph_count'] = count
+
+class _DocumentXmlHandler:
+    """
+    Handler cho expat: gom text của từng paragraph theo thứ tự xuất hiện trong document.xml.
+    - Paragraph ngoài bảng: một dòng
+    - Bảng: mỗi hàng một dòng, các ô nối bằng tab; các paragraph trong một ô nối bằng dấu cách
+      (bảng lồng trong ô được đưa vào text của ô chứa nó)
+    Dòng đã hoàn chỉnh được đưa vào lines; chỉ giữ trạng thái của paragraph/hàng đang dở.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.paragraphs = []   # Stack các paragraph đang mở (paragraph trong text box lồng trong paragraph)
+        self.cells = []        # Stack các ô bảng đang mở: list text các paragraph trong ô
+        self.rows = []         # Stack các hàng bảng đang mở: list text các ô
+        self.in_text = False
+        self.in_ppr = 0        # Trong w:pPr (w:tab ở đây là định nghĩa tab stop, không phải ký tự)
+
+    def _deliver(self, text):
+        if self.cells:
+            self.cells[-1].append(text)
+        elif text.strip():
+            self.lines.append(text)
+
+    def start(self, name, attrs):
+        if name == _T:
+            self.in_text = True
+        elif name == _P:
+            self.paragraphs.append([])
+        elif name == _PPR:
+            self.in_ppr += 1
+        elif name == _TAB:
+            if self.paragraphs and not self.in_ppr:
+                self.paragraphs[-1].append("\t")
+        elif name == _BR:
+            # Ngắt trang / ngắt cột không phải ký tự xuống dòng trong text
+            if self.paragraphs and attrs.get(_BR_TYPE, 'textWrapping') == 'textWrapping':
+                self.paragraphs[-1].append("\n")
+        elif name == _CR:
+            if self.paragraphs:
+                self.paragraphs[-1].append("\n")
+        elif name == _TC:
+            self.cells.append([])
+        elif name == _TR:
+            self.rows.append([])
+
+    def end(self, name):
+        if name == _T:
+            self.in_text = False
+        elif name == _P:
+            self._deliver("".join(self.paragraphs.pop()))
+        elif name == _PPR:
+            self.in_ppr -= 1
+        elif name == _TC:
+            cell = self.cells.pop()
+            self.rows[-1].append(" ".join(text for text in cell if text.strip()))
+        elif name == _TR:
+            self._deliver("\t".join(self.rows.pop()))
+
+    def characters(self, data):
+        if self.in_text and self.paragraphs:
+            self.paragraphs[-1].append(data)
+
+def _iter_document_xml(filepath, metadata):
+    handler = _DocumentXmlHandler()
+    parser = expat.ParserCreate(namespace_separator=' ')
+    # Gộp các đoạn character data liền nhau thành một lần gọi handler
+    parser.buffer_text = True
+    parser.StartElementHandler = handler.start
+    parser.EndElementHandler = handler.end
+    parser.CharacterDataHandler = handler.characters
+
+    count = 0
+    with zipfile.ZipFile(filepath) as archive, archive.open('word/document.xml') as xml:
+        while True:
+            data = xml.read(DOCX_READ_SIZE)
+            parser.Parse(data, not data)
+            # Các dòng được nối bằng "\n" (ký tự nối đi kèm đầu dòng sau), giống python-docx
+            for line in handler.lines:
+                yield line if count == 0 else "\n" + line
+                count += 1
+            handler.lines.clear()
+            if not data:
+                break
+    metadata['paragraph_count'] = count
+
+def stream_docx(filepath, extractor=None):
+    """
+    Trích xuất văn bản từ file DOCX dạng streaming, mỗi segment là một paragraph
+    (hoặc một hàng bảng với extractor 'xml').
+    extractor: 'python-docx' hoặc 'xml' (mặc định DOCX_EXTRACTOR)
+    - metadata: file_name, file_size; paragraph_count được bổ sung khi đọc xong.
+    """
+    extractor = extractor or DOCX_EXTRACTOR
+    if extractor not in DOCX_EXTRACTORS:
+        raise ValueError(f"DOCX extractor không hợp lệ: {extractor} (chọn một trong: {', '.join(DOCX_EXTRACTORS)})")
+    metadata = {
+        "file_name": os.path.basename(filepath),
+        "file_size": os.path.getsize(filepath)
+    }
+    iterate = _iter_document_xml if extractor == 'xml' else _iter_paragraphs
+    return TextStream(metadata, iterate(filepath, metadata))
+
+def process_docx(filepath, extractor=None):
     """
     Trích xuất văn bản từ file DOCX.
-    - Sử dụng python-docx để đọc nội dung.
-    - Trả về content + metadata (file_name, file_size, paragraph_count).
+    - Trả về content + metadata (file_name, file_size, paragraph_count), xem stream_docx.
     """
     try:
-        file_name = os.path.basename(filepath)
-        file_size = os.path.getsize(filepath)
-
-        # Đọc file DOCX
-        doc = docx.Document(filepath)
-        
-        # Trích xuất text từ tất cả paragraphs
-        paragraphs = []
-        for para in doc.paragraphs:
-            if para.text.strip():
-                paragraphs.append(para.text)
-        
-        content = "\n".join(paragraphs)
-
-        return {
-            "content": content,
-            "metadata": {
-                "file_name": file_name,
-                "file_size": file_size,
-                "paragraph_count": len(paragraphs),
-            }
-        }
-
+        return collect(stream_docx(filepath, extractor))
     except Exception as e:
         print(f"Lỗi khi xử lý file DOCX {filepath}: {e}")
         return None
@@ -1,39 +1,137 @@
 import PyPDF2
 import os
+import logging
+import multiprocessing
+import ocr
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from processors.stream import TextStream, collect
 
-def process_pdf(filepath):
+# Phiên bản output, thuộc khóa extraction cache (xem ProcessorRegistry.cache_tag)
+PROCESSOR_VERSION = "1"
+
+# PDF có từ số trang này trở lên được trích xuất song song theo khoảng trang
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", "200"))
+# Số process trích xuất song song (mặc định: số CPU)
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", "0")) or (os.cpu_count() or 1)
+# Số trang mỗi khoảng giao cho một process; mỗi process giữ tối đa 2 khoảng chờ đọc (bộ nhớ có giới hạn)
+PDF_RANGE_PAGES = int(os.getenv("PDF_RANGE_PAGES", "25"))
+
+def cache_params():
+    """Cấu hình ảnh hưởng tới text trích xuất (phần của khóa extraction cache): OCR có chạy không, ngôn ngữ, DPI."""
+    return f"ocr={ocr.OCR_LANG}/{ocr.OCR_DPI}" if ocr.ocr_available() else "ocr=off"
+
+def _extract_pages(reader, start, stop):
+    """Trích xuất text của các trang [start, stop); trang không có text trả về chuỗi rỗng."""
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def _extract_page_range(filepath, start, stop):
+    """
+    Chạy trong process con: tự mở reader riêng (PdfReader không chia sẻ được giữa các process)
+    và trích xuất khoảng trang [start, stop).
+    """
+    with open(filepath, 'rb') as f:
+        return _extract_pages(PyPDF2.PdfReader(f), start, stop)
+
+def _page_ranges(num_pages, size):
+    """
+    Chia num_pages thành các khoảng liên tiếp size trang. Mỗi khoảng tốn một lần mở file và
+    dựng cây trang trong process con, nên không nên quá nhỏ.
+    """
+    size = max(1, size)
+    return [(start, min(start + size, num_pages)) for start in range(0, num_pages, size)]
+
+def _iter_parallel(filepath, num_pages, workers):
+    """
+    Trích xuất các khoảng trang trên pool process và yield text từng trang theo đúng thứ tự.
+    Chỉ giữ tối đa 2 * workers khoảng đang chạy / chờ đọc, nên bộ nhớ không phụ thuộc số trang.
+    """
+    ranges = _page_ranges(num_pages, PDF_RANGE_PAGES)
+    window = 2 * workers
+    pending = deque()
+    # spawn: không fork process đang có thread (job worker, writer) và kết nối DB mở, như run_staged
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        try:
+            for start, stop in ranges:
+                pending.append(pool.submit(_extract_page_range, filepath, start, stop))
+                if len(pending) >= window:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # Stream bị bỏ dở (vd: lỗi ghi DB): không chạy tiếp các khoảng chưa bắt đầu
+            for future in pending:
+                future.cancel()
+
+def _iter_pages(filepath, workers, metadata):
+    """
+    Yield text từng trang có text (kết thúc bằng "\n"), đồng thời ghi vào metadata:
+    page_count, và page_offsets[i] là vị trí ký tự bắt đầu của trang i + 1 trong nội dung
+    (trang không có text có cùng offset với trang kế tiếp).
+    """
+    page_offsets = metadata['page_offsets']
+    with open(filepath, 'rb') as f:
+        reader = PyPDF2.PdfReader(f)
+        num_pages = len(reader.pages)
+        metadata['page_count'] = num_pages
+
+        # Đang chạy trong process con (vd: pool của run_staged) thì không mở thêm pool lồng nhau
+        parallel = (workers > 1 and num_pages >= PDF_PARALLEL_MIN_PAGES
+                    and multiprocessing.parent_process() is None)
+        if parallel:
+            pages = _iter_parallel(filepath, num_pages, workers)
+        else:
+            pages = (reader.pages[i].extract_text() or "" for i in range(num_pages))
+
+        # Trang không có text layer được render + OCR (nếu bật OCR_ENABLED)
+        ocr_stats = None
+        if ocr.ocr_available():
+            ocr_stats = ocr.OcrStats()
+            pages = ocr.fill_missing_pages(filepath, pages, stats=ocr_stats)
+
+        offset = 0
+        has_text = False
+        for page_text in pages:
+            page_offsets.append(offset)
+            if page_text:
+                has_text = has_text or bool(page_text.strip())
+                yield page_text + "\n"
+                offset += len(page_text) + 1
+
+    if ocr_stats is not None and ocr_stats.pages:
+        metadata['ocr_pages'] = ocr_stats.pages
+        ocr.OCR_STATS.merge(ocr_stats)
+        logging.info(f"{os.path.basename(filepath)}: {ocr_stats.summary()}")
+
+    # Nếu không trích xuất được text nào, coi là file scan và bỏ qua
+    if not has_text:
+        print(f"Bỏ qua PDF dạng scan (không có text layer): {filepath}")
+        metadata['skipped'] = "PDF dạng scan (không có text layer)"
+
+def stream_pdf(filepath, workers=None):
+    """
+    Trích xuất văn bản từ file PDF dạng streaming: mỗi segment là text của một trang.
+    Trang không có text layer được OCR nếu bật OCR_ENABLED (xem ocr.py); metadata có thêm ocr_pages.
+    PDF từ PDF_PARALLEL_MIN_PAGES trang trở lên được chia thành các khoảng PDF_RANGE_PAGES trang và trích xuất
+    song song trên workers process (mặc định PDF_WORKERS); PDF nhỏ hơn chạy tuần tự.
+    metadata được bổ sung page_count, page_offsets (để xác định trang của từng chunk) trong lúc đọc.
+    """
+    metadata = {
+        "file_name": os.path.basename(filepath),
+        "file_size": os.path.getsize(filepath),
+        "page_offsets": []
+    }
+    return TextStream(metadata, _iter_pages(filepath, workers or PDF_WORKERS, metadata))
+
+def process_pdf(filepath, workers=None):
     """
-    Trích xuất văn bản từ file PDF.
+    Trích xuất văn bản từ file PDF (toàn bộ nội dung, xem stream_pdf).
     Trả về dictionary gồm content và metadata.
-    Bỏ qua PDF dạng scan (không có text layer).
+    Bỏ qua PDF dạng scan (không có text layer) nếu không bật OCR.
     """
-    text = ""
     try:
-        file_size = os.path.getsize(filepath)
-        file_name = os.path.basename(filepath)
-        
-        with open(filepath, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            num_pages = len(reader.pages)
-            
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        
-        # Nếu không trích xuất được text nào, coi là file scan và bỏ qua
-        if not text.strip():
-            print(f"Bỏ qua PDF dạng scan (không có text layer): {filepath}")
-            return None
-
-        return {
-            "content": text,
-            "metadata": {
-                "file_name": file_name,
-                "file_size": file_size,
-                "page_count": num_pages
-            }
-        }
+        return collect(stream_pdf(filepath, workers))
     except Exception as e:
         print(f"Lỗi khi xử lý file PDF {filepath}: {e}")
         return None
@@ -0,0 +1,201 @@
+import sys
+import logging
+import importlib
+import threading
+from collections.abc import MutableMapping
+from importlib.metadata import entry_points
+from processors.stream import collect
+
+# Processor bên thứ ba đăng ký qua entry point trong nhóm này, tên entry point là đuôi file
+# và giá trị trỏ tới hàm stream (filepath -> TextStream, xem processors/stream.py). Ví dụ pyproject.toml:
+#   [project.entry-points."ocr_pipeline.processors"]
+#   ".rtf" = "rtf_processor:stream_rtf"
+ENTRY_POINT_GROUP = "ocr_pipeline.processors"
+
+# Processor có sẵn: đuôi file -> module, hàm dict (content + metadata), hàm stream.
+# Module (và thư viện parser của nó: PyPDF2, python-docx, chardet) chỉ được import khi
+# gặp file đuôi đó lần đầu.
+BUILTIN_PROCESSORS = {
+    '.txt': ('processors.txt_processor', 'process_txt', 'stream_txt'),
+    '.pdf': ('processors.pdf_processor', 'process_pdf', 'stream_pdf'),
+    '.docx': ('processors.docx_processor', 'process_docx', 'stream_docx'),
+}
+
+class LazyRef:
+    """Tham chiếu tới một processor chưa được import; load() import và trả về hàm thật."""
+
+    def __init__(self, loader, target):
+        self._loader = loader
+        self.target = target   # Mô tả dạng "module:hàm" (cho --list-processors)
+
+    def load(self):
+        return self._loader()
+
+    def __repr__(self):
+        return f"LazyRef({self.target!r})"
+
+def normalize_ext(ext):
+    """'RTF' / '.rtf' -> '.rtf'"""
+    ext = ext.lower()
+    return ext if ext.startswith('.') else f".{ext}"
+
+def _import_attr(module, attr):
+    return LazyRef(lambda: getattr(importlib.import_module(module), attr), f"{module}:{attr}")
+
+def _process_from_stream(stream_processor):
+    """Hàm dict (content + metadata) cho processor chỉ có hàm stream, cùng cách xử lý lỗi với processor có sẵn."""
+    def process(filepath):
+        try:
+            return collect(stream_processor(filepath))
+        except Exception as e:
+            print(f"Lỗi khi xử lý file {filepath}: {e}")
+            return None
+    return process
+
+class LazyProcessors(MutableMapping):
+    """
+    Dict đuôi file -> processor, giá trị là LazyRef được import ở lần truy cập đầu tiên rồi giữ lại.
+    Processor từ entry point được tìm (chưa import) ở lần truy cập đầu tiên vào dict.
+    Gán giá trị (vd: dict[ext] = hàm) vẫn dùng được như dict thường.
+    """
+
+    def __init__(self, registry, entries=None):
+        self._registry = registry
+        self._entries = dict(entries or {})
+        self._lock = threading.Lock()
+
+    def __getitem__(self, ext):
+        self._registry.discover()
+        value = self._entries[ext]
+        if isinstance(value, LazyRef):
+            with self._lock:
+                value = self._entries[ext]
+                if isinstance(value, LazyRef):
+                    value = self._entries[ext] = value.load()
+        return value
+
+    def __setitem__(self, ext, value):
+        self._registry.discover()
+        self._entries[ext] = value
+
+    def __delitem__(self, ext):
+        self._registry.discover()
+        del self._entries[ext]
+
+    def __iter__(self):
+        self._registry.discover()
+        return iter(list(self._entries))
+
+    def __len__(self):
+        self._registry.discover()
+        return len(self._entries)
+
+    def __contains__(self, ext):
+        # Kiểm tra đuôi file được hỗ trợ không import processor
+        self._registry.discover()
+        return ext in self._entries
+
+    def clear(self):
+        self._registry.discover()
+        self._entries.clear()
+
+    def update(self, other=(), **kwargs):
+        # Chép thẳng LazyRef từ LazyProcessors khác (vd: khôi phục sau copy()) để không import processor
+        if isinstance(other, LazyProcessors):
+            self._registry.discover()
+            self._entries.update(other._entries)
+            other = ()
+        super().update(other, **kwargs)
+
+    def copy(self):
+        self._registry.discover()
+        return LazyProcessors(self._registry, self._entries)
+
+    def is_loaded(self, ext):
+        self._registry.discover()
+        return not isinstance(self._entries[ext], LazyRef)
+
+    def target(self, ext):
+        value = self._entries[ext]
+        if isinstance(value, LazyRef):
+            return value.target
+        return f"{getattr(value, '__module__', '?')}:{getattr(value, '__qualname__', repr(value))}"
+
+class ProcessorRegistry:
+    """
+    Danh sách processor theo đuôi file: processor có sẵn + processor từ entry point (ENTRY_POINT_GROUP).
+    - processors: đuôi file -> hàm dict (content + metadata)
+    - stream_processors: đuôi file -> hàm stream (TextStream)
+    Processor từ entry point trùng đuôi với processor có sẵn sẽ thay thế processor có sẵn.
+    """
+
+    def __init__(self, builtins=BUILTIN_PROCESSORS, group=ENTRY_POINT_GROUP):
+        self.group = group
+        self.sources = {}
+        self._discovered = False
+        self._discover_lock = threading.Lock()
+        processors, stream_processors = {}, {}
+        for ext, (module, process_attr, stream_attr) in builtins.items():
+            processors[ext] = _import_attr(module, process_attr)
+            stream_processors[ext] = _import_attr(module, stream_attr)
+            self.sources[ext] = 'builtin'
+        self.processors = LazyProcessors(self, processors)
+        self.stream_processors = LazyProcessors(self, stream_processors)
+
+    def register(self, ext, stream_processor, process=None, source='manual'):
+        """
+        Đăng ký processor cho đuôi file ext (vd: '.rtf').
+        stream_processor / process: hàm hoặc LazyRef; không có process thì gom từ stream_processor.
+        """
+        ext = normalize_ext(ext)
+        if process is None:
+            if isinstance(stream_processor, LazyRef):
+                ref = stream_processor
+                process = LazyRef(lambda: _process_from_stream(ref.load()), ref.target)
+            else:
+                process = _process_from_stream(stream_processor)
+        self.stream_processors._entries[ext] = stream_processor
+        self.processors._entries[ext] = process
+        self.sources[ext] = source
+
+    def discover(self):
+        """Tìm processor đăng ký qua entry point (chỉ đọc metadata package, chưa import), chạy một lần."""
+        if self._discovered:
+            return
+        with self._discover_lock:
+            if self._discovered:
+                return
+            for ep in entry_points(group=self.group):
+                source = f"{ep.dist.name} {ep.dist.version}" if ep.dist else 'entry point'
+                if normalize_ext(ep.name) in self.sources:
+                    logging.info(f"Processor {normalize_ext(ep.name)} từ {source} thay thế processor đã có.")
+                self.register(ep.name, LazyRef(ep.load, ep.value), source=source)
+            self._discovered = True
+
+    def cache_tag(self, ext):
+        """
+        Định danh output của processor cho đuôi ext, dùng trong khóa extraction cache:
+        "<module:hàm>@<phiên bản>[?<cấu hình>]". Phiên bản là PROCESSOR_VERSION của module processor
+        (cần tăng khi text / metadata trích xuất thay đổi), hoặc package + version với processor từ entry point;
+        cache_params() của module (nếu có) mô tả cấu hình ảnh hưởng tới output (vd: OCR, extractor DOCX).
+        Trả về None nếu module đặt PROCESSOR_CACHEABLE = False (trích xuất rẻ hơn đọc cache).
+        """
+        stream_processor = self.stream_processors[ext]
+        module = sys.modules.get(getattr(stream_processor, '__module__', None))
+        if not getattr(module, 'PROCESSOR_CACHEABLE', True):
+            return None
+        version = getattr(module, 'PROCESSOR_VERSION', None) or self.sources.get(ext, 'manual')
+        tag = f"{self.stream_processors.target(ext)}@{version}"
+        params = getattr(module, 'cache_params', None)
+        return f"{tag}?{params()}" if callable(params) else tag
+
+    def describe(self):
+        """Danh sách processor cho --list-processors: (đuôi file, hàm stream, nguồn, đã import chưa)."""
+        self.discover()
+        return [
+            (ext, self.stream_processors.target(ext), self.sources[ext], self.stream_processors.is_loaded(ext))
+            for ext in sorted(self.stream_processors)
+        ]
+
+# Registry dùng chung của pipeline
+REGISTRY = ProcessorRegistry()
@@ -0,0 +1,65 @@
+import tempfile
+
+# Số ký tự mỗi lần đọc lại từ TextSpool
+SPOOL_READ_SIZE = 1024 * 1024
+
+class TextStream:
+    """
+    Kết quả của processor dạng streaming.
+    metadata: dict metadata của file. Các giá trị chỉ biết sau khi đọc nội dung
+              (vd: page_count, paragraph_count) được processor bổ sung trong lúc duyệt segments;
+              'skipped' (nếu có) là lý do processor bỏ qua file (vd: PDF scan không có text layer).
+    segments: iterator các đoạn văn bản (trang, đoạn, khối...) theo đúng thứ tự, chỉ duyệt được một lần;
+              nối lại bằng "".join chính là toàn bộ nội dung.
+    """
+
+    def __init__(self, metadata: dict, segments):
+        self.metadata = metadata
+        self.segments = segments
+
+    def __iter__(self):
+        return iter(self.segments)
+
+def collect(stream: TextStream):
+    """
+    Gom stream thành dict {'content', 'metadata'} của API cũ (toàn bộ nội dung trong bộ nhớ).
+    Trả về None nếu processor bỏ qua file.
+    """
+    content = "".join(stream)
+    if stream.metadata.get('skipped'):
+        return None
+    return {"content": content, "metadata": stream.metadata}
+
+class TextSpool:
+    """
+    Ghi text của một TextStream ra file tạm trong lúc stream được duyệt, để đọc lại nhiều lần
+    mà không chạy lại processor (vd: chunk cùng một nội dung theo nhiều chunk mode).
+    - stream: TextStream bọc stream gốc, duyệt một lần như bình thường
+    - replay(): TextStream đọc lại từ file tạm (metadata dùng chung với stream gốc), chỉ dùng sau khi
+      stream đã được duyệt hết; các bản replay phải được duyệt lần lượt, không xen kẽ
+    """
+
+    def __init__(self, source: TextStream):
+        # newline="": giữ nguyên \r\n, text đọc lại giống hệt text đã ghi
+        self._file = tempfile.TemporaryFile(mode="w+", encoding="utf-8", newline="")
+        self._complete = False
+        self.stream = TextStream(source.metadata, self._record(source))
+
+    def _record(self, source):
+        for segment in source:
+            self._file.write(segment)
+            yield segment
+        self._complete = True
+
+    def replay(self) -> TextStream:
+        if not self._complete:
+            raise RuntimeError("TextSpool.replay() trước khi stream gốc được duyệt hết")
+        return TextStream(self.stream.metadata, self._read())
+
+    def _read(self):
+        self._file.seek(0)
+        for block in iter(lambda: self._file.read(SPOOL_READ_SIZE), ""):
+            yield block
+
+    def close(self):
+        self._file.close()
@@ -1,5 +1,123 @@
 import os
+import re
+import mmap
+import codecs
 import chardet
+from processors.stream import TextStream, collect
+
+# Không dùng extraction cache (xem ProcessorRegistry.cache_tag): đọc + giải mã TXT nhanh hơn cả giải nén từ cache
+PROCESSOR_CACHEABLE = False
+
+# Kích thước mỗi khối byte được giải mã và trả ra thành một segment
+TXT_BLOCK_SIZE = 1024 * 1024
+# Số byte tối đa dùng để nhận diện encoding (phần đầu file, hoặc từ byte non-ASCII đầu tiên)
+TXT_DETECT_BYTES = int(os.getenv("TXT_DETECT_BYTES", str(64 * 1024)))
+# File từ kích thước này trở lên được đọc qua mmap thay vì read() toàn bộ
+TXT_MMAP_MIN_SIZE = 4 * 1024 * 1024
+
+# BOM -> encoding (codec tương ứng tự bỏ BOM khi giải mã)
+_BOMS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+_NON_ASCII = re.compile(rb'[\x80-\xff]')
+
+def _is_utf8(sample: bytes) -> bool:
+    """sample là UTF-8 hợp lệ (cho phép ký tự nhiều byte bị cắt dở ở cuối mẫu)."""
+    try:
+        sample.decode('utf-8')
+        return True
+    except UnicodeDecodeError as e:
+        return e.reason == 'unexpected end of data' and e.start >= len(sample) - 3
+
+def detect_encoding(sample: bytes) -> str:
+    """
+    Nhận diện encoding từ một mẫu byte giới hạn:
+    - BOM (UTF-8/16/32)
+    - fast path: mẫu là UTF-8 hợp lệ (kể cả ASCII) và không có byte NUL (dấu hiệu UTF-16 không BOM)
+    - còn lại: chardet.UniversalDetector, đưa từng phần nhỏ và dừng sớm khi đã chắc chắn
+    """
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding
+    if b'\0' not in sample and _is_utf8(sample):
+        return 'utf-8'
+
+    detector = chardet.UniversalDetector()
+    for start in range(0, len(sample), 4096):
+        detector.feed(sample[start:start + 4096])
+        if detector.done:
+            break
+    detector.close()
+    return detector.result['encoding'] or 'utf-8'
+
+def _decoder(encoding):
+    return codecs.getincrementaldecoder(encoding)(errors='replace')
+
+def _iter_blocks(filepath, metadata):
+    """
+    Đọc file đúng một lần (mmap với file lớn), giải mã ngay từ buffer đã đọc.
+    Trong lúc phần đã đọc toàn là ASCII thì chưa cần chọn encoding (ASCII giống nhau ở mọi
+    encoding tương thích ASCII): khi gặp byte non-ASCII đầu tiên mới nhận diện encoding
+    trên mẫu bắt đầu từ byte đó.
+    \r\n và \r được đổi thành \n như khi mở file ở text mode.
+    """
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        use_mmap = size and size >= TXT_MMAP_MIN_SIZE
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap else f.read()
+        try:
+            sample = data[:TXT_DETECT_BYTES]
+            encoding = detect_encoding(sample)
+            ascii_only = encoding == 'utf-8' and sample.isascii()
+            decoder = _decoder(encoding)
+            pending_cr = False   # \r ở cuối khối trước: chưa biết có \n theo sau hay không
+
+            def translate(text, final=False):
+                nonlocal pending_cr
+                if pending_cr:
+                    text = "\r" + text
+                pending_cr = not final and text.endswith("\r")
+                if pending_cr:
+                    text = text[:-1]
+                # Phần lớn file không có \r: kiểm tra trước rẻ hơn nhiều so với replace
+                if "\r" in text:
+                    text = text.replace("\r\n", "\n").replace("\r", "\n")
+                return text
+
+            for start in range(0, len(data), TXT_BLOCK_SIZE):
+                block = data[start:start + TXT_BLOCK_SIZE]
+                if ascii_only and not block.isascii():
+                    # Decoder cũ không giữ byte dở dang nào vì phần trước chỉ có ASCII
+                    ascii_only = False
+                    first = start + _NON_ASCII.search(block).start()
+                    encoding = detect_encoding(data[first:first + TXT_DETECT_BYTES])
+                    decoder = _decoder(encoding)
+                text = translate(decoder.decode(block))
+                if text:
+                    yield text
+            tail = translate(decoder.decode(b'', final=True), final=True)
+            if tail:
+                yield tail
+            metadata['encoding'] = encoding
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+def stream_txt(filepath):
+    """
+    Đọc nội dung file TXT dạng streaming (mỗi segment ứng với tối đa TXT_BLOCK_SIZE byte),
+    tự động nhận diện encoding. File chỉ được đọc một lần.
+    """
+    metadata = {
+        "file_name": os.path.basename(filepath),
+        "file_size": os.path.getsize(filepath)
+    }
+    return TextStream(metadata, _iter_blocks(filepath, metadata))
 
 def process_txt(filepath):
     """
@@ -7,24 +125,7 @@ def process_txt(filepath):
     Trả về dictionary gồm content và metadata.
     """
     try:
-        file_size = os.path.getsize(filepath)
-        file_name = os.path.basename(filepath)
-        
-        with open(filepath, 'rb') as f:
-            raw_data = f.read()
-            result = chardet.detect(raw_data)
-            encoding = result['encoding'] or 'utf-8'
-        
-        with open(filepath, 'r', encoding=encoding, errors='replace') as f:
-            content = f.read()
-            
-        return {
-            "content": content,
-            "metadata": {
-                "file_name": file_name,
-                "file_size": file_size
-            }
-        }
+        return collect(stream_txt(filepath))
     except Exception as e:
         print(f"Lỗi khi xử lý file TXT {filepath}: {e}")
         return None
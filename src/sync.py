@@ -0,0 +1,224 @@
+import os
+import time
+import logging
+import threading
+from database import (
+    init_database, load_manifest, upsert_manifest_entry, delete_manifest_entries,
+    count_manifest_references, delete_document
+)
+from main import PROCESSORS, ingest_file, compute_file_hash, run_staged, _iter_files
+
+# Khoảng thời gian (giây) giữa hai lần quét lại thư mục khi không có watchdog (chế độ polling)
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", "5.0"))
+# File phải không có sự kiện mới trong khoảng này mới được ingest (tránh đọc file đang ghi dở)
+WATCH_SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS", "2.0"))
+
+def _retire_document(document_id: int) -> bool:
+    """Xóa document nếu không còn file nguồn nào trong manifest tham chiếu tới nó."""
+    if count_manifest_references(document_id) > 0:
+        return False
+    return delete_document(document_id)
+
+def _retire_missing(paths, manifest, chunk_mode) -> int:
+    """
+    Xóa manifest của các file nguồn đã biến mất và retire document do sync tạo từ các file đó
+    (document chỉ được tham chiếu vì trùng nội dung - skip / link - không bị xóa).
+    Trả về: số document đã xóa
+    """
+    doc_ids = {manifest[p]['document_id'] for p in paths
+               if manifest[p]['document_id'] is not None and manifest[p]['owned']}
+    delete_manifest_entries(paths, chunk_mode)
+    for path in paths:
+        manifest.pop(path, None)
+
+    retired = sum(1 for doc_id in doc_ids if _retire_document(doc_id))
+    logging.info(f"{len(paths)} file nguồn đã bị xóa. Retire {retired} document.")
+    return retired
+
+def _sync_files(filepaths, manifest, workers=1, chunk_mode="sentence", dedup_policy=None, retire=False):
+    """
+    Ingest những file mới hoặc đã thay đổi so với manifest.
+    File có size + mtime khớp manifest chỉ tốn một lần stat, không đọc nội dung.
+    File đổi mtime nhưng nội dung (hash) giữ nguyên chỉ được cập nhật manifest.
+    manifest: kết quả load_manifest, được cập nhật tại chỗ.
+    Trả về: dict đếm success/fail/skip/unchanged/retired
+    """
+    counters = {'success': 0, 'fail': 0, 'skip': 0, 'unchanged': 0, 'retired': 0}
+    stats = {}
+    hashes = {}
+
+    for path in filepaths:
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in PROCESSORS:
+            counters['skip'] += 1
+            continue
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue  # File biến mất trong lúc quét
+
+        entry = manifest.get(path)
+        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            counters['unchanged'] += 1
+            continue
+
+        try:
+            content_hash = compute_file_hash(path)
+        except OSError as e:
+            logging.error(f"Không đọc được file {path}: {e}")
+            counters['fail'] += 1
+            continue
+
+        if entry and entry['content_hash'] == content_hash and entry['document_id'] is not None:
+            # Chỉ đổi mtime (touch / copy lại), nội dung giữ nguyên
+            upsert_manifest_entry(path, chunk_mode, st.st_size, st.st_mtime_ns, content_hash, entry['document_id'],
+                                  entry['owned'])
+            entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+            counters['unchanged'] += 1
+            continue
+
+        stats[path] = st
+        hashes[path] = content_hash
+
+    def on_done(path, content_hash, doc_id, created):
+        st = stats[path]
+        old = manifest.get(path)
+        upsert_manifest_entry(path, chunk_mode, st.st_size, st.st_mtime_ns, content_hash, doc_id, created)
+        manifest[path] = {
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'content_hash': content_hash,
+            'document_id': doc_id,
+            'owned': created
+        }
+        # File bị sửa: document cũ do sync tạo từ file này đã bị thay thế
+        if retire and old and old['owned'] and old['document_id'] not in (None, doc_id):
+            if _retire_document(old['document_id']):
+                counters['retired'] += 1
+
+    if workers > 1 and len(hashes) > 1:
+        result = run_staged(list(hashes), workers, chunk_mode=chunk_mode, dedup_policy=dedup_policy,
+                            on_done=on_done, hashes=hashes)
+        for key in ('success', 'fail', 'skip'):
+            counters[key] += result[key]
+    else:
+        for path, content_hash in hashes.items():
+            result, doc_id, created = ingest_file(path, chunk_mode=chunk_mode, dedup_policy=dedup_policy,
+                                         content_hash=content_hash)
+            if result is True:
+                counters['success'] += 1
+            elif result is False:
+                counters['fail'] += 1
+            else:
+                counters['skip'] += 1
+            if result is not False and doc_id is not None:
+                on_done(path, content_hash, doc_id, created)
+
+    return counters
+
+def _sync_directory(directory_path, workers=1, chunk_mode="sentence", dedup_policy=None, retire=False):
+    """Quét toàn bộ thư mục và đồng bộ với manifest (không khởi tạo database)."""
+    root = os.path.abspath(directory_path)
+    manifest = load_manifest(os.path.join(root, ''), chunk_mode)
+    filepaths = list(_iter_files(root))
+
+    counters = _sync_files(filepaths, manifest, workers=workers, chunk_mode=chunk_mode,
+                           dedup_policy=dedup_policy, retire=retire)
+
+    if retire:
+        seen = set(filepaths)
+        missing = [path for path in manifest if path not in seen]
+        if missing:
+            counters['retired'] += _retire_missing(missing, manifest, chunk_mode)
+
+    logging.info(
+        f"Hoàn thành sync {root}. Thành công: {counters['success']}, Thất bại: {counters['fail']}, "
+        f"Bỏ qua: {counters['skip']}, Không đổi: {counters['unchanged']}, Retire: {counters['retired']}"
+    )
+    return counters
+
+def sync_directory(directory_path, workers=1, chunk_mode="sentence", dedup_policy=None, retire=False):
+    """
+    Đồng bộ thư mục theo manifest: chỉ ingest file mới hoặc đã thay đổi.
+    retire=True: xóa document có file nguồn đã biến mất hoặc đã bị thay thế.
+    Trả về: dict đếm success/fail/skip/unchanged/retired (None nếu không khởi tạo được)
+    """
+    try:
+        init_database()
+    except Exception as e:
+        logging.critical(f"Không thể khởi tạo database: {e}")
+        return
+
+    if not os.path.exists(directory_path):
+        logging.error(f"Không tìm thấy thư mục: {directory_path}")
+        return
+
+    return _sync_directory(directory_path, workers=workers, chunk_mode=chunk_mode,
+                           dedup_policy=dedup_policy, retire=retire)
+
+def watch_directory(directory_path, workers=1, chunk_mode="sentence", dedup_policy=None, retire=False,
+                    poll_interval=WATCH_POLL_INTERVAL, settle_seconds=WATCH_SETTLE_SECONDS, stop_event=None):
+    """
+    Sync thư mục một lần rồi tiếp tục theo dõi, ingest file ngay khi xuất hiện.
+    Dùng watchdog (inotify trên Linux) nếu đã cài, ngược lại quét lại thư mục mỗi poll_interval giây.
+    stop_event: threading.Event để dừng theo dõi (mặc định chạy tới khi bị ngắt bằng Ctrl+C).
+    """
+    if sync_directory(directory_path, workers=workers, chunk_mode=chunk_mode,
+                      dedup_policy=dedup_policy, retire=retire) is None:
+        return
+
+    stop_event = stop_event or threading.Event()
+    root = os.path.abspath(directory_path)
+
+    try:
+        from watchdog.observers import Observer
+        from watchdog.events import FileSystemEventHandler
+    except ImportError:
+        logging.info(f"Chưa cài watchdog, theo dõi {root} bằng polling mỗi {poll_interval} giây.")
+        while not stop_event.wait(poll_interval):
+            _sync_directory(root, workers=workers, chunk_mode=chunk_mode,
+                            dedup_policy=dedup_policy, retire=retire)
+        return
+
+    manifest = load_manifest(os.path.join(root, ''), chunk_mode)
+    pending = {}
+    lock = threading.Lock()
+
+    class _Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            if event.is_directory:
+                return
+            paths = [event.src_path]
+            if getattr(event, 'dest_path', None):
+                paths.append(event.dest_path)
+            now = time.monotonic()
+            with lock:
+                for path in paths:
+                    pending[os.path.abspath(path)] = now
+
+    observer = Observer()
+    observer.schedule(_Handler(), root, recursive=True)
+    observer.start()
+    logging.info(f"Đang theo dõi thư mục {root}...")
+
+    try:
+        while not stop_event.wait(min(settle_seconds, 0.5)):
+            now = time.monotonic()
+            with lock:
+                ready = [path for path, seen_at in pending.items() if now - seen_at >= settle_seconds]
+                for path in ready:
+                    del pending[path]
+            if not ready:
+                continue
+
+            existing = [path for path in ready if os.path.isfile(path)]
+            if existing:
+                _sync_files(existing, manifest, workers=workers, chunk_mode=chunk_mode,
+                            dedup_policy=dedup_policy, retire=retire)
+            gone = [path for path in ready if not os.path.exists(path) and path in manifest]
+            if retire and gone:
+                _retire_missing(gone, manifest, chunk_mode)
+    finally:
+        observer.stop()
+        observer.join()
@@ -4,7 +4,8 @@ import os
 import shutil
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import StaticPool, NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from fastapi.testclient import TestClient
 
 # Thêm thư mục src vào đường dẫn
@@ -14,12 +15,21 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 's
 # TRƯỚC KHI import bất kỳ module nào từ src (database, app, main).
 # Điều này đảm bảo code không bao giờ kết nối đến database thật (Postgres) trong quá trình test.
 os.environ["DATABASE_URL"] = "sqlite:///:memory:"
+# Không chạy job worker nền trong test (session test_db không dùng chung được giữa các thread).
+# Test gọi jobs.run_pending_jobs() để xử lý hàng đợi một cách tuần tự.
+os.environ["JOB_WORKERS"] = "0"
+# Không dùng extraction cache chung giữa các test (nhiều test dùng processor giả với cùng nội dung file);
+# test của cache tự tạo ExtractCache riêng trong thư mục tạm.
+os.environ["EXTRACT_CACHE"] = "0"
 
 from database import Base, get_db_session
 from app import app
 
-# Sử dụng SQLite in-memory cho việc kiểm thử
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# Sử dụng SQLite in-memory cho việc kiểm thử. Database in-memory dạng shared cache (đặt tên qua URI)
+# để engine async của các endpoint đọc (aiosqlite) thấy cùng dữ liệu với session đồng bộ test_db;
+# database tồn tại chừng nào kết nối của StaticPool còn mở.
+SQLALCHEMY_DATABASE_URL = "sqlite:///file:ocr_pipeline_test?mode=memory&cache=shared&uri=true"
+ASYNC_SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///file:ocr_pipeline_test?mode=memory&cache=shared&uri=true"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
@@ -27,6 +37,9 @@ engine = create_engine(
     poolclass=StaticPool,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# NullPool: mỗi TestClient chạy event loop riêng, kết nối aiosqlite không dùng lại được giữa các loop
+async_engine = create_async_engine(ASYNC_SQLALCHEMY_DATABASE_URL, poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
 @pytest.fixture(scope="function")
 def test_db():
@@ -67,7 +80,8 @@ def client(test_db, tmp_path):
     # Patch SessionLocal trong database.py để trả về test_db
     # Patch UPLOAD_DIR trong app
     with patch("app.UPLOAD_DIR", str(temp_upload_dir)), \
-         patch("database.SessionLocal", return_value=test_db):
+         patch("database.SessionLocal", return_value=test_db), \
+         patch("database.AsyncSessionLocal", TestingAsyncSessionLocal):
         
         with TestClient(app) as c:
             yield c
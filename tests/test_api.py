@@ -4,6 +4,9 @@ import pytest
 # Thêm thư mục src vào path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
 
+from unittest.mock import patch
+from jobs import run_pending_jobs
+
 # from app import app # app được sử dụng trong conftest, không cần ở đây trực tiếp
 # client = TestClient(app) # Đã xóa, sử dụng fixture
 
@@ -16,8 +19,7 @@ def test_get_documents_empty(client):
     # Giả sử DB trống cho test db mới
     response = client.get("/documents/")
     assert response.status_code == 200
-    assert isinstance(response.json(), list)
-    assert len(response.json()) == 0
+    assert response.json() == {"items": [], "next_cursor": None}
 
 def test_upload_file(client, tmp_path):
     # Tạo file giả lập
@@ -40,9 +42,21 @@ def test_upload_file(client, tmp_path):
     assert data["results"][0]["filename"] == "api_test.txt" # Tên gốc trả về trong result thường là tên gốc upload
     # Tuy nhiên, kiểm tra trong message hoặc query DB xem tên lưu là gì nếu cần.
     # Trong app.py: results.append({"filename": file.filename ...}) -> trả về tên gốc.
+    assert data["results"][0]["status"] == "queued"
+    job_id = data["results"][0]["job_id"]
+
+    # Upload chỉ đưa vào hàng đợi, chưa có document nào
+    assert client.get(f"/jobs/{job_id}").json()["status"] == "pending"
+    assert len(client.get("/documents/").json()["items"]) == 0
+
+    # Worker xử lý hàng đợi
+    assert run_pending_jobs() == 1
+    job = client.get(f"/jobs/{job_id}").json()
+    assert job["status"] == "done"
+    assert job["document_id"] is not None
     
     # Kiểm tra DB xem đã lưu đúng tên mới chưa
-    all_docs = client.get("/documents/").json()
+    all_docs = client.get("/documents/").json()["items"]
     saved_doc = next((d for d in all_docs if d['file_name'].startswith("api_test")), None)
     assert saved_doc is not None
     assert "sentence" in saved_doc["file_name"] # api_test_sentence.txt
@@ -57,9 +71,10 @@ def test_document_crud(client, tmp_path):
     with open(p, "rb") as f:
         response = client.post("/upload/", files={"files": ("crud_test.txt", f, "text/plain")})
     assert response.status_code == 200
+    run_pending_jobs()
     
     # Get all to find ID
-    docs = client.get("/documents/").json()
+    docs = client.get("/documents/").json()["items"]
     assert len(docs) > 0
     doc_id = docs[0]["id"]
     
@@ -85,5 +100,359 @@ def test_document_crud(client, tmp_path):
     resp_check = client.get(f"/documents/{doc_id}")
     assert resp_check.status_code == 404
 
+def test_jobs_filter_and_failure(client):
+    # File TXT hợp lệ -> job done; file PDF hỏng -> job thất bại
+    client.post("/upload/", files=[
+        ("files", ("ok.txt", b"Hello.", "text/plain")),
+        ("files", ("broken.pdf", b"not a pdf", "application/pdf")),
+    ])
+    assert len(client.get("/jobs", params={"status": "pending"}).json()) == 2
+
+    run_pending_jobs()
+
+    done = client.get("/jobs", params={"status": "done"}).json()
+    failed = client.get("/jobs", params={"status": "failed"}).json()
+    assert [j["file_name"] for j in done] == ["ok.txt"]
+    assert [j["file_name"] for j in failed] == ["broken.pdf"]
+    assert failed[0]["error"]
+    assert client.get("/jobs/999999").status_code == 404
+
+def test_requeue_running_jobs(client):
+    from database import claim_next_job, requeue_running_jobs
+    client.post("/upload/", files={"files": ("resume.txt", b"Resume me.", "text/plain")})
+
+    # Giả lập server dừng khi job đang chạy
+    job = claim_next_job()
+    assert job["status"] == "running"
+    assert claim_next_job() is None
+
+    # Khởi động lại: job được đưa lại hàng đợi và xử lý tiếp
+    assert requeue_running_jobs() == 1
+    assert run_pending_jobs() == 1
+    job = client.get(f"/jobs/{job['id']}").json()
+    assert job["status"] == "done"
+    assert job["attempts"] == 2
+
+def test_upload_dedup_policies(client):
+    content = b"Same bytes. Uploaded twice."
+    client.post("/upload/", files={"files": ("orig.txt", content, "text/plain")})
+    run_pending_jobs()
+    original = client.get("/documents/").json()["items"][0]
+
+    # skip: phát hiện trùng ngay khi upload, không tạo job
+    resp = client.post("/upload/", files={"files": ("again.txt", content, "text/plain")})
+    result = resp.json()["results"][0]
+    assert result["status"] == "duplicate"
+    assert result["document_id"] == original["id"]
+    assert len(client.get("/jobs").json()) == 1
+
+    # link: tạo document mới, chunks sao chép từ document gốc
+    resp = client.post("/upload/", files={"files": ("linked.txt", content, "text/plain")},
+                       data={"dedup_policy": "link"})
+    assert resp.json()["results"][0]["status"] == "queued"
+    with patch("jobs.stream_chunk_sets") as mock_extract:
+        run_pending_jobs()
+        mock_extract.assert_not_called()
+    docs = client.get("/documents/").json()["items"]
+    assert len(docs) == 2
+    linked = next(d for d in docs if d["id"] != original["id"])
+    assert linked["content_hash"] == original["content_hash"]
+    original_chunks = client.get(f"/documents/{original['id']}").json()["chunks"]
+    linked_chunks = client.get(f"/documents/{linked['id']}").json()["chunks"]
+    assert [c["content"] for c in linked_chunks] == [c["content"] for c in original_chunks]
+
+    assert client.post("/upload/", files={"files": ("x.txt", content, "text/plain")},
+                       data={"dedup_policy": "bogus"}).status_code == 400
+
 if __name__ == "__main__":
     pytest.main([__file__])
+
+def test_upload_failure_leaves_no_file(client):
+    import app as app_module
+    with patch("app.create_job", side_effect=RuntimeError("DB down")):
+        response = client.post("/upload/", files={"files": ("fail.txt", b"Noi dung", "text/plain")})
+    assert response.json()["results"][0] == {"filename": "fail.txt", "status": "error", "message": "DB down"}
+    assert os.listdir(app_module.UPLOAD_DIR) == []
+
+def test_upload_document_names(client):
+    post = lambda content: client.post("/upload/", files={"files": ("same.txt", content, "text/plain")}).json()
+    post(b"Noi dung mot.")
+    run_pending_jobs()
+    # Upload trùng nội dung bị bỏ qua: không tiêu tốn hậu tố tên
+    assert post(b"Noi dung mot.")["results"][0]["status"] == "duplicate"
+    post(b"Noi dung hai.")
+    run_pending_jobs()
+    docs = sorted(client.get("/documents/").json()["items"], key=lambda d: d["id"])
+    assert [d["file_name"] for d in docs] == ["same_sentence.txt", "same_sentence(1).txt"]
+
+    response = client.put(f"/documents/{docs[1]['id']}", params={"new_name": "same_sentence.txt"})
+    assert response.status_code == 409
+
+def test_search_endpoint(client):
+    client.post("/upload/", files=[
+        ("files", ("contract.txt", "Hợp đồng mua bán căn hộ. Giá trị hợp đồng là hai tỷ.".encode("utf-8"), "text/plain")),
+        ("files", ("memo.txt", b"Meeting notes for Monday.", "text/plain")),
+    ])
+    run_pending_jobs()
+
+    data = client.get("/search", params={"q": "hợp đồng"}).json()
+    assert data["results"]
+    assert all(r["file_name"].startswith("contract") for r in data["results"])
+    assert data["has_more"] is False
+
+    page = client.get("/search", params={"q": "hợp đồng", "limit": 1}).json()
+    assert len(page["results"]) == 1
+
+    assert client.get("/search", params={"q": "tỷ"}).json()["results"]
+    assert client.get("/search", params={"q": "  "}).status_code == 400
+
+def test_documents_search_endpoint(client):
+    client.post("/upload/", files=[
+        ("files", ("quarterly_report.txt", b"Q1.", "text/plain")),
+        ("files", ("notes.txt", b"Notes.", "text/plain")),
+    ])
+    run_pending_jobs()
+
+    names = [d["file_name"] for d in client.get("/documents/search", params={"q": "report"}).json()]
+    assert names == ["quarterly_report_sentence.txt"]
+
+    similar = client.get("/documents/search", params={"q": "quarterly reprot", "mode": "similarity"}).json()
+    assert similar and similar[0]["file_name"] == "quarterly_report_sentence.txt"
+
+    assert client.get("/documents/search", params={"q": "x", "mode": "fuzzy"}).status_code == 400
+
+def test_upload_token_mode_and_invalid_mode(client):
+    text = " ".join(f"Câu thứ {i} trong tài liệu." for i in range(300)).encode("utf-8")
+    resp = client.post("/upload/", files={"files": ("tok.txt", text, "text/plain")}, data={"chunk_mode": "token"})
+    assert resp.json()["results"][0]["status"] == "queued"
+    run_pending_jobs()
+    doc = client.get("/documents/").json()["items"][0]
+    assert doc["chunk_mode"] == "token"
+    assert doc["chunk_count"] > 1
+
+    resp = client.post("/upload/", files={"files": ("bad.txt", b"x", "text/plain")}, data={"chunk_mode": "words"})
+    assert resp.status_code == 400
+
+def test_documents_keyset_pagination(client, test_db):
+    from datetime import datetime
+    from database import Document
+    # Hai document cùng upload_date: thứ tự phân định bằng id
+    same_time = datetime(2024, 1, 1)
+    test_db.add_all([Document(file_name=f"doc_{i}.txt", file_path="p", file_type=".txt",
+                              upload_date=same_time if i < 2 else datetime(2024, 1, 1 + i))
+                     for i in range(5)])
+    test_db.commit()
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2}
+        if cursor:
+            params["after"] = cursor
+        page = client.get("/documents/", params=params).json()
+        seen += [d["file_name"] for d in page["items"]]
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    assert seen == ["doc_4.txt", "doc_3.txt", "doc_2.txt", "doc_1.txt", "doc_0.txt"]
+    assert client.get("/documents/", params={"after": "not-a-cursor"}).status_code == 400
+
+def test_document_chunks_paged_and_streamed(client, test_db):
+    import json
+    from database import save_document_with_chunks
+    doc_id = save_document_with_chunks(
+        {'file_name': 'big.txt', 'file_path': 'p', 'file_type': '.txt', 'file_size': 1},
+        [{'chunk_index': i, 'content': f"Đoạn {i}", 'char_count': 6} for i in range(25)]
+    )
+
+    page = client.get(f"/documents/{doc_id}/chunks", params={"limit": 10}).json()
+    assert [c["chunk_index"] for c in page["items"]] == list(range(10))
+    assert page["next_start"] == 10
+    page = client.get(f"/documents/{doc_id}/chunks", params={"start": 20, "limit": 10}).json()
+    assert [c["chunk_index"] for c in page["items"]] == list(range(20, 25))
+    assert page["next_start"] is None
+
+    resp = client.get(f"/documents/{doc_id}/chunks", params={"format": "ndjson", "start": 5, "end": 15})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert [c["chunk_index"] for c in lines] == list(range(5, 15))
+    assert lines[0]["content"] == "Đoạn 5"
+
+    assert client.get("/documents/999999/chunks").status_code == 404
+    assert client.get(f"/documents/{doc_id}/chunks", params={"format": "xml"}).status_code == 400
+
+def test_artifact_stats_endpoint(client):
+    data = client.get("/artifacts/stats").json()
+    assert {"workers", "format", "fsync", "pending", "committed", "failed", "retries", "recent_failures"} <= set(data)
+
+def test_ocr_stats_endpoint(client):
+    data = client.get("/ocr/stats").json()
+    assert data["enabled"] is False
+    assert {"pages", "cache_hits", "cache_hit_rate", "seconds_per_page"} <= set(data)
+
+def test_upload_multiple_chunk_modes_and_rechunk(client):
+    from main import STREAM_PROCESSORS
+    text = "\n".join(f"Đoạn {i}. Câu một của đoạn {i}. Câu hai của đoạn {i}." for i in range(40)).encode("utf-8")
+    stream_txt = STREAM_PROCESSORS['.txt']
+    calls = []
+    def counting(filepath):
+        calls.append(filepath)
+        return stream_txt(filepath)
+
+    resp = client.post("/upload/", files={"files": ("multi.txt", text, "text/plain")},
+                       data={"chunk_mode": "sentence, paragraph"})
+    assert resp.json()["results"][0]["status"] == "queued"
+    with patch.dict('main.STREAM_PROCESSORS', {'.txt': counting}):
+        run_pending_jobs()
+    # Trích xuất một lần cho cả hai bộ chunks, một document duy nhất
+    assert len(calls) == 1
+    docs = client.get("/documents/").json()["items"]
+    assert len(docs) == 1
+    doc = docs[0]
+    assert doc["file_name"] == "multi_sentence_paragraph.txt"
+    assert doc["chunk_mode"] == "sentence"
+
+    detail = client.get(f"/documents/{doc['id']}").json()
+    assert [(s["chunk_mode"], s["primary"]) for s in detail["chunk_sets"]] == [("sentence", True), ("paragraph", False)]
+    sentence = [c["content"] for c in detail["chunks"]]
+    paragraph = [c["content"] for c in client.get(f"/documents/{doc['id']}", params={"chunk_mode": "paragraph"}).json()["chunks"]]
+    assert sentence != paragraph
+    assert "".join("".join(paragraph).split()) == "".join(text.decode("utf-8").split())
+    page = client.get(f"/documents/{doc['id']}/chunks", params={"chunk_mode": "paragraph", "limit": 1000}).json()
+    assert [c["content"] for c in page["items"]] == paragraph
+    assert client.get(f"/documents/{doc['id']}/chunks", params={"chunk_mode": "token"}).status_code == 404
+
+    # Upload lại với một mode đã có: trùng document, không tạo job
+    resp = client.post("/upload/", files={"files": ("again.txt", text, "text/plain")}, data={"chunk_mode": "paragraph"})
+    assert resp.json()["results"][0]["status"] == "duplicate"
+
+    # Rechunk: thêm bộ token, thay bộ paragraph
+    resp = client.post(f"/documents/{doc['id']}/rechunk", data={"chunk_mode": "token,paragraph"})
+    assert resp.status_code == 200
+    body = resp.json()
+    assert set(body["rechunked"]) == {"token", "paragraph"}
+    assert {s["chunk_mode"]: s["chunk_count"] for s in body["chunk_sets"]} == {
+        "sentence": len(sentence), "paragraph": len(paragraph), "token": body["rechunked"]["token"]
+    }
+    assert [c["content"] for c in client.get(f"/documents/{doc['id']}", params={"chunk_mode": "paragraph"}).json()["chunks"]] == paragraph
+
+    assert client.post("/documents/999999/rechunk", data={"chunk_mode": "token"}).status_code == 404
+    assert client.post(f"/documents/{doc['id']}/rechunk", data={"chunk_mode": "words"}).status_code == 400
+
+def test_rechunk_db_failure_keeps_chunk_files(client):
+    import chunk_store
+    from database import get_document
+    from main import rechunk_document, _chunks_dir
+    text = "\n\n".join(f"Đoạn {i}. Câu một. Câu hai." for i in range(10)).encode("utf-8")
+    client.post("/upload/", files={"files": ("keep.txt", text, "text/plain")}, data={"chunk_mode": "paragraph"})
+    run_pending_jobs()
+    assert chunk_store.WRITE_BEHIND.drain(timeout=10)
+    document = get_document(client.get("/documents/").json()["items"][0]["id"])
+    path = _chunks_dir(document.file_path, document.file_name, "paragraph")
+    with chunk_store.open_reader(path) as reader:
+        before = list(reader)
+    assert before
+
+    # Ghi DB lỗi: chunks vật lý cũ còn nguyên, không còn chunks ghi dở ở chỗ tạm
+    with patch('main.replace_chunk_sets', side_effect=RuntimeError("DB lỗi")):
+        with pytest.raises(RuntimeError):
+            rechunk_document(document.id, ["paragraph"])
+    assert chunk_store.WRITE_BEHIND.drain(timeout=10)
+    with chunk_store.open_reader(path) as reader:
+        assert list(reader) == before
+    assert not os.path.exists(path + chunk_store.STAGING_SUFFIX)
+
+    assert rechunk_document(document.id, ["paragraph"]) == {"paragraph": len(before)}
+    assert chunk_store.WRITE_BEHIND.drain(timeout=10)
+    with chunk_store.open_reader(path) as reader:
+        assert list(reader) == before
+    assert not os.path.exists(path + chunk_store.STAGING_SUFFIX)
+
+def test_read_endpoints_use_async_session(client, monkeypatch):
+    import json
+    import chunk_codec
+    import database
+    from database import save_document_with_chunks
+    monkeypatch.setattr(chunk_codec, 'CHUNK_COMPRESSION', 'zlib')
+    monkeypatch.setattr(chunk_codec, 'CHUNK_COMPRESSION_MIN_BYTES', 16)
+    monkeypatch.setattr(database, 'CHUNK_STREAM_BATCH_SIZE', 4)
+    contents = [f"Điều {i}: bên thuê thanh toán hóa đơn điện nước hằng tháng." for i in range(10)]
+    doc_id = save_document_with_chunks({'file_name': 'async.txt', 'file_path': 'p', 'file_type': '.txt'},
+                                       [{'chunk_index': i, 'content': c} for i, c in enumerate(contents)])
+
+    # Mọi truy vấn của endpoint đọc đi qua AsyncSession (aiosqlite), kể cả chunk nén và snippet FTS
+    sessions = []
+    def counting_session():
+        sessions.append(1)
+        return database.AsyncSessionLocal.__wrapped__()
+    counting_session.__wrapped__ = database.AsyncSessionLocal
+    with patch('database.AsyncSessionLocal', counting_session):
+        assert [c["content"] for c in client.get(f"/documents/{doc_id}").json()["chunks"]] == contents
+        lines = client.get(f"/documents/{doc_id}/chunks", params={"format": "ndjson"}).text.splitlines()
+        assert [json.loads(line)["content"] for line in lines] == contents
+        hits = client.get("/search", params={"q": "điện nước"}).json()["results"]
+        assert len(hits) == 10 and "<b>điện</b>" in hits[0]["snippet"]
+    # Một session cho mỗi request; ndjson: thêm một session cho mỗi trang 4 chunks được stream
+    assert len(sessions) == 1 + (1 + 3) + 1
+
+def test_upload_admission_control(client):
+    from admission import IngestAdmission
+    ingest = IngestAdmission(max_concurrency=1, max_pending_files=3, max_pending_bytes=10 ** 6,
+                             max_files=2, max_file_bytes=1000, max_request_bytes=10 ** 5, retry_after=7)
+    upload = lambda *names: client.post("/upload/", files=[("files", (n, f"Nội dung {n}".encode(), "text/plain"))
+                                                           for n in names])
+    with patch("admission.INGEST", ingest):
+        # Giới hạn mỗi request: số file, kích thước mỗi file, kích thước body
+        assert upload("a.txt", "b.txt", "c.txt").status_code == 413
+        big = client.post("/upload/", files=[("files", ("big.txt", b"x" * 1200, "text/plain")),
+                                             ("files", ("ok.txt", b"ok", "text/plain"))]).json()["results"]
+        assert [r["status"] for r in big] == ["error", "queued"]
+        # Body lớn hơn max_files file cỡ tối đa bị từ chối theo Content-Length, trước khi được đọc
+        assert ingest.request_limit() == 2000
+        assert client.post("/upload/", files={"files": ("huge.txt", b"x" * 5000, "text/plain")}).status_code == 413
+
+        # Hàng đợi còn 2 chỗ: request 2 file được nhận, request tiếp theo bị từ chối kèm Retry-After
+        assert [r["status"] for r in upload("d.txt", "e.txt").json()["results"]] == ["queued", "queued"]
+        response = upload("f.txt")
+        assert response.status_code == 429 and response.headers["Retry-After"] == "7"
+        stats = client.get("/upload/stats").json()
+        assert stats["pending_files"] == 3 and stats["pending_bytes"] > 0
+        assert stats["active_uploads"] == 0 and stats["reserved_files"] == 0
+
+        # Worker xử lý xong -> ngân sách được trả lại
+        assert run_pending_jobs() == 3
+        assert client.get("/upload/stats").json()["pending_files"] == 0
+        assert upload("f.txt").status_code == 200
+
+        # Body chunked (không có Content-Length): không kiểm tra được kích thước trước khi đọc -> 411
+        boundary = "ranh-gioi"
+        def chunked_body():
+            yield f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"h.txt\"\r\n".encode()
+            yield b"Content-Type: text/plain\r\n\r\n" + b"x" * 5000
+            yield f"\r\n--{boundary}--\r\n".encode()
+        response = client.post("/upload/", content=chunked_body(),
+                               headers={"Content-Type": f"multipart/form-data; boundary={boundary}"})
+        assert response.status_code == 411
+        assert client.get("/upload/stats").json()["reserved_bytes"] == 0
+
+        # Đang có một upload khác được nhận (max_concurrency=1)
+        ticket = ingest.enter()
+        assert upload("g.txt").status_code == 429
+        ingest.leave(ticket)
+
+        stats = client.get("/upload/stats").json()
+        assert stats["rejected"] == {'busy': 1, 'pending_files': 1, 'pending_bytes': 0, 'too_many_files': 1,
+                                     'request_too_large': 1, 'file_too_large': 1, 'length_required': 1}
+        assert stats["accepted_files"] == 4 and stats["pending_files"] == 1
+
+    # Byte của file vào hàng đợi được chuyển từ phần Content-Length request đã giữ, không cộng thêm
+    ingest = IngestAdmission(max_concurrency=0, max_pending_files=0, max_pending_bytes=0)
+    ticket = ingest.enter(1000)
+    ingest.admit_files(ticket, 2)
+    ingest.track(ticket, 1, 600)
+    assert (ingest.as_dict()["reserved_bytes"], ingest.as_dict()["pending_bytes"]) == (400, 600)
+    ingest.track(ticket, 2, 300)
+    ingest.leave(ticket)
+    assert (ingest.as_dict()["reserved_bytes"], ingest.as_dict()["pending_bytes"]) == (0, 900)
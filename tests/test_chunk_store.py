@@ -0,0 +1,174 @@
+import sys
+import os
+import pytest
+
+# Thêm thư mục src vào path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import chunk_store
+from chunk_store import open_writer, open_reader, read_chunk, remove_chunks, PackedChunkReader, ChunkWriteBehind
+
+CHUNKS = ["Chunk đầu tiên.", "", "Tiếng Việt có dấu: ắ ề ộ ữ", "x" * 5000]
+
+@pytest.mark.parametrize("chunk_format", ["files", "packed"])
+def test_write_and_read_chunks(tmp_path, chunk_format):
+    path = str(tmp_path / "chunks_data" / "doc_txt_sentence_chunks")
+    writer = open_writer(path, chunk_format)
+    for content in CHUNKS:
+        writer.write(content)
+    writer.close()
+
+    with open_reader(path) as reader:
+        assert len(reader) == len(CHUNKS)
+        assert reader[2] == CHUNKS[2]
+        assert reader[-1] == CHUNKS[-1]
+        assert list(reader) == CHUNKS
+        with pytest.raises(IndexError):
+            reader[len(CHUNKS)]
+    assert read_chunk(path, 0) == CHUNKS[0]
+
+    remove_chunks(path)
+    assert os.listdir(tmp_path / "chunks_data") == []
+
+def test_packed_layout_is_two_files(tmp_path):
+    path = str(tmp_path / "doc_chunks")
+    writer = open_writer(path, "packed")
+    for i in range(1000):
+        writer.write(f"chunk {i}")
+    # Trong lúc ghi chỉ có file .tmp: reader không thấy artifact ghi dở
+    assert sorted(os.listdir(tmp_path)) == ["doc_chunks.idx.tmp", "doc_chunks.pack.tmp"]
+    writer.close()
+    assert sorted(os.listdir(tmp_path)) == ["doc_chunks.idx", "doc_chunks.pack"]
+
+    with open_reader(path) as reader:
+        assert isinstance(reader, PackedChunkReader)
+        assert reader[737] == "chunk 737"
+
+def test_packed_abort_and_invalid_format(tmp_path):
+    path = str(tmp_path / "doc_chunks")
+    writer = open_writer(path, "packed")
+    writer.write("a")
+    writer.abort()
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(ValueError):
+        open_writer(path, "zip")
+
+def _failing_write_batch(original, fail_calls):
+    """write_batch lỗi ở các lần gọi thứ fail_calls (bắt đầu từ 1); file packed bị ghi dở trước khi lỗi."""
+    calls = []
+
+    def write_batch(self, contents):
+        calls.append(contents)
+        if len(calls) in fail_calls:
+            if getattr(self, '_data', None) is not None:
+                self._data.write(b"ghi do")
+            raise OSError("disk busy")
+        return original(self, contents)
+    return write_batch
+
+@pytest.mark.parametrize("chunk_format", ["files", "packed"])
+def test_write_behind_retries_transient_errors(tmp_path, monkeypatch, chunk_format):
+    monkeypatch.setattr(chunk_store, "CHUNK_WRITE_RETRY_DELAY", 0)
+    writer_class = chunk_store.PackedChunkWriter if chunk_format == "packed" else chunk_store.ChunkDirWriter
+    monkeypatch.setattr(writer_class, "write_batch", _failing_write_batch(writer_class.write_batch, {1, 3}))
+
+    behind = ChunkWriteBehind(workers=2, queue_size=1, batch_size=2, retries=2)
+    path = str(tmp_path / "doc_chunks")
+    artifact = behind.open(path, chunk_format)
+    for i in range(4):
+        artifact.write(f"chunk {i}")
+    artifact.commit()
+    assert behind.shutdown(timeout=10)
+
+    with open_reader(path) as reader:
+        assert list(reader) == [f"chunk {i}" for i in range(4)]
+    stats = behind.stats.as_dict()
+    assert (stats['committed'], stats['failed'], stats['retries'], stats['chunks_written']) == (1, 0, 2, 4)
+
+def test_write_behind_failure_is_surfaced_and_abort(tmp_path, monkeypatch):
+    monkeypatch.setattr(chunk_store, "CHUNK_WRITE_RETRY_DELAY", 0)
+    monkeypatch.setattr(chunk_store.PackedChunkWriter, "write_batch",
+                        _failing_write_batch(chunk_store.PackedChunkWriter.write_batch, {1, 2, 3}))
+    behind = ChunkWriteBehind(workers=1, batch_size=1, retries=2)
+
+    failed = behind.open(str(tmp_path / "failed_chunks"), "packed")
+    failed.write("a")
+    failed.commit()
+    aborted = behind.open(str(tmp_path / "aborted_chunks"), "files")
+    aborted.write("b")
+    aborted.abort()
+    assert behind.drain(timeout=10)
+
+    stats = behind.stats.as_dict()
+    assert (stats['failed'], stats['aborted'], stats['committed'], stats['retries']) == (1, 1, 0, 2)
+    assert stats['recent_failures'] == [{'path': str(tmp_path / "failed_chunks"), 'error': "disk busy"}]
+    assert os.listdir(tmp_path) == []
+    behind.shutdown()
+
+@pytest.mark.parametrize("chunk_format", ["files", "packed"])
+def test_write_behind_same_path_serialized(tmp_path, chunk_format):
+    # Cùng path mở hai lần liên tiếp (vd: chunk lại khi lần ghi đầu còn trong hàng đợi):
+    # cùng một thread ghi, theo thứ tự mở, artifact sau thắng
+    behind = ChunkWriteBehind(workers=4, batch_size=1)
+    path = str(tmp_path / "doc_chunks")
+    first = behind.open(path, chunk_format)
+    second = behind.open(path, chunk_format)
+    assert first._worker == second._worker
+    for i in range(50):
+        first.write(f"cũ {i}")
+    first.commit()
+    for i in range(3):
+        second.write(f"mới {i}")
+    second.commit()
+    assert behind.shutdown(timeout=10)
+
+    with open_reader(path) as reader:
+        chunks = list(reader)
+    # Định dạng files không tự xóa các chunk thừa của artifact trước (rechunk dùng replace=True)
+    assert chunks[:3] == [f"mới {i}" for i in range(3)]
+    if chunk_format == "packed":
+        assert len(chunks) == 3
+    assert behind.stats.as_dict()['committed'] == 2
+
+@pytest.mark.parametrize("old_format,new_format", [("files", "files"), ("packed", "packed"), ("files", "packed")])
+def test_write_behind_replace(tmp_path, old_format, new_format):
+    behind = ChunkWriteBehind(workers=2, batch_size=1)
+    path = str(tmp_path / "doc_chunks")
+    old = behind.open(path, old_format)
+    for i in range(5):
+        old.write(f"cũ {i}")
+    old.commit()
+
+    # abort: chunks cũ giữ nguyên, phần ghi dở ở chỗ tạm bị bỏ
+    aborted = behind.open(path, new_format, replace=True)
+    assert aborted._worker == old._worker
+    aborted.write("bỏ")
+    aborted.abort()
+    assert behind.drain(timeout=10)
+    with open_reader(path) as reader:
+        assert list(reader) == [f"cũ {i}" for i in range(5)]
+
+    replaced = behind.open(path, new_format, replace=True)
+    for i in range(2):
+        replaced.write(f"mới {i}")
+    replaced.commit()
+    assert behind.shutdown(timeout=10)
+    with open_reader(path) as reader:
+        assert list(reader) == ["mới 0", "mới 1"]
+    assert sorted(os.listdir(tmp_path)) == (["doc_chunks"] if new_format == "files"
+                                            else ["doc_chunks.idx", "doc_chunks.pack"])
+
+def test_write_behind_inline_and_fsync(tmp_path):
+    # workers=0: ghi ngay trong thread gọi, không có thread nền
+    behind = ChunkWriteBehind(workers=0, batch_size=10)
+    path = str(tmp_path / "doc_chunks")
+    artifact = behind.open(path, "packed", fsync="always")
+    artifact.write("Xin chào")
+    artifact.commit()
+    assert read_chunk(path, 0) == "Xin chào"
+    assert behind.shutdown() and behind.stats.as_dict()['committed'] == 1
+    with pytest.raises(ValueError):
+        behind.open(path, "packed", fsync="sometimes")
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -5,7 +5,9 @@ import pytest
 # Thêm thư mục src vào path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
 
-from chunker import chunk_text
+import re
+import random
+from chunker import chunk_text, chunk_text_iter, split_sentences, split_sentences_iter, count_tokens, chunk_text_offsets_iter
 
 def test_chunk_text_empty():
     assert chunk_text("") == []
@@ -26,5 +28,161 @@ def test_chunk_text_limit():
     for chunk in chunks:
         assert len(chunk) <= 100
 
+def _legacy_chunk_text(text, mode="sentence", max_size=1000):
+    """Cài đặt chunk_text trước khi chuyển sang streaming, dùng làm chuẩn so sánh."""
+    if not text:
+        return []
+    text = text.strip()
+    chunks = []
+    current = ""
+    if mode == "paragraph":
+        parts = [p.strip() for p in text.split("\n") if p.strip()]
+        glue = "\n"
+    else:
+        parts = re.findall(r'[^.!?]*[.!?]', text)
+        parts = [s.strip() for s in parts if s.strip()]
+        glue = " "
+        if not parts:
+            parts = [text[i:i+max_size] for i in range(0, len(text), max_size)]
+            return [p.strip() for p in parts if p.strip()]
+    for p in parts:
+        item = p + glue
+        if len(item) > max_size:
+            if current:
+                chunks.append(current.strip())
+                current = ""
+            start = 0
+            while start < len(item):
+                chunks.append(item[start:start + max_size].strip())
+                start += max_size
+            continue
+        if len(current) + len(item) <= max_size:
+            current += item
+        else:
+            chunks.append(current.strip())
+            current = item
+    if current:
+        chunks.append(current.strip())
+    return chunks
+
+def _random_pieces(rng, text):
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text), rng.randint(0, 8))))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+@pytest.mark.parametrize("mode", ["sentence", "paragraph"])
+def test_chunk_text_iter_matches_legacy(mode):
+    rng = random.Random(1234)
+    alphabet = ["a", "b", "ạ", " ", "  ", "\n", "\t", ".", "!", "?", "xyz", " " * 12]
+    for _ in range(3000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 80)))
+        max_size = rng.choice([1, 2, 3, 5, 8, 13])
+        expected = _legacy_chunk_text(text, mode=mode, max_size=max_size)
+        assert chunk_text(text, mode=mode, max_size=max_size) == expected, (text, max_size)
+        pieces = _random_pieces(rng, text)
+        assert list(chunk_text_iter(pieces, mode=mode, max_size=max_size)) == expected, (pieces, max_size)
+
+def test_chunk_text_iter_streams_incrementally():
+    # Chunk đầu tiên được trả ra trước khi đọc hết nguồn
+    consumed = []
+    def pages():
+        for i in range(1000):
+            consumed.append(i)
+            yield f"Trang {i} có nội dung. " * 20
+
+    first = next(chunk_text_iter(pages(), max_size=200))
+    assert first.startswith("Trang 0")
+    assert len(consumed) == 1
+
+    # Một câu rất dài không có dấu kết câu vẫn được chia dần theo max_size
+    consumed.clear()
+    def long_run():
+        for i in range(1000):
+            consumed.append(i)
+            yield "x" * 100
+    chunks = chunk_text_iter(long_run(), max_size=250)
+    assert next(chunks) == "x" * 250
+    assert len(consumed) == 3
+
+def test_split_sentences_vietnamese():
+    text = ("Ông Nguyễn V. An sống tại TP. Hồ Chí Minh. Giá là 3.14 triệu, tức 1.000.000 đồng! "
+            "Anh ấy chờ... rồi đi. Thật vậy… Sau đó ThS. Lê nói: \"Xong.\" Các loại quả, v.v. "
+            "Phần cuối không có dấu chấm")
+    assert split_sentences(text) == [
+        "Ông Nguyễn V. An sống tại TP. Hồ Chí Minh.",
+        "Giá là 3.14 triệu, tức 1.000.000 đồng!",
+        "Anh ấy chờ... rồi đi.",
+        "Thật vậy…",
+        "Sau đó ThS. Lê nói: \"Xong.\"",
+        "Các loại quả, v.v.",
+        "Phần cuối không có dấu chấm",
+    ]
+    assert split_sentences("Dòng một\n\nDòng hai") == ["Dòng một", "Dòng hai"]
+
+    # Kết quả không phụ thuộc cách chia mảnh
+    rng = random.Random(5)
+    for _ in range(200):
+        assert list(split_sentences_iter(_random_pieces(rng, text))) == split_sentences(text)
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("Xin chào, thế giới!") == 6
+    assert count_tokens("internationalization") == 5
+
+@pytest.mark.parametrize("mode", ["token", "sliding"])
+def test_token_modes_respect_budget_and_overlap(mode):
+    text = " ".join(f"Câu số {i} nói về chủ đề {i % 7} với vài từ nữa." for i in range(200))
+    chunks = chunk_text(text, mode=mode, max_tokens=40, overlap_tokens=15)
+    assert len(chunks) > 1
+    assert all(count_tokens(c) <= 40 for c in chunks)
+    # Không mất nội dung: câu đầu và câu cuối đều có mặt
+    assert chunks[0].startswith("Câu số 0 ")
+    assert chunks[-1].endswith("Câu số 199 nói về chủ đề 3 với vài từ nữa.")
+    # Hai chunk liền nhau gối đầu lên nhau
+    for prev, nxt in zip(chunks, chunks[1:]):
+        assert nxt[:8] in prev[-80:]
+    if mode == "token":
+        # Ranh giới chunk trùng ranh giới câu
+        assert all(c.startswith("Câu số") and c.endswith(".") for c in chunks)
+
+    rng = random.Random(9)
+    assert list(chunk_text_iter(_random_pieces(rng, text), mode=mode, max_tokens=40, overlap_tokens=15)) == chunks
+
+@pytest.mark.parametrize("mode", ["token", "sliding"])
+def test_token_modes_random_texts(mode):
+    rng = random.Random(21)
+    alphabet = ["a", "Bx", " ", "\n", ".", "!", "?", "...", "TP", "3.1", "\n\n", "ư", "x" * 26]
+    for _ in range(1000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60)))
+        budget = rng.randint(1, 12)
+        overlap = rng.randint(0, budget - 1)
+        chunks = chunk_text(text, mode=mode, max_tokens=budget, overlap_tokens=overlap)
+        assert all(c and count_tokens(c) <= budget for c in chunks), (text, budget, overlap)
+        # Mọi ký tự (trừ khoảng trắng) đều xuất hiện trong kết quả
+        assert set("".join("".join(chunks).split())) == set("".join(text.split()))
+        pieces = _random_pieces(rng, text)
+        assert list(chunk_text_iter(pieces, mode=mode, max_tokens=budget, overlap_tokens=overlap)) == chunks
+
+def test_token_mode_splits_oversized_sentence():
+    text = "Ngắn. " + " ".join(["từ"] * 100) + ". Cuối."
+    chunks = chunk_text(text, mode="token", max_tokens=30, overlap_tokens=0)
+    assert chunks[0] == "Ngắn."
+    assert all(count_tokens(c) <= 30 for c in chunks)
+    assert " ".join(chunks).split() == text.split()
+    with pytest.raises(ValueError):
+        chunk_text(text, mode="token", max_tokens=10, overlap_tokens=10)
+
 if __name__ == "__main__":
     pytest.main([__file__])
+
+@pytest.mark.parametrize("mode", ["sentence", "paragraph", "token", "sliding"])
+def test_chunk_text_offsets_iter(mode):
+    text = "".join(f"Trang {p}, câu {i} có nội dung.\n" for p in range(1, 6) for i in range(40))
+    pieces = _random_pieces(random.Random(mode), text)
+    located = list(chunk_text_offsets_iter(pieces, mode=mode, max_size=300, max_tokens=60, overlap_tokens=10))
+    assert [chunk for _, chunk in located] == chunk_text(text, mode=mode, max_size=300,
+                                                          max_tokens=60, overlap_tokens=10)
+    offsets = [offset for offset, _ in located]
+    assert None not in offsets
+    assert offsets == sorted(offsets)
+    for offset, chunk in located:
+        assert text[offset:].startswith(chunk.split()[0])
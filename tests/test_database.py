@@ -8,9 +8,11 @@ from sqlalchemy.orm import sessionmaker
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
 
 from database import (
-    Base, Document, Chunk, get_unique_filename, check_document_exists, init_database,
+    Base, Document, Chunk, save_document, check_document_exists, init_database,
     delete_document, update_document, search_documents_by_name, get_all_documents,
-    get_document, get_chunks
+    get_document, get_chunks, save_document_with_chunks, find_document_by_hash,
+    link_document, _upgrade_schema, save_chunks, _insert_chunks, search_chunks,
+    encode_cursor, decode_cursor, get_chunk_range, iter_chunks
 )
 
 # Sử dụng database kiểm thử riêng biệt hoặc cùng một database?
@@ -43,35 +45,105 @@ def test_connection(db_session):
     result = db_session.execute(text("SELECT 1"))
     assert result.scalar() == 1
 
-def test_get_unique_filename(db_session):
-    """Kiểm tra logic tự động đổi tên"""
-    # Dọn dẹp các file có thể đang tồn tại
-    base_name = "pytest_renaming.txt"
-    existing = db_session.query(Document).filter(Document.file_name.like(f"pytest_renaming%")).all()
-    for doc in existing:
-        db_session.delete(doc)
-    db_session.commit()
+def test_document_name_allocation(db_session):
+    """Tên trùng được cấp hậu tố (n) khi thêm document; tên của lần lưu thất bại không bị tiêu tốn"""
+    info = lambda: {'file_name': "pytest_renaming.txt", 'file_path': "path", 'file_type': ".txt"}
+    ids = [save_document(info()) for _ in range(2)]
 
-    # 1. File đầu tiên
-    name1 = get_unique_filename(base_name)
-    assert name1 == base_name
-    
-    # Tạo doc giả lập
-    doc1 = Document(file_name=name1, file_path="path", file_type=".txt")
-    db_session.add(doc1)
+    def broken_chunks():
+        yield {'chunk_index': 0, 'content': "a"}
+        raise RuntimeError("extract failed")
+    with pytest.raises(RuntimeError):
+        save_document_with_chunks(info(), broken_chunks())
+
+    saved = info()
+    ids.append(save_document_with_chunks(saved, []))
+    assert saved['file_name'] == "pytest_renaming(2).txt"
+    assert [db_session.get(Document, i).file_name for i in ids] == [
+        "pytest_renaming.txt", "pytest_renaming(1).txt", "pytest_renaming(2).txt"
+    ]
+
+def test_document_name_allocation_constant_queries(db_session):
+    """Số truy vấn không phụ thuộc số bản trùng; bộ đếm khởi tạo từ documents có sẵn"""
+    from sqlalchemy import event
+    db_session.add_all(
+        [Document(file_name="report.pdf", file_path="p", file_type=".pdf")] +
+        [Document(file_name=f"report({i}).pdf", file_path="p", file_type=".pdf") for i in range(1, 300)] +
+        # Không được tính: ký tự _ trong LIKE phải được escape, hậu tố không phải số
+        [Document(file_name="reportx(900).pdf", file_path="p", file_type=".pdf"),
+         Document(file_name="report(abc).pdf", file_path="p", file_type=".pdf")]
+    )
     db_session.commit()
+    info = lambda name="report.pdf": {'file_name': name, 'file_path': "p", 'file_type': ".pdf"}
+    name_of = lambda doc_id: db_session.get(Document, doc_id).file_name
 
-    # 2. File thứ hai (trùng lặp)
-    name2 = get_unique_filename(base_name)
-    assert name2 == "pytest_renaming(1).txt"
-    
-    doc2 = Document(file_name=name2, file_path="path", file_type=".txt")
-    db_session.add(doc2)
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(db_session.get_bind(), "before_cursor_execute", count)
+    try:
+        # Lần đầu: khởi tạo bộ đếm từ dữ liệu có sẵn
+        first_id = save_document(info())
+        first = len(statements)
+        statements.clear()
+        # Các lần sau: chỉ UPDATE bộ đếm + INSERT document
+        second_id = save_document(info())
+        assert len(statements) <= first
+        assert len(statements) <= 4
+    finally:
+        event.remove(db_session.get_bind(), "before_cursor_execute", count)
+    assert (name_of(first_id), name_of(second_id)) == ("report(300).pdf", "report(301).pdf")
+
+    # Tên được cấp đã bị chiếm (document đổi tên thủ công / file gốc tên "report(302).pdf"):
+    # unique index từ chối, bộ đếm được đồng bộ lại và cấp hậu tố tiếp theo
+    literal_id = save_document(info("report(302).pdf"))
+    assert name_of(literal_id) == "report(302).pdf"
+    assert name_of(save_document(info())) == "report(303).pdf"
+    assert name_of(save_document(info("report_x.pdf"))) == "report_x.pdf"
+
+    from sqlalchemy.exc import IntegrityError
+    db_session.add(Document(file_name="report.pdf", file_path="p", file_type=".pdf"))
+    with pytest.raises(IntegrityError):
+        db_session.commit()
+    db_session.rollback()
+
+def test_document_name_allocation_retries_on_conflict(db_session):
+    """Hai request cùng khởi tạo bộ đếm -> vi phạm khóa chính, request thua thử lại"""
+    from sqlalchemy.exc import IntegrityError
+    real_flush = db_session.flush
+    calls = []
+    def flaky_flush(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 1:
+            raise IntegrityError("INSERT INTO file_name_counters", {}, Exception("duplicate key"))
+        return real_flush(*args, **kwargs)
+
+    info = lambda: {'file_name': "race.txt", 'file_path': "p", 'file_type': ".txt"}
+    with patch.object(db_session, 'flush', side_effect=flaky_flush):
+        first_id = save_document(info())
+    # Lần thử thứ hai: flush bộ đếm + flush document
+    assert len(calls) == 3
+    assert db_session.get(Document, first_id).file_name == "race.txt"
+    assert db_session.get(Document, save_document(info())).file_name == "race(1).txt"
+
+def test_duplicate_names_resolved_before_unique_index(db_session):
+    """Dữ liệu cũ có tên trùng: đổi tên các bản sau rồi mới tạo unique index"""
+    from database import _resolve_duplicate_names
+    bind = db_session.get_bind()
+    db_session.execute(text("DROP INDEX uq_documents_file_name"))
+    db_session.commit()
+    names = ["dup.txt", "dup.txt", "dup(1).txt", "dup.txt"]
+    docs = [Document(file_name=name, file_path="p", file_type=".txt") for name in names]
+    db_session.add_all(docs)
     db_session.commit()
+    ids = [doc.id for doc in docs]
 
-    # 3. File thứ ba
-    name3 = get_unique_filename(base_name)
-    assert name3 == "pytest_renaming(2).txt"
+    _resolve_duplicate_names(bind)
+    _upgrade_schema(bind)
+    db_session.expire_all()
+    assert [db_session.get(Document, i).file_name for i in ids] == ["dup.txt", "dup(2).txt", "dup(1).txt", "dup(3).txt"]
+    assert db_session.get(Document, save_document({'file_name': "dup.txt", 'file_path': "p",
+                                                   'file_type': ".txt"})).file_name == "dup(4).txt"
 
 def test_check_document_exists(db_session):
     """Kiểm tra sự tồn tại của tài liệu"""
@@ -151,19 +223,52 @@ def test_search_documents(db_session):
     assert "invoice_2023.pdf" in filenames
     assert "report_2023.docx" in filenames
 
+def test_search_documents_trigram(db_session):
+    db_session.add_all([
+        Document(file_name="Hợp_đồng_thuê_nhà.pdf", file_path="p1", file_type=".pdf"),
+        Document(file_name="invoice_2023.pdf", file_path="p2", file_type=".pdf"),
+        Document(file_name="100%_done.txt", file_path="p3", file_type=".txt"),
+    ])
+    db_session.commit()
+
+    # Chuỗi con, không phân biệt hoa thường (kể cả chữ có dấu)
+    assert [r['file_name'] for r in search_documents_by_name("HỢP_ĐỒNG")] == ["Hợp_đồng_thuê_nhà.pdf"]
+    # Chuỗi ngắn hơn một trigram và ký tự đặc biệt của LIKE
+    assert [r['file_name'] for r in search_documents_by_name("0%")] == ["100%_done.txt"]
+    assert search_documents_by_name("_x") == []
+
+    # Gõ sai vẫn tìm được ở chế độ similarity
+    results = search_documents_by_name("invoce 2023", mode="similarity")
+    assert results[0]['file_name'] == "invoice_2023.pdf"
+    assert 0 < results[0]['similarity'] <= 1
+    assert search_documents_by_name("zzzz", mode="similarity") == []
+
+    # Index cập nhật khi đổi tên
+    doc_id = results[0]['id']
+    update_document(doc_id, {"file_name": "receipt.pdf"})
+    assert search_documents_by_name("invoice") == []
+    assert [r['id'] for r in search_documents_by_name("ceipt")] == [doc_id]
+
 def test_get_all_documents(db_session):
     """Kiểm tra lấy tất cả document"""
     # Count current
-    initial_count = len(get_all_documents())
+    initial_count = len(get_all_documents()['items'])
     
     # Add new
     doc = Document(file_name="new_doc.txt", file_path="p", file_type=".txt")
     db_session.add(doc)
     db_session.commit()
     
-    new_count = len(get_all_documents())
+    new_count = len(get_all_documents()['items'])
     assert new_count == initial_count + 1
 
+    # Trang cuối không có cursor tiếp theo; cursor mã hóa được (upload_date, id)
+    assert get_all_documents(limit=new_count)['next_cursor'] is None
+    assert get_all_documents(limit=1, after=encode_cursor(doc.upload_date, doc.id))['items'] == []
+    with pytest.raises(ValueError):
+        get_all_documents(after="???")
+    assert decode_cursor(encode_cursor(doc.upload_date, doc.id)) == (doc.upload_date, doc.id)
+
 def test_get_document_and_chunks(db_session):
     """Kiểm tra lấy chi tiết document và chunks"""
     doc = Document(file_name="detail_test.txt", file_path="p", file_type=".txt")
@@ -186,5 +291,310 @@ def test_get_document_and_chunks(db_session):
     assert len(chunks) == 2
     assert chunks[0].content == "c1"
 
+def test_save_document_with_chunks_atomic(db_session):
+    """Document và chunks được ghi cùng nhau, lỗi thì không để lại document thiếu chunks"""
+    file_info = {'file_name': "atomic.txt", 'file_path': "p", 'file_type': ".txt", 'file_size': 10}
+    chunks_data = [
+        {'chunk_index': 0, 'content': "c0", 'char_count': 2},
+        {'chunk_index': 1, 'content': "c1"},
+    ]
+    doc_id = save_document_with_chunks(file_info, chunks_data)
+    assert get_document(doc_id).chunk_count == 2
+    assert [c.content for c in get_chunks(doc_id)] == ["c0", "c1"]
+
+    # Chunk thiếu content -> rollback toàn bộ
+    bad_info = dict(file_info, file_name="atomic_bad.txt")
+    with pytest.raises(KeyError):
+        save_document_with_chunks(bad_info, [{'chunk_index': 0}])
+    assert check_document_exists("atomic_bad.txt") is False
+
+def test_find_and_link_document_by_hash(db_session):
+    """Tìm document theo hash nội dung và tạo document liên kết (sao chép chunks)"""
+    file_info = {'file_name': "orig.txt", 'file_path': "p", 'file_type': ".txt",
+                 'content_hash': "a" * 64, 'chunk_mode': "sentence"}
+    chunks_data = [{'chunk_index': 0, 'content': "c0", 'page_number': 1}, {'chunk_index': 1, 'content': "c1"}]
+    doc_id = save_document_with_chunks(file_info, chunks_data)
+
+    assert find_document_by_hash("a" * 64) == doc_id
+    assert find_document_by_hash("a" * 64, "sentence") == doc_id
+    assert find_document_by_hash("a" * 64, "paragraph") is None
+    assert find_document_by_hash("b" * 64) is None
+
+    linked_id = link_document(doc_id, {'file_name': "copy.txt", 'file_path': "p2"})
+    assert linked_id != doc_id
+    linked = get_document(linked_id)
+    assert linked.chunk_count == 2
+    assert linked.content_hash == "a" * 64
+    assert [c.content for c in get_chunks(linked_id)] == ["c0", "c1"]
+    assert [c.page_number for c in get_chunks(linked_id)] == [1, None]
+
+def test_save_chunks_in_batches(db_session):
+    """Chunks được ghi theo lô bằng Core insert, không sót dòng nào ở lô cuối"""
+    doc = Document(file_name="bulk.txt", file_path="p", file_type=".txt")
+    db_session.add(doc)
+    db_session.commit()
+    db_session.refresh(doc)
+
+    chunks_data = [{'chunk_index': i, 'content': f"chunk {i}"} for i in range(5)]
+    with patch.object(db_session, 'execute', wraps=db_session.execute) as spy:
+        save_chunks(doc.id, chunks_data, batch_size=2)
+        # 5 chunks, lô 2 -> 3 lần executemany
+        assert spy.call_count == 3
+
+    chunks = get_chunks(doc.id)
+    assert [c.chunk_index for c in chunks] == [0, 1, 2, 3, 4]
+    assert chunks[4].char_count == len("chunk 4")
+
+def test_save_document_with_chunks_from_generator(db_session):
+    """Chunks dạng iterator (pipeline streaming) được ghi theo lô, chunk_count lấy theo số chunks đã ghi"""
+    chunks = ({'chunk_index': i, 'content': f"chunk {i}"} for i in range(5))
+    doc_id = save_document_with_chunks({'file_name': "gen.txt", 'file_path': "p", 'file_type': ".txt"},
+                                       chunks, batch_size=2)
+    assert get_document(doc_id).chunk_count == 5
+    assert [c.content for c in get_chunks(doc_id)] == [f"chunk {i}" for i in range(5)]
+
+def test_chunk_compression_is_sqlite_only():
+    """PostgreSQL không nén chunks trong ứng dụng: không train dictionary, không ghi lại bảng chunks"""
+    from database import train_chunk_dictionary, recompress_chunks
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = 'postgresql'
+    with patch('database.SessionLocal', return_value=session):
+        with pytest.raises(ValueError):
+            recompress_chunks('zlib')
+        with pytest.raises(ValueError):
+            train_chunk_dictionary('zlib')
+    session.execute.assert_not_called()
+    session.commit.assert_not_called()
+
+def test_insert_chunks_uses_copy_on_postgresql():
+    """Trên PostgreSQL (psycopg2) chunks được ghi bằng COPY dạng CSV"""
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = 'postgresql'
+    session.get_bind.return_value.dialect.driver = 'psycopg2'
+    cursor = session.connection.return_value.connection.dbapi_connection.cursor.return_value.__enter__.return_value
+    payloads = []
+    cursor.copy_expert.side_effect = lambda sql, buffer: payloads.append(buffer.read())
+
+    chunks_data = [
+        {'chunk_index': 0, 'content': 'Xin chào, "thế giới"\nDòng 2'},
+        {'chunk_index': 1, 'content': ''},
+        {'chunk_index': 2, 'content': 'c'},
+    ]
+    assert _insert_chunks(session, 7, chunks_data, batch_size=2) == 3
+
+    assert len(payloads) == 2
+    assert "COPY chunks" in cursor.copy_expert.call_args[0][0]
+    assert payloads[0].startswith('7,0,"Xin chào, ""thế giới""\nDòng 2",')
+    # Chuỗi rỗng phải được quote để không bị hiểu thành NULL
+    assert '7,1,"",0' in payloads[0]
+    session.execute.assert_not_called()
+
+def test_upgrade_schema_adds_missing_columns():
+    """Bảng documents kiểu cũ được bổ sung các cột mới"""
+    from sqlalchemy import create_engine, inspect
+    old_engine = create_engine("sqlite:///:memory:")
+    with old_engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE documents (id INTEGER PRIMARY KEY, file_name VARCHAR NOT NULL, "
+            "file_path VARCHAR NOT NULL, file_type VARCHAR NOT NULL, file_size INTEGER, "
+            "upload_date DATETIME, chunk_count INTEGER)"
+        ))
+
+    _upgrade_schema(old_engine)
+
+    inspector = inspect(old_engine)
+    columns = {c['name'] for c in inspector.get_columns("documents")}
+    assert {"content_hash", "chunk_mode"} <= columns
+    assert any(ix['column_names'] == ["content_hash"] for ix in inspector.get_indexes("documents"))
+
+def test_chunk_sets_replace_and_link(db_session):
+    from database import replace_chunk_sets, get_chunk_sets
+    info = {'file_name': 'm.txt', 'file_path': 'p', 'file_type': '.txt', 'content_hash': "m" * 64, 'chunk_mode': "sentence"}
+    doc_id = save_document_with_chunks(info, [{'chunk_index': 0, 'content': "s0"}],
+                                       extra_chunk_sets={"paragraph": iter([{'chunk_index': 0, 'content': "p0"}])})
+    assert [c.content for c in get_chunks(doc_id)] == ["s0"]
+    assert [c.content for c in get_chunks(doc_id, "paragraph")] == ["p0"]
+    assert find_document_by_hash("m" * 64, ["sentence", "paragraph"]) == doc_id
+    assert find_document_by_hash("m" * 64, ["sentence", "token"]) is None
+
+    counts = replace_chunk_sets(doc_id, {
+        "sentence": [{'chunk_index': i, 'content': f"s{i}"} for i in range(3)],
+        "token": [{'chunk_index': 0, 'content': "t0"}]
+    })
+    assert counts == {"sentence": 3, "token": 1}
+    assert get_document(doc_id).chunk_count == 3
+    assert [(s['chunk_mode'], s['chunk_count']) for s in get_chunk_sets(doc_id)] == [
+        ("sentence", 3), ("paragraph", 1), ("token", 1)
+    ]
+    assert replace_chunk_sets(999999, {"token": []}) is None
+
+    # Document liên kết nhận đủ các bộ chunks
+    linked_id = link_document(doc_id, {'file_name': 'm(1).txt', 'file_path': 'p2'})
+    assert [c.content for c in get_chunks(linked_id, "token")] == ["t0"]
+    assert [c.content for c in get_chunks(linked_id)] == ["s0", "s1", "s2"]
+
 if __name__ == "__main__":
     pytest.main([__file__])
+
+def test_search_chunks_fulltext(db_session):
+    doc_a = save_document_with_chunks({'file_name': 'a.txt', 'file_path': '/tmp/a.txt', 'file_type': '.txt', 'file_size': 1}, [
+        {'chunk_index': 0, 'content': 'Hóa đơn tiền điện tháng một.', 'char_count': 28},
+        {'chunk_index': 1, 'content': 'Hợp đồng thuê nhà, hóa đơn điện nước.', 'char_count': 37},
+    ])
+    doc_b = save_document_with_chunks({'file_name': 'b.txt', 'file_path': '/tmp/b.txt', 'file_type': '.txt', 'file_size': 1}, [
+        {'chunk_index': 0, 'content': 'Báo cáo tài chính "quý" hai.', 'char_count': 28},
+    ])
+
+    hits = search_chunks("hóa đơn")
+    assert {(h['document_id'], h['chunk_index']) for h in hits} == {(doc_a, 0), (doc_a, 1)}
+    assert all('<b>' in h['snippet'] for h in hits)
+    assert hits[0]['rank'] >= hits[1]['rank']
+    assert hits[0]['file_name'] == 'a.txt'
+
+    # Ký tự đặc biệt của cú pháp FTS không gây lỗi
+    assert [h['document_id'] for h in search_chunks('"quý" OR (')] == []
+    assert [h['document_id'] for h in search_chunks('"quý"')] == [doc_b]
+    assert search_chunks("   ") == []
+
+    # Phân trang
+    assert len(search_chunks("hóa đơn", limit=1)) == 1
+    assert len(search_chunks("hóa đơn", limit=1, offset=1)) == 1
+
+    # Index được cập nhật khi xóa document
+    delete_document(doc_a)
+    assert search_chunks("hóa đơn") == []
+
+def test_chunk_range_and_iter_chunks(db_session):
+    chunks = [{'chunk_index': i, 'content': f"c{i}", 'char_count': 2} for i in range(7)]
+    doc_id = save_document_with_chunks({'file_name': 'r.txt', 'file_path': 'p', 'file_type': '.txt'}, chunks)
+
+    page = get_chunk_range(doc_id, start=2, end=6, limit=3)
+    assert [c['content'] for c in page['items']] == ["c2", "c3", "c4"]
+    assert page['next_start'] == 5
+    assert get_chunk_range(doc_id, start=5, end=6, limit=3)['next_start'] is None
+
+    # Đọc theo từng lô nhỏ hơn tổng số chunks vẫn đủ và đúng thứ tự
+    assert [c['chunk_index'] for c in iter_chunks(doc_id, batch_size=2)] == list(range(7))
+    assert list(iter_chunks(doc_id, start=10)) == []
+
+def test_chunk_codec_round_trip():
+    import chunk_codec
+    samples = [f"Điều {i}. Bên A có trách nhiệm thanh toán hóa đơn cho Bên B đúng hạn." for i in range(50)]
+    dictionary = chunk_codec.train_dictionary(samples, 'zlib')
+    assert 0 < len(dictionary) <= 32 * 1024
+    text_ = "Điều 51. Bên A có trách nhiệm thanh toán hóa đơn cho Bên B đúng hạn."
+    with_dict = chunk_codec.compress(text_, 'zlib', dictionary)
+    assert chunk_codec.decompress(with_dict, 'zlib', dictionary) == text_
+    assert len(with_dict) < len(chunk_codec.compress(text_, 'zlib'))
+    assert chunk_codec.parse_tag(chunk_codec.codec_tag('zlib', 3)) == ('zlib', 3)
+    with pytest.raises(ValueError):
+        chunk_codec.check_codec('lzma')
+
+def test_compressed_chunks_are_transparent(db_session, monkeypatch):
+    import chunk_codec
+    monkeypatch.setattr(chunk_codec, 'CHUNK_COMPRESSION', 'zlib')
+    monkeypatch.setattr(chunk_codec, 'CHUNK_COMPRESSION_MIN_BYTES', 32)
+    long_text = "Hợp đồng thuê nhà, hóa đơn điện nước được thanh toán hằng tháng. " * 5
+    chunks = [{'chunk_index': 0, 'content': long_text}, {'chunk_index': 1, 'content': "ngắn"}]
+    doc_id = save_document_with_chunks({'file_name': 'z.txt', 'file_path': 'p', 'file_type': '.txt',
+                                        'content_hash': "z" * 64}, chunks)
+
+    stored = db_session.execute(text("SELECT content, content_z, content_codec FROM chunks ORDER BY chunk_index")).all()
+    assert stored[0].content == '' and stored[0].content_codec == 'zlib' and len(stored[0].content_z) < len(long_text)
+    # Chunk ngắn hơn CHUNK_COMPRESSION_MIN_BYTES giữ text thường
+    assert stored[1] == ("ngắn", None, None)
+
+    db_session.expire_all()
+    assert [c.content for c in get_chunks(doc_id)] == [long_text, "ngắn"]
+    assert [c['content'] for c in get_chunk_range(doc_id)['items']] == [long_text, "ngắn"]
+    assert [c['content'] for c in iter_chunks(doc_id, batch_size=1)] == [long_text, "ngắn"]
+
+    # Index full-text đọc nội dung đã giải nén, kể cả snippet; document liên kết sao chép dạng nén
+    hits = search_chunks("điện nước")
+    assert [h['document_id'] for h in hits] == [doc_id]
+    assert '<b>điện</b>' in hits[0]['snippet']
+    linked = link_document(doc_id, {'file_name': 'z2.txt', 'file_path': 'p2'})
+    db_session.expire_all()
+    assert [c.content for c in get_chunks(linked)] == [long_text, "ngắn"]
+    assert {h['document_id'] for h in search_chunks("điện nước")} == {doc_id, linked}
+
+    delete_document(linked)
+    assert [h['document_id'] for h in search_chunks("điện nước")] == [doc_id]
+
+def test_recompress_chunks_with_dictionary(db_session, monkeypatch):
+    import chunk_codec
+    from database import train_chunk_dictionary, recompress_chunks, chunk_storage_stats
+    monkeypatch.setattr(chunk_codec, 'CHUNK_COMPRESSION_MIN_BYTES', 16)
+    contents = [f"Điều {i}: Bên thuê thanh toán tiền thuê nhà và hóa đơn điện nước trước ngày {i % 28 + 1}." for i in range(40)]
+    doc_id = save_document_with_chunks({'file_name': 'm.txt', 'file_path': 'p', 'file_type': '.txt'},
+                                       [{'chunk_index': i, 'content': c} for i, c in enumerate(contents)])
+    before = chunk_storage_stats()
+    assert before['compressed_chunks'] == 0 and before['ratio'] == 1
+
+    dictionary_id = train_chunk_dictionary('zlib', sample_count=20)
+    progress = []
+    result = recompress_chunks('zlib', batch_size=15, progress=progress.append)
+    assert result == {'rows': 40, 'updated': 40}
+    assert len(progress) == 3
+    codecs = {row[0] for row in db_session.execute(text("SELECT content_codec FROM chunks"))}
+    assert codecs == {f"zlib:{dictionary_id}"}
+    after = chunk_storage_stats()
+    assert after['raw_bytes'] == before['raw_bytes'] and after['ratio'] > 2
+
+    # Chạy lại: không còn gì để ghi; dictionary bị xóa khỏi cache vẫn được đọc lại từ database
+    assert recompress_chunks('zlib', batch_size=15)['updated'] == 0
+    import database
+    database._chunk_dictionaries.clear()
+    db_session.expire_all()
+    assert [c.content for c in get_chunks(doc_id)] == contents
+    assert {h['chunk_index'] for h in search_chunks("ngày 28")} == {27, 28}
+
+    # Giải nén về text thường
+    assert recompress_chunks('none')['updated'] == 40
+    assert chunk_storage_stats()['compressed_chunks'] == 0
+    assert [c['content'] for c in iter_chunks(doc_id)] == contents
+
+def test_fulltext_index_migrates_to_compressed_view():
+    """Bảng FTS5 cũ (đọc thẳng chunks.content) được tạo lại trên view chunks_text và index lại"""
+    from database import _setup_fulltext
+    old_engine = create_engine("sqlite:///:memory:")
+    with old_engine.begin() as conn:
+        conn.execute(text("CREATE TABLE chunks (id INTEGER PRIMARY KEY, content TEXT NOT NULL, "
+                          "content_z BLOB, content_codec VARCHAR)"))
+        conn.execute(text("CREATE VIRTUAL TABLE chunks_fts USING fts5(content, content='chunks', content_rowid='id')"))
+        conn.execute(text("INSERT INTO chunks (id, content) VALUES (1, 'hóa đơn cũ')"))
+
+    with old_engine.begin() as conn:
+        _setup_fulltext(conn)
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = 'chunks_fts'")).scalar()
+        assert "chunks_text" in sql
+        assert conn.execute(text("SELECT rowid FROM chunks_fts WHERE chunks_fts MATCH 'cũ'")).scalar() == 1
+
+def test_engine_options_from_environment(monkeypatch):
+    import database
+    from sqlalchemy.engine import make_url
+    monkeypatch.setattr(database, 'DB_POOL_SIZE', 20)
+    monkeypatch.setattr(database, 'DB_MAX_OVERFLOW', 5)
+    monkeypatch.setattr(database, 'DB_STATEMENT_TIMEOUT_MS', 1500)
+
+    async_url = database._async_url("postgresql://u:p@db:5432/OCR")
+    assert async_url.drivername == 'postgresql+asyncpg'
+    options = database._engine_options(async_url)
+    assert options['pool_size'] == 20 and options['max_overflow'] == 5 and options['pool_pre_ping'] is True
+    assert options['connect_args'] == {'server_settings': {'statement_timeout': '1500'}}
+    assert database._engine_options(make_url("postgresql://u:p@db/OCR"))['connect_args'] == {
+        'options': '-c statement_timeout=1500'
+    }
+    # SQLite: không có pool / pre-ping / statement timeout
+    assert database._async_url("sqlite:///x.db").drivername == 'sqlite+aiosqlite'
+    assert database._engine_options(make_url("sqlite:///x.db")) == {}
+
+def test_invalid_fts_config_rejected_at_import():
+    """FTS_CONFIG được kiểm tra khi nạp module, không đợi tới lúc tạo index full-text"""
+    import subprocess
+    src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+    env = {**os.environ, "FTS_CONFIG": "simple'); DROP TABLE chunks; --"}
+    result = subprocess.run([sys.executable, "-c", "import database"], cwd=src_dir, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode != 0
+    assert "FTS_CONFIG không hợp lệ" in result.stderr
@@ -0,0 +1,152 @@
+import sys
+import os
+import pytest
+from unittest.mock import patch
+
+# Thêm thư mục src vào path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import extract_cache
+from extract_cache import ExtractCache
+from processors.stream import TextStream, collect
+from processors.registry import REGISTRY
+
+TEXT = "Trang một của hợp đồng.\nTrang hai: điều khoản thanh toán.\n"
+
+def _counting_processor(calls, text=TEXT):
+    """Processor giả hai trang, đếm số lần được gọi; page_offsets được bổ sung dần như stream_pdf."""
+    def stream(filepath):
+        calls.append(filepath)
+        metadata = {'file_name': os.path.basename(filepath), 'file_size': os.path.getsize(filepath), 'page_offsets': []}
+        def segments():
+            half = len(text) // 2
+            metadata['page_offsets'].append(0)
+            yield text[:half]
+            metadata['page_offsets'].append(half)
+            yield text[half:]
+        return TextStream(metadata, segments())
+    return stream
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ExtractCache(str(tmp_path / "extract_cache"), enabled=True)
+    with patch.object(extract_cache, 'EXTRACT_CACHE', cache):
+        yield cache
+
+def test_hit_skips_processor(cache, tmp_path):
+    from main import extract_file
+    calls = []
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"%PDF-1.4 fake")
+    with patch.dict('main.STREAM_PROCESSORS', {'.pdf': _counting_processor(calls)}):
+        first = extract_file(str(path), chunk_mode='paragraph')
+        # Đổi chunk mode: dùng lại text trong cache, không chạy processor
+        second = extract_file(str(path), chunk_mode='sentence')
+        third = extract_file(str(path), chunk_mode='paragraph')
+
+    assert len(calls) == 1
+    written = cache._entries()[0][1]
+    assert first['cache_stats'] == {'hits': 0, 'misses': 1, 'writes': 1, 'evictions': 0, 'errors': 0,
+                                    'bytes_written': written}
+    assert second['cache_stats']['hits'] == 1
+    assert "".join("".join(second['chunks']).split()) == "".join(TEXT.split())
+    # page_offsets được lưu cùng text nên vẫn có số trang khi đọc từ cache
+    assert first['pages'] is not None
+    assert {**third, 'cache_stats': None} == {**first, 'cache_stats': None}
+    assert len(calls) == 1
+    assert cache.stats.as_dict()['hit_rate'] == round(2 / 3, 3)
+
+def test_hit_uses_current_file_name(cache, tmp_path):
+    calls = []
+    a, b = tmp_path / "a.pdf", tmp_path / "b_copy.pdf"
+    a.write_bytes(b"same content")
+    b.write_bytes(b"same content")
+    key = cache.key("h" * 64, "fake@1")
+    collect(cache.record(key, _counting_processor(calls)(str(a))))
+
+    result = collect(cache.get(key, str(b)))
+    assert result['content'] == TEXT
+    assert result['metadata']['file_name'] == "b_copy.pdf"
+    assert result['metadata']['page_offsets'] == [0, len(TEXT) // 2]
+
+def test_partial_stream_leaves_no_entry(cache, tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"x")
+    key = cache.key("h" * 64, "fake@1")
+    stream = cache.record(key, _counting_processor([])(str(path)))
+    next(iter(stream))
+    stream.segments.close()
+
+    assert cache.get(key, str(path)) is None
+    assert cache._entries() == []
+    assert not any(name.endswith(".tmp") for _, _, names in os.walk(cache.directory) for name in names)
+
+def test_corrupt_entry_is_a_miss(cache, tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"x")
+    key = cache.key("h" * 64, "fake@1")
+    collect(cache.record(key, _counting_processor([])(str(path))))
+    with open(cache._path(key), "r+b") as f:
+        f.truncate(3)
+
+    assert cache.get(key, str(path)) is None
+    assert cache.stats.errors == 1
+    assert not os.path.exists(cache._path(key))
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ExtractCache(str(tmp_path / "extract_cache"), max_mb=0.05, enabled=True, level=0)
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"x")
+    keys = [cache.key(str(i), "fake@1") for i in range(4)]
+    for i, key in enumerate(keys):
+        collect(cache.record(key, TextStream({}, iter(["x" * 20000]))))
+        os.utime(cache._path(key), (1000 + i, 1000 + i))
+        if i == 1:
+            # Dùng lại mục đầu tiên: không còn là mục cũ nhất
+            collect(cache.get(keys[0], str(path)))
+
+    remaining = {os.path.basename(p)[:-2] for _, _, p in cache._entries()}
+    assert keys[0] in remaining and keys[3] in remaining
+    assert keys[1] not in remaining
+    assert cache.stats.evictions >= 1
+
+def test_worker_processes_leave_eviction_to_parent(tmp_path):
+    # Process con của pipeline ghi mục cache nhưng không tự dọn: mỗi process chỉ thấy phần mình ghi,
+    # nên tự dọn thì tổng dung lượng có thể tới workers x max_bytes
+    directory = str(tmp_path / "extract_cache")
+    workers = [ExtractCache(directory, max_mb=0.05, enabled=True, level=0) for _ in range(2)]
+    parent = ExtractCache(directory, max_mb=0.05, enabled=True, level=0)
+    written = 0
+    for i, worker in enumerate(workers * 2):
+        worker.evicting = False
+        before = worker.stats.snapshot()['bytes_written']
+        collect(worker.record(worker.key(str(i), "fake@1"), TextStream({}, iter(["x" * 20000]))))
+        written += worker.stats.snapshot()['bytes_written'] - before
+    assert len(parent._entries()) == 4 and written > parent.max_bytes
+
+    # Process chính cộng số byte các process con báo về rồi dọn theo dung lượng thật trên đĩa
+    parent.account(written)
+    assert sum(size for _, size, _ in parent._entries()) <= parent.max_bytes
+    assert parent.stats.evictions >= 1
+
+def test_cache_tag_tracks_version_and_params(monkeypatch):
+    import processors.docx_processor as docx_processor
+    tag = REGISTRY.cache_tag('.docx')
+    assert tag == "processors.docx_processor:stream_docx@1?extractor=python-docx"
+
+    monkeypatch.setattr(docx_processor, 'DOCX_EXTRACTOR', 'xml')
+    assert REGISTRY.cache_tag('.docx') != tag
+    monkeypatch.setattr(docx_processor, 'DOCX_EXTRACTOR', 'python-docx')
+    monkeypatch.setattr(docx_processor, 'PROCESSOR_VERSION', '2')
+    assert REGISTRY.cache_tag('.docx') != tag
+
+def test_txt_is_not_cached(cache, tmp_path):
+    from main import extract_file
+    path = tmp_path / "note.txt"
+    path.write_text("Một câu ngắn.", encoding="utf-8")
+
+    assert REGISTRY.cache_tag('.txt') is None
+    extracted = extract_file(str(path))
+    assert extracted['chunks'] == ["Một câu ngắn."]
+    assert cache.stats.as_dict()['hits'] == cache.stats.as_dict()['misses'] == 0
+    assert cache._entries() == []
@@ -32,48 +32,56 @@ def test_process_directory(mock_exists, mock_walk, mock_process_file, mock_init_
     mock_init_db.assert_called_once()
     assert mock_process_file.call_count == 3
     
+def _fake_stream_processor(content, **metadata):
+    """Processor streaming giả lập: mỗi lần gọi trả TextStream mới với nội dung content."""
+    from processors.stream import TextStream
+    return MagicMock(side_effect=lambda filepath: TextStream(dict(metadata), iter([content])))
+
 def test_process_file_success():
-    with patch('main.PROCESSORS') as mock_processors:
-        mock_handler = MagicMock()
-        mock_handler.return_value = {
-            'content': 'dummy content',
-            'metadata': {'file_size': 123}
-        }
-        # Giả lập support .txt
-        mock_processors.__contains__.return_value = True 
-        mock_processors.__getitem__.return_value = mock_handler
-        
+    saved = []
+    def fake_save(file_info, chunks_data, job_id=None, extra_chunk_sets=None):
+        # Chunks được chuyển dạng iterator, ghi dần theo lô
+        saved.append((file_info, list(chunks_data)))
+        return len(saved)
+
+    with patch.dict('main.STREAM_PROCESSORS', {'.txt': _fake_stream_processor('dummy content', file_size=123)}):
         # Patch các hàm phụ thuộc khác
-        with patch('main.get_unique_filename') as mock_unique, \
-             patch('main.chunk_text') as mock_chunk, \
-             patch('main.save_document') as mock_save_doc, \
-             patch('main.save_chunks') as mock_save_chunks, \
+        with patch('main.compute_file_hash', return_value='h' * 64), \
+             patch('main.find_document_by_hash', return_value=None), \
+             patch('main.chunk_text_iter') as mock_chunk, \
+             patch('main.save_document_with_chunks', side_effect=fake_save) as mock_save_doc, \
              patch('os.makedirs') as mock_makedirs, \
              patch('builtins.open', new_callable=MagicMock) as mock_open:
             
-            mock_unique.return_value = 'test.txt'
-            mock_chunk.return_value = ['chunk1']
-            mock_save_doc.return_value = 1
+            mock_chunk.side_effect = lambda pieces, mode: iter(['chunk1'])
             
             # Gọi hàm với chế độ mặc định (sentence)
             result = process_file('path/to/test.txt')
             assert result is True
-            mock_chunk.assert_called_with('dummy content', mode='sentence')
+            assert mock_chunk.call_args.kwargs['mode'] == 'sentence'
             mock_save_doc.assert_called_once()
             
             # Reset mocks cho lần gọi sau
             mock_chunk.reset_mock()
             mock_save_doc.reset_mock()
-            mock_save_chunks.reset_mock()
+            saved.clear()
             
             # Gọi hàm với chế độ paragraph
             result_para = process_file('path/to/test.txt', chunk_mode='paragraph')
             assert result_para is True
-            mock_chunk.assert_called_with('dummy content', mode='paragraph')
+            assert mock_chunk.call_args.kwargs['mode'] == 'paragraph'
             mock_save_doc.assert_called_once()
-            mock_save_chunks.assert_called_once()
+            # Document + chunks được ghi trong cùng một lời gọi (một transaction)
+            file_info, chunks_data = saved[0]
+            assert file_info['file_name'] == 'test.txt'
+            assert file_info['file_size'] == 123
+            assert file_info['content_hash'] == 'h' * 64
+            assert file_info['chunk_mode'] == 'paragraph'
+            assert chunks_data == [{'chunk_index': 0, 'content': 'chunk1', 'char_count': 6}]
             
-            # Verify file saving logic
+            # Verify file saving logic (chunks vật lý được ghi nền, chờ ghi xong)
+            import chunk_store
+            assert chunk_store.WRITE_BEHIND.drain(timeout=10)
             mock_makedirs.assert_called()
             mock_open.assert_called()
 
@@ -82,3 +90,151 @@ def test_process_file_unsupported():
         # Dict rỗng -> không support gì cả
         result = process_file('test.xyz')
         assert result is None
+
+def test_list_processors(capsys):
+    from main import list_processors, parse_args
+    assert parse_args(["--list-processors"]).list_processors
+    rows = list_processors()
+    assert {'.txt', '.pdf', '.docx'} <= {row[0] for row in rows}
+    assert "processors.pdf_processor:stream_pdf" in capsys.readouterr().out
+
+def test_persist_stream_packed_chunks(tmp_path):
+    import chunk_store
+    from main import persist_stream
+    from chunk_store import open_reader
+    (tmp_path / "input").mkdir()
+    filepath = str(tmp_path / "input" / "doc.txt")
+    chunks = [{'chunk_index': i, 'content': f"Đoạn {i}", 'char_count': 6} for i in range(3)]
+
+    def fake_save(file_info, chunks_data, job_id=None, extra_chunk_sets=None):
+        assert len(list(chunks_data)) == 3
+        return 1
+
+    with patch('main.save_document_with_chunks', side_effect=fake_save):
+        persist_stream(filepath, '.txt', {}, iter(chunks), file_name='doc.txt', chunk_format='packed')
+    assert chunk_store.WRITE_BEHIND.drain(timeout=10)
+    base = str(tmp_path / "chunks_data" / "doc_txt_sentence_chunks")
+    with open_reader(base) as reader:
+        assert list(reader) == ["Đoạn 0", "Đoạn 1", "Đoạn 2"]
+
+    # Ghi DB lỗi giữa chừng: không để lại artifact (kể cả file .tmp)
+    def failing_save(file_info, chunks_data, job_id=None, extra_chunk_sets=None):
+        next(iter(chunks_data))
+        raise RuntimeError("db down")
+
+    with patch('main.save_document_with_chunks', side_effect=failing_save):
+        with pytest.raises(RuntimeError):
+            persist_stream(filepath, '.txt', {}, iter(chunks), file_name='doc2.txt', chunk_format='packed')
+    assert chunk_store.WRITE_BEHIND.drain(timeout=10)
+    assert sorted(os.listdir(tmp_path / "chunks_data")) == ["doc_txt_sentence_chunks.idx", "doc_txt_sentence_chunks.pack"]
+
+@patch('main.init_database')
+@patch('main.find_document_by_hash')
+@patch('main.persist_file')
+def test_process_directory_staged(mock_persist, mock_find, mock_init_db, tmp_path):
+    # Tạo thư mục thật để các process con có thể đọc file
+    (tmp_path / "a.txt").write_text("File A. Nội dung.", encoding="utf-8")
+    (tmp_path / "b.txt").write_text("File B.", encoding="utf-8")
+    (tmp_path / "c.txt").write_text("File C lỗi khi ghi DB.", encoding="utf-8")
+    (tmp_path / "d.xyz").write_text("Không hỗ trợ", encoding="utf-8")
+    sub = tmp_path / "sub"
+    sub.mkdir()
+    (sub / "a_copy.txt").write_text("File A. Nội dung.", encoding="utf-8")
+
+    saved_hashes = {}
+    def fake_persist(filepath, extracted, chunk_mode="sentence", content_hash=None):
+        if filepath.endswith("c.txt"):
+            raise RuntimeError("DB down")
+        saved_hashes[content_hash] = len(saved_hashes) + 1
+        return saved_hashes[content_hash]
+    mock_persist.side_effect = fake_persist
+    mock_find.side_effect = lambda content_hash, chunk_mode=None: saved_hashes.get(content_hash)
+
+    counters = process_directory(str(tmp_path), workers=2)
+
+    # a_copy.txt trùng nội dung với a.txt -> bỏ qua, không trích xuất lại
+    assert counters == {'success': 2, 'fail': 1, 'skip': 2}
+    assert mock_persist.call_count == 3
+    # Kết quả trích xuất từ process con được chuyển cho writer
+    extracted_by_name = {os.path.basename(c.args[0]): c.args[1] for c in mock_persist.call_args_list}
+    assert "a_copy.txt" not in extracted_by_name
+    assert extracted_by_name["b.txt"]["chunks"] == ["File B."]
+    assert extracted_by_name["a.txt"]["file_type"] == ".txt"
+
+def test_extract_file_assigns_page_numbers():
+    from main import extract_file
+    page_one = " ".join(f"Câu {i} của trang một." for i in range(40)) + "\n"
+    page_three = " ".join(f"Câu {i} của trang ba." for i in range(40)) + "\n"
+    # Trang 2 không có text: cùng offset với trang 3
+    offsets = [0, len(page_one), len(page_one)]
+    processor = _fake_stream_processor(page_one + page_three, file_size=1, page_count=3, page_offsets=offsets)
+    with patch.dict('main.STREAM_PROCESSORS', {'.pdf': processor}):
+        extracted = extract_file('doc.pdf', chunk_mode='sentence')
+
+    assert 'page_offsets' not in extracted['metadata']
+    assert len(extracted['chunks']) == 2
+    assert extracted['chunks'][1].startswith("Câu") and "trang ba" in extracted['chunks'][1]
+    assert extracted['pages'] == [1, 3]
+
+def test_stream_file_is_incremental(tmp_path):
+    from main import stream_file
+    from processors.stream import TextStream
+    produced = []
+    def segments():
+        for i in range(1000):
+            produced.append(i)
+            yield f"Đoạn {i} của tài liệu rất dài.\n"
+
+    with patch.dict('main.STREAM_PROCESSORS', {'.txt': lambda filepath: TextStream({}, segments())}):
+        stream, chunks = stream_file('big.txt', chunk_mode='paragraph')
+        first = next(chunks)
+        # Chunk đầu được trả khi mới đọc một phần nhỏ của file
+        assert first['chunk_index'] == 0
+        assert len(produced) < 100
+        assert sum(1 for _ in chunks) > 10
+        assert len(produced) == 1000
+
+def test_extraction_finishes_before_write_transaction(tmp_path):
+    from main import ingest_file
+    from processors.stream import TextStream
+    import chunk_store
+    produced = []
+    def segments():
+        for i in range(1000):
+            produced.append(i)
+            yield f"Đoạn {i} của tài liệu rất dài.\n"
+
+    saved = {}
+    def fake_save(file_info, chunks_data, job_id=None, extra_chunk_sets=None):
+        # Transaction chỉ được mở khi processor đã chạy xong: không giữ lock trong lúc trích xuất / OCR
+        saved['produced'] = len(produced)
+        saved['chunks'] = [chunk['content'] for chunk in chunks_data]
+        return 1
+
+    (tmp_path / "input").mkdir()
+    filepath = str(tmp_path / "input" / "big.txt")
+    with patch.dict('main.STREAM_PROCESSORS', {'.txt': lambda filepath: TextStream({}, segments())}), \
+         patch('main.compute_file_hash', return_value='h' * 64), \
+         patch('main.find_document_by_hash', return_value=None), \
+         patch('main.save_document_with_chunks', side_effect=fake_save):
+        assert ingest_file(filepath, chunk_mode='paragraph') == (True, 1, True)
+    assert saved['produced'] == 1000
+    assert saved['chunks'][0].startswith("Đoạn 0") and len(saved['chunks']) > 10
+    assert chunk_store.WRITE_BEHIND.drain(timeout=10)
+
+def test_process_file_skipped_pdf_creates_nothing(tmp_path):
+    from processors.stream import TextStream
+    def scanned(filepath):
+        metadata = {'file_size': 1, 'page_offsets': []}
+        def pages():
+            metadata['page_offsets'] += [0, 0]
+            metadata['skipped'] = "PDF dạng scan"
+            yield from ()
+        return TextStream(metadata, pages())
+
+    with patch.dict('main.STREAM_PROCESSORS', {'.pdf': scanned}), \
+         patch('main.compute_file_hash', return_value='h' * 64), \
+         patch('main.find_document_by_hash', return_value=None), \
+         patch('main.save_document_with_chunks') as mock_save:
+        assert process_file(str(tmp_path / 'scan.pdf')) is False
+        mock_save.assert_not_called()
@@ -1,5 +1,6 @@
 import sys
 import os
+import codecs
 import pytest
 
 # Thêm thư mục src vào path
@@ -72,5 +73,315 @@ def test_process_docx(mock_document, tmp_path):
     assert result['metadata']['file_name'] == "test.docx"
     assert result['metadata']['paragraph_count'] == 1
 
+def _write_text_pdf(path, page_texts):
+    """Tạo file PDF tối giản, mỗi trang một dòng text (font Helvetica có sẵn)."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in page_texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    path.write_bytes(out)
+
+def test_process_pdf_parallel_matches_serial(tmp_path, monkeypatch):
+    import processors.pdf_processor as pdf_processor
+    p = tmp_path / "pages.pdf"
+    texts = [f"Page {i} text." if i % 5 else "" for i in range(1, 13)]
+    _write_text_pdf(p, texts)
+
+    serial = process_pdf(str(p), workers=1)
+    monkeypatch.setattr(pdf_processor, "PDF_PARALLEL_MIN_PAGES", 4)
+    with patch.object(pdf_processor, "_iter_parallel", wraps=pdf_processor._iter_parallel) as spy:
+        parallel = process_pdf(str(p), workers=2)
+        spy.assert_called_once()
+
+    assert parallel == serial
+    assert serial['metadata']['page_count'] == 12
+    content, offsets = serial['content'], serial['metadata']['page_offsets']
+    assert len(offsets) == 12
+    # Trang có text bắt đầu đúng tại offset của nó; trang rỗng không chiếm ký tự nào
+    assert content[offsets[0]:].startswith("Page 1 text.")
+    assert content[offsets[10]:].startswith("Page 11 text.")
+    assert offsets[4] == offsets[5]
+
+def test_pdf_page_ranges_cover_all_pages():
+    from processors.pdf_processor import _page_ranges
+    for num_pages in (1, 7, 200, 2001):
+        ranges = _page_ranges(num_pages, 25)
+        assert ranges[0][0] == 0 and ranges[-1][1] == num_pages
+        assert all(0 < stop - start <= 25 for start, stop in ranges)
+        assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+
+def test_pdf_parallel_is_bounded_and_spawned(monkeypatch):
+    import processors.pdf_processor as pdf_processor
+    from concurrent.futures import Future
+    pools = []
+
+    class InlinePool:
+        """Pool giả: chạy khoảng trang ngay khi submit, ghi lại số khoảng đã submit."""
+        def __init__(self, max_workers, mp_context=None):
+            self.mp_context = mp_context
+            self.submitted = 0
+            pools.append(self)
+        def __enter__(self):
+            return self
+        def __exit__(self, *exc):
+            return False
+        def submit(self, fn, filepath, start, stop):
+            self.submitted += 1
+            future = Future()
+            future.set_result([f"trang {i}" for i in range(start, stop)])
+            return future
+
+    monkeypatch.setattr(pdf_processor, "ProcessPoolExecutor", InlinePool)
+    monkeypatch.setattr(pdf_processor, "PDF_RANGE_PAGES", 10)
+    pages = pdf_processor._iter_parallel("big.pdf", 1000, workers=2)
+    assert next(pages) == "trang 0"
+    pool = pools[0]
+    assert pool.mp_context.get_start_method() == "spawn"
+    # Trang đầu có khi mới submit 2 * workers khoảng, không phải cả 100 khoảng
+    assert pool.submitted == 4
+    assert list(pages) == [f"trang {i}" for i in range(1, 1000)]
+    assert pool.submitted == 100
+
+def test_stream_txt_matches_full_read(tmp_path, monkeypatch):
+    import processors.txt_processor as txt_processor
+    from processors.txt_processor import stream_txt
+    p = tmp_path / "crlf.txt"
+    text = "Dòng tiếng Việt có dấu.\r\n" * 50
+    p.write_bytes(text.encode("utf-8"))
+    # Khối nhỏ: ranh giới khối rơi giữa \r\n và giữa ký tự nhiều byte
+    monkeypatch.setattr(txt_processor, "TXT_BLOCK_SIZE", 7)
+    stream = stream_txt(str(p))
+    segments = list(stream)
+    assert len(segments) > 1
+    with open(p, encoding="utf-8") as f:
+        assert "".join(segments) == f.read()
+    assert stream.metadata['encoding'].lower().replace("-", "") == "utf8"
+    assert process_txt(str(p))['content'] == "".join(segments)
+
+@patch('processors.docx_processor.docx.Document')
+def test_stream_docx_paragraphs(mock_document, tmp_path):
+    from processors.docx_processor import stream_docx
+    paragraphs = [MagicMock(text=t) for t in ["Một", "  ", "Hai", "Ba"]]
+    mock_document.return_value = MagicMock(paragraphs=paragraphs)
+    p = tmp_path / "paras.docx"
+    p.write_bytes(b"PK...")
+
+    stream = stream_docx(str(p))
+    assert "paragraph_count" not in stream.metadata
+    assert list(stream) == ["Một", "\nHai", "\nBa"]
+    assert stream.metadata['paragraph_count'] == 3
+
+def test_stream_docx_xml_matches_python_docx(tmp_path, monkeypatch):
+    import docx
+    import processors.docx_processor as docx_processor
+    document = docx.Document()
+    document.add_paragraph("Hợp đồng & <phụ lục>")
+    document.add_paragraph("   ")
+    run = document.add_paragraph("Điều 1. ").add_run("Giá")
+    run.add_tab()
+    run.add_text("hai tỷ")
+    run.add_break()
+    run.add_text("đồng")
+    document.add_paragraph("Kết thúc.")
+    p = tmp_path / "doc.docx"
+    document.save(str(p))
+
+    # Đưa XML cho parser từng phần rất nhỏ: thẻ và ký tự UTF-8 bị cắt giữa các lần đọc
+    monkeypatch.setattr(docx_processor, "DOCX_READ_SIZE", 7)
+    stream = docx_processor.stream_docx(str(p), extractor="xml")
+    segments = list(stream)
+    assert segments == ["Hợp đồng & <phụ lục>", "\nĐiều 1. Giá\thai tỷ\nđồng", "\nKết thúc."]
+    assert stream.metadata['paragraph_count'] == 3
+    assert process_docx(str(p), extractor="xml") == process_docx(str(p), extractor="python-docx")
+
+def test_stream_docx_xml_tables_in_document_order(tmp_path):
+    import docx
+    from processors.docx_processor import stream_docx
+    document = docx.Document()
+    document.add_paragraph("Trước bảng")
+    table = document.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Tên"
+    table.cell(0, 1).text = "Giá"
+    table.cell(1, 0).add_paragraph("thứ hai")
+    table.cell(1, 0).paragraphs[0].text = "Dòng"
+    nested = table.cell(1, 1).add_table(rows=1, cols=2)
+    nested.cell(0, 0).text = "a"
+    nested.cell(0, 1).text = "b"
+    document.add_paragraph("Sau bảng")
+    p = tmp_path / "table.docx"
+    document.save(str(p))
+
+    result = process_docx(str(p), extractor="xml")
+    assert result['content'] == "Trước bảng\nTên\tGiá\nDòng thứ hai\ta\tb\nSau bảng"
+    assert result['metadata']['paragraph_count'] == 4
+    with pytest.raises(ValueError):
+        stream_docx(str(p), extractor="lxml")
+
+def test_registry_is_lazy_on_import():
+    import subprocess
+    # Process mới: import app/main không được kéo theo thư viện parser
+    code = (
+        "import sys, main\n"
+        "assert '.pdf' in main.PROCESSORS\n"
+        "print(sorted(m for m in ('PyPDF2', 'docx', 'chardet') if m in sys.modules))\n"
+        "main.STREAM_PROCESSORS['.txt']\n"
+        "print(sorted(m for m in ('PyPDF2', 'docx', 'chardet') if m in sys.modules))\n"
+    )
+    src = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src'))
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=src, capture_output=True, text=True, check=True,
+        env=dict(os.environ, DATABASE_URL="sqlite://")
+    )
+    assert result.stdout.splitlines() == ["[]", "['chardet']"]
+
+def test_registry_entry_point_processor(tmp_path, monkeypatch):
+    from processors.registry import ProcessorRegistry, LazyRef
+    # Package giả cài qua entry point: chỉ có metadata + module plugin trên sys.path
+    dist = tmp_path / "rtf_plugin-1.0.dist-info"
+    dist.mkdir()
+    (dist / "METADATA").write_text("Metadata-Version: 2.1\nName: rtf-plugin\nVersion: 1.0\n")
+    (dist / "entry_points.txt").write_text("[ocr_pipeline.processors]\n.RTF = rtf_plugin:stream_rtf\n")
+    (tmp_path / "rtf_plugin.py").write_text(
+        "from processors.stream import TextStream\n"
+        "def stream_rtf(filepath):\n"
+        "    return TextStream({'file_name': filepath}, iter(['Xin ', 'chào']))\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    registry = ProcessorRegistry()
+    assert '.rtf' in registry.stream_processors
+    assert 'rtf_plugin' not in sys.modules
+    assert ('.rtf', 'rtf_plugin:stream_rtf', 'rtf-plugin 1.0', False) in registry.describe()
+    assert registry.processors['.rtf']('a.rtf') == {'content': 'Xin chào', 'metadata': {'file_name': 'a.rtf'}}
+    assert registry.processors.is_loaded('.rtf')
+    monkeypatch.delitem(sys.modules, 'rtf_plugin')
+
+    # copy / khôi phục (như patch.dict) giữ nguyên processor chưa import
+    saved = registry.stream_processors.copy()
+    registry.stream_processors.clear()
+    registry.stream_processors.update(saved)
+    assert isinstance(registry.stream_processors._entries['.pdf'], LazyRef)
+
+@pytest.fixture
+def fake_ocr(tmp_path, monkeypatch):
+    """pdftoppm / tesseract giả lập: ảnh trang là chuỗi "image-<trang>", tesseract ghi log mỗi lần chạy."""
+    import ocr
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "tesseract_calls.log"
+    pdftoppm = bin_dir / "pdftoppm"
+    # Tham số: -f N -l N -r DPI -png -singlefile input root
+    pdftoppm.write_text('#!/bin/sh\neval root=\\${$#}\nprintf "image-%s" "$2" > "$root.png"\n')
+    tesseract = bin_dir / "tesseract"
+    tesseract.write_text(f'#!/bin/sh\necho "$1" >> "{calls}"\nprintf "OCR %s.\\n\\f" "$(cat "$1")"\n')
+    for script in (pdftoppm, tesseract):
+        script.chmod(0o755)
+
+    monkeypatch.setattr(ocr, "OCR_ENABLED", True)
+    monkeypatch.setattr(ocr, "PDFTOPPM_CMD", str(pdftoppm))
+    monkeypatch.setattr(ocr, "TESSERACT_CMD", str(tesseract))
+    monkeypatch.setattr(ocr, "OCR_CACHE_DIR", str(tmp_path / "ocr_cache"))
+    monkeypatch.setattr(ocr, "OCR_STATS", ocr.OcrStats())
+    return lambda: len(calls.read_text().splitlines()) if calls.exists() else 0
+
+def test_process_pdf_ocr_missing_pages_with_cache(tmp_path, fake_ocr):
+    import ocr
+    p = tmp_path / "scan.pdf"
+    _write_text_pdf(p, ["", "Page 2 text.", "", ""])
+
+    result = process_pdf(str(p), workers=1)
+    # Chỉ các trang không có text được OCR, kết quả giữ đúng thứ tự trang
+    assert result['content'] == "OCR image-1.\nPage 2 text.\nOCR image-3.\nOCR image-4.\n"
+    assert result['metadata']['ocr_pages'] == 3
+    assert fake_ocr() == 3
+
+    # Ingest lại cùng bản scan: lấy từ cache, không chạy tesseract
+    again = process_pdf(str(p), workers=1)
+    assert again['content'] == result['content']
+    assert fake_ocr() == 3
+    stats = ocr.OCR_STATS.as_dict()
+    assert stats['pages'] == 6
+    assert stats['cache_hits'] == 3
+    assert stats['cache_hit_rate'] == 0.5
+    assert stats['seconds_per_page'] is not None
+
+def test_process_pdf_without_ocr_skips_scan(tmp_path, monkeypatch):
+    import ocr
+    monkeypatch.setattr(ocr, "OCR_ENABLED", False)
+    p = tmp_path / "scan.pdf"
+    _write_text_pdf(p, ["", ""])
+    assert process_pdf(str(p)) is None
+
+_FRENCH = ("Il était une fois, dans un château très éloigné, une princesse qui s’ennuyait. "
+           "Les élèves étudient la géographie et l’histoire de la République française.\r\n")
+_RUSSIAN = "Съешь же ещё этих мягких французских булок, да выпей чаю.\r\n"
+
+@pytest.mark.parametrize("encoding, prefix, text", [
+    ("utf-8", "", "Hợp đồng mua bán căn hộ, giá trị hai tỷ đồng.\r\n"),
+    ("utf-16", "", _FRENCH),
+    ("utf-8-sig", "", _FRENCH),
+    ("windows-1252", "", _FRENCH),
+    ("windows-1251", "", _RUSSIAN),
+    # Phần đầu toàn ASCII dài hơn mẫu nhận diện: encoding được nhận diện tại byte non-ASCII đầu tiên
+    ("windows-1252", "Plain ASCII line.\r\n" * 300, _FRENCH),
+])
+def test_stream_txt_encodings(tmp_path, monkeypatch, encoding, prefix, text):
+    import processors.txt_processor as txt_processor
+    monkeypatch.setattr(txt_processor, "TXT_DETECT_BYTES", 1024)
+    monkeypatch.setattr(txt_processor, "TXT_BLOCK_SIZE", 4096)
+    monkeypatch.setattr(txt_processor, "TXT_MMAP_MIN_SIZE", 1)
+    body = text * 200
+    p = tmp_path / "enc.txt"
+    p.write_bytes((prefix + body).encode(encoding))
+
+    result = process_txt(str(p))
+    with open(p, encoding=encoding) as f:
+        assert result['content'] == f.read()
+    assert codecs.lookup(result['metadata']['encoding']).name == codecs.lookup(encoding).name
+
+def test_stream_txt_cr_at_block_boundary(tmp_path, monkeypatch):
+    import processors.txt_processor as txt_processor
+    monkeypatch.setattr(txt_processor, "TXT_BLOCK_SIZE", 4)
+    p = tmp_path / "cr.txt"
+    p.write_bytes(b"abc\r\ndef\rghi\r")
+    assert process_txt(str(p))['content'] == "abc\ndef\nghi\n"
+    (tmp_path / "empty.txt").write_bytes(b"")
+    assert process_txt(str(tmp_path / "empty.txt"))['content'] == ""
+
 if __name__ == "__main__":
     pytest.main([__file__])
+
+def test_text_spool_replays_without_rerunning_processor():
+    from processors.stream import TextStream, TextSpool
+    produced = []
+    def segments():
+        for part in ("Dòng một\r\n", "", "Dòng hai"):
+            produced.append(part)
+            yield part
+    spool = TextSpool(TextStream({'file_size': 1}, segments()))
+    with pytest.raises(RuntimeError):
+        spool.replay()
+    assert "".join(spool.stream) == "Dòng một\r\nDòng hai"
+
+    for _ in range(2):
+        replay = spool.replay()
+        assert "".join(replay) == "Dòng một\r\nDòng hai"
+        assert replay.metadata is spool.stream.metadata
+    assert len(produced) == 3
+    spool.close()
@@ -0,0 +1,130 @@
+import sys
+import os
+import threading
+import pytest
+from unittest.mock import patch, MagicMock
+
+# Thêm thư mục src vào path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from database import Document, SourceFile
+from sync import sync_directory, watch_directory
+
+@pytest.fixture
+def db_session(test_db):
+    # Ngăn code ứng dụng đóng session (gây lỗi DetachedInstanceError)
+    original_close = test_db.close
+    test_db.close = MagicMock()
+
+    with patch('database.SessionLocal', return_value=test_db), \
+         patch('sync.init_database'):
+        yield test_db
+
+    test_db.close = original_close
+
+@pytest.fixture
+def docs_dir(tmp_path):
+    d = tmp_path / "docs"
+    d.mkdir()
+    (d / "a.txt").write_text("File A. Phiên bản một.", encoding="utf-8")
+    (d / "b.txt").write_text("File B.", encoding="utf-8")
+    return d
+
+def test_sync_only_ingests_new_or_modified(db_session, docs_dir):
+    counters = sync_directory(str(docs_dir))
+    assert counters['success'] == 2
+    assert db_session.query(SourceFile).count() == 2
+
+    # Chạy lại: không file nào bị đọc lại
+    with patch('sync.compute_file_hash') as mock_hash, patch('main.stream_file') as mock_extract:
+        counters = sync_directory(str(docs_dir))
+        mock_hash.assert_not_called()
+        mock_extract.assert_not_called()
+    assert counters['unchanged'] == 2
+    assert counters['success'] == 0
+
+    # Sửa a.txt -> chỉ a.txt được ingest lại, document cũ bị retire
+    old_doc_id = db_session.query(SourceFile).filter(SourceFile.path.endswith("a.txt")).one().document_id
+    (docs_dir / "a.txt").write_text("File A. Phiên bản hai, dài hơn.", encoding="utf-8")
+    counters = sync_directory(str(docs_dir), retire=True)
+    assert counters['success'] == 1
+    assert counters['unchanged'] == 1
+    assert counters['retired'] == 1
+    assert db_session.query(Document).filter_by(id=old_doc_id).first() is None
+
+def test_sync_touch_and_retire_missing(db_session, docs_dir):
+    sync_directory(str(docs_dir))
+
+    # Chỉ đổi mtime, nội dung giữ nguyên -> không ingest lại
+    st = os.stat(docs_dir / "b.txt")
+    os.utime(docs_dir / "b.txt", ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    counters = sync_directory(str(docs_dir))
+    assert counters['unchanged'] == 2
+    assert db_session.query(Document).count() == 2
+
+    # File nguồn bị xóa -> retire document
+    os.remove(docs_dir / "b.txt")
+    counters = sync_directory(str(docs_dir), retire=True)
+    assert counters['retired'] == 1
+    assert db_session.query(Document).count() == 1
+    assert db_session.query(SourceFile).count() == 1
+
+@pytest.mark.parametrize("dedup_policy", ["skip", "link"])
+def test_retire_keeps_documents_sync_did_not_create(db_session, docs_dir, tmp_path, dedup_policy):
+    from main import process_file
+    # report.txt được ingest trực tiếp, rồi một bản sao được đặt vào thư mục sync
+    report = tmp_path / "report.txt"
+    report.write_text("Báo cáo quý. Nội dung gốc.", encoding="utf-8")
+    assert process_file(str(report)) is True
+    original_id = db_session.query(Document).filter(Document.file_name == "report.txt").one().id
+    (docs_dir / "report_copy.txt").write_bytes(report.read_bytes())
+
+    sync_directory(str(docs_dir), dedup_policy=dedup_policy)
+    entry = db_session.query(SourceFile).filter(SourceFile.path.endswith("report_copy.txt")).one()
+    assert not entry.owned
+    assert (entry.document_id == original_id) == (dedup_policy == "skip")
+
+    # Bản sao biến mất: manifest được dọn nhưng không document nào bị xóa qua tham chiếu skip / link
+    documents = db_session.query(Document).count()
+    os.remove(docs_dir / "report_copy.txt")
+    counters = sync_directory(str(docs_dir), dedup_policy=dedup_policy, retire=True)
+    assert counters['retired'] == 0
+    assert db_session.query(Document).filter_by(id=original_id).first() is not None
+    assert db_session.query(Document).count() == documents
+    assert db_session.query(SourceFile).filter(SourceFile.path.endswith("report_copy.txt")).first() is None
+
+def test_watch_polling_fallback(db_session, docs_dir):
+    import sync
+    stop = threading.Event()
+    ingested = threading.Event()
+    original_sync = sync._sync_directory
+
+    def tracking_sync(*args, **kwargs):
+        counters = original_sync(*args, **kwargs)
+        if counters['success']:
+            ingested.set()
+        return counters
+
+    # Giả lập chưa cài watchdog -> dùng polling
+    with patch.dict(sys.modules, {'watchdog': None, 'watchdog.observers': None, 'watchdog.events': None}), \
+         patch('sync._sync_directory', side_effect=tracking_sync):
+        watcher = threading.Thread(
+            target=watch_directory, args=(str(docs_dir),),
+            kwargs={'poll_interval': 0.05, 'stop_event': stop}
+        )
+        watcher.start()
+        try:
+            # Chờ lần sync đầu tiên xong rồi mới thả file mới vào
+            assert ingested.wait(5)
+            ingested.clear()
+            (docs_dir / "c.txt").write_text("File C mới xuất hiện.", encoding="utf-8")
+            assert ingested.wait(5)
+        finally:
+            stop.set()
+            watcher.join()
+
+    assert db_session.query(Document).filter(Document.file_name == "c.txt").first() is not None
+    assert db_session.query(Document).count() == 3
+
+if __name__ == "__main__":
+    pytest.main([__file__])